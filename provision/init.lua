@@ -72,8 +72,8 @@
 --     }
 -- ]
 
--- If You want use method queue.put_unique you have to add additional
--- (fourth) index:
+-- Methods queue.put_unique and queue.put_unique_many need the additional
+-- (fourth) index on task data (provision/tarantool.cfg defines it):
 --            {
 --                type    = "TREE",
 --                unique  = 0,
@@ -210,6 +210,19 @@ local function rettask(task)
 end
 
 
+-- task tuple (as rettask returns it) with the task priority appended
+-- in the same form as it was passed to queue.put
+local function rettask_pri(task)
+    if task == nil then
+        return
+    end
+
+    local pri = max_pri - pri_unpack(task[i_pri]) + min_pri - queue.default.pri
+    task = rettask(task)
+    return task:transform(#task, 0, tostring(pri))
+end
+
+
 local function process_tube(space, tube)
 
     while true do
@@ -688,8 +701,30 @@ queue.put = function(space, tube, ...)
     return put_task(space, tube, queue.default.ipri, ...)
 end
 
+local function put_unique_task(space, tube, delay, ttl, ttr, pri, data, ...)
+    if data == nil then
+        error('Can not put unique task without data')
+    end
+
+    if box.space[space].index[idx_data] == nil then
+        error("Tarantool have to be configured to use queue.put_unique method")
+    end
+
+    -- a task with the same data is waiting to be taken, whether its delay is over or not
+    for _, status in pairs({ ST_READY, ST_DELAYED }) do
+        local task = box.select( space, idx_data, tube, status, data )
+        if task ~= nil then
+            return rettask( task )
+        end
+    end
+    queue.stat[space][tube]:inc('put')
+    -- put_task converts delay, ttl and ttr to time64 itself
+    return put_task(space, tube, queue.default.ipri, delay, ttl, ttr, pri, data, ...)
+end
+
 -- queue.put_unique(space, tube, delay, ttl, ttr, pri, ...)
 --  put unique task into queue.
+--  if a ready or delayed task of the tube has the same data, returns it instead
 --   arguments
 --      1. tube - queue name
 --      2. delay - delay before task can be taken
@@ -697,34 +732,48 @@ end
 --      4. ttr - time to release (when task is taken)
 --      5. pri - priority
 --      6. ... - task data
-queue.put_unique = function(space, tube, delay, ttl, ttr, pri, data, ...)
+queue.put_unique = function(space, tube, ...)
     space = tonumber(space)
+    return put_unique_task(space, tube, ...)
+end
 
-    delay = tonumber(delay)
-    if delay <= 0 then
-        delay = queue.default.delay
-    end
-    delay = to_time64(delay)
-
-    local check_status = ST_READY
-    if delay > 0 then
-        check_status = ST_DELAYED
+-- queue.put_unique_many(space, tube, delay, ttl, ttr, pri, data, ...)
+--  put several unique tasks into queue in one call (see queue.put_unique).
+--   arguments after tube are groups of five fields, one group per task:
+--      delay, ttl, ttr, pri, data
+--   returns tuples of the new or already queued tasks in the same order
+queue.put_unique_many = function(space, tube, ...)
+    space = tonumber(space)
+    local args = {...}
+    if #args % 5 ~= 0 then
+        error('Each task must have delay, ttl, ttr, pri and data')
     end
 
-    if data == nil then
-	error('Can not put unique task without data')
+    local tasks = {}
+    for i = 1, #args, 5 do
+        table.insert(tasks, put_unique_task(space, tube, unpack(args, i, i + 4)))
     end
+    return unpack(tasks)
+end
 
-    if box.space[space].index[idx_data] == nil then
-        error("Tarantool have to be configured to use queue.put_unique method")
+-- queue.put_many(space, tube, delay, ttl, ttr, pri, data, ...)
+--  put several tasks into queue in one call.
+--   arguments after tube are groups of five fields, one group per task:
+--      delay, ttl, ttr, pri, data (see queue.put)
+--   returns tuples of the tasks in the same order
+queue.put_many = function(space, tube, ...)
+    space = tonumber(space)
+    local args = {...}
+    if #args % 5 ~= 0 then
+        error('Each task must have delay, ttl, ttr, pri and data')
     end
 
-    local task = box.select( space, idx_data, tube, check_status, data )
-    if task ~= nil then
-	return rettask( task )
+    local tasks = {}
+    for i = 1, #args, 5 do
+        queue.stat[space][tube]:inc('put')
+        table.insert(tasks, put_task(space, tube, queue.default.ipri, unpack(args, i, i + 4)))
     end
-    queue.stat[space][tube]:inc('put')
-    return put_task(space, tube, queue.default.ipri, delay, ttl, ttr, pri, data, ...)
+    return unpack(tasks)
 end
 
 -- queue.urgent(space, tube, delay, ttl, ttr, pri, ...)
@@ -743,8 +792,53 @@ queue.urgent = function(space, tube, delayed, ...)
     return put_task(space, tube, ipri, delayed, ...)
 end
 
+-- takes the first ready task of the tube, returns nil if there is none
+local function take_ready(space, tube)
+    local iterator = box.space[space].index[idx_tube]
+                            :iterator(box.index.EQ, tube, ST_READY)
+
+    for task in iterator do
+        local now = box.time64()
+        local created = box.unpack('l', task[i_created])
+        local ttr = box.unpack('l', task[i_ttr])
+        local ttl = box.unpack('l', task[i_ttl])
+        local event = now + ttr
+        if event > created + ttl then
+            event = created + ttl
+            -- tube started too late
+            if event <= now then
+                return
+            end
+        end
+
+
+        task = box.update(space,
+            task[i_uuid],
+                '=p=p=p+p',
+                i_status,
+                ST_TAKEN,
+
+                i_event,
+                event,
+
+                i_cid,
+                box.session.id(),
+
+                i_ctaken,
+                1
+        )
+
+        queue.workers[space][tube].ch:put(true, 0)
+        queue.consumers[space][tube]:put(true, 0)
+        queue.stat[space][tube]:inc('take')
+        return rettask_pri(task)
+    end
+end
+
+
 -- queue.take(space, tube, timeout)
 -- take task for processing
+--  returns task tuple with the task priority as the last field
 queue.take = function(space, tube, timeout)
 
     space = tonumber(space)
@@ -762,44 +856,9 @@ queue.take = function(space, tube, timeout)
 
     while true do
 
-        local iterator = box.space[space].index[idx_tube]
-                                :iterator(box.index.EQ, tube, ST_READY)
-
-        for task in iterator do
-            local now = box.time64()
-            local created = box.unpack('l', task[i_created])
-            local ttr = box.unpack('l', task[i_ttr])
-            local ttl = box.unpack('l', task[i_ttl])
-            local event = now + ttr
-            if event > created + ttl then
-                event = created + ttl
-                -- tube started too late
-                if event <= now then
-                    break
-                end
-            end
-
-
-            task = box.update(space,
-                task[i_uuid],
-                    '=p=p=p+p',
-                    i_status,
-                    ST_TAKEN,
-
-                    i_event,
-                    event,
-
-                    i_cid,
-                    box.session.id(),
-
-                    i_ctaken,
-                    1
-            )
-
-            queue.workers[space][tube].ch:put(true, 0)
-            queue.consumers[space][tube]:put(true, 0)
-            queue.stat[space][tube]:inc('take')
-            return rettask(task)
+        local task = take_ready(space, tube)
+        if task ~= nil then
+            return task
         end
 
         if timeout > 0 then
@@ -817,6 +876,32 @@ queue.take = function(space, tube, timeout)
 end
 
 
+-- queue.take_many(space, tube, count, timeout)
+-- take up to count tasks for processing
+--  waits for the first task as queue.take does, the rest are taken
+--  only if they are ready; returns tuples in the queue.take form
+queue.take_many = function(space, tube, count, timeout)
+
+    space = tonumber(space)
+    count = tonumber(count)
+
+    if count < 1 then
+        return
+    end
+
+    local tasks = {}
+    local task = queue.take(space, tube, timeout)
+    while task ~= nil do
+        table.insert(tasks, task)
+        if #tasks >= count then
+            break
+        end
+        task = take_ready(space, tube)
+    end
+    return unpack(tasks)
+end
+
+
 -- queue.delete(space, id)
 --  deletes task from queue
 queue.delete = function(space, id)
@@ -853,6 +938,29 @@ queue.ack = function(space, id)
 end
 
 
+-- applies action to each task id, returns tuples of the tasks
+-- the action succeeded for; the other ids are skipped
+local function each_task(action, space, ...)
+    local tasks = {}
+    for i, id in ipairs({...}) do
+        local ok, task = pcall(action, space, id)
+        if ok then
+            table.insert(tasks, task)
+        else
+            print("queue: ", task)
+        end
+    end
+    return unpack(tasks)
+end
+
+
+-- queue.ack_many(space, id, ...)
+--  ack several tasks in one call, returns tuples of the acked tasks
+queue.ack_many = function(space, ...)
+    return each_task(queue.ack, space, ...)
+end
+
+
 -- queue.touch(space, id)
 --  prolong ttr for taken task
 queue.touch = function(space, id)
@@ -958,6 +1066,13 @@ queue.bury = function(space, id)
     return rettask(task)
 end
 
+-- queue.bury_many(space, id, ...)
+--  bury several tasks in one call, returns tuples of the buried tasks
+queue.bury_many = function(space, ...)
+    return each_task(queue.bury, space, ...)
+end
+
+
 -- queue.dig(space, id)
 --  dig(unbury) task
 queue.dig = function(space, id)
@@ -1122,6 +1237,17 @@ queue.release = function(space, id, delay, ttl)
 end
 
 
+-- queue.release_many(space, delay, id, ...)
+--  release several tasks with the same delay in one call,
+--  returns tuples of the released tasks
+queue.release_many = function(space, delay, ...)
+    local release = function(space, id)
+        return queue.release(space, id, delay)
+    end
+    return each_task(release, space, ...)
+end
+
+
 -- queue.requeue(space, id)
 --  marks task as ready and push it at end of queue
 queue.requeue = function(space, id)
@@ -12,6 +12,19 @@ from tests.test_redirect_checker import RedirectCheckerTestCase
 from tests.test_worker import WorkerTestCase
 from tests.test_utils import UtilsTestCase
 from tests.test_init import InitTestCase
+from tests.test_multi import MultiTestCase
+from tests.test_cache import CacheTestCase
+from tests.test_http_session import HttpSessionTestCase
+from tests.test_host_limiter import HostLimiterTestCase
+from tests.test_circuit_breaker import CircuitBreakerTestCase
+from tests.test_serializer import SerializerTestCase
+from tests.test_metrics import MetricsTestCase
+from tests.test_timing import TimingTestCase
+from tests.test_green import GreenTestCase
+from tests.test_health import HealthTestCase
+from tests.test_prepare_url import PrepareUrlTestCase
+from tests.test_domain_rules import DomainRulesTestCase
+from tests.test_retry import RetryTestCase
 
 
 if __name__ == '__main__':
@@ -21,6 +34,19 @@ if __name__ == '__main__':
         unittest.makeSuite(WorkerTestCase),
         unittest.makeSuite(UtilsTestCase),
         unittest.makeSuite(InitTestCase),
+        unittest.makeSuite(MultiTestCase),
+        unittest.makeSuite(CacheTestCase),
+        unittest.makeSuite(HttpSessionTestCase),
+        unittest.makeSuite(HostLimiterTestCase),
+        unittest.makeSuite(CircuitBreakerTestCase),
+        unittest.makeSuite(SerializerTestCase),
+        unittest.makeSuite(MetricsTestCase),
+        unittest.makeSuite(TimingTestCase),
+        unittest.makeSuite(GreenTestCase),
+        unittest.makeSuite(HealthTestCase),
+        unittest.makeSuite(PrepareUrlTestCase),
+        unittest.makeSuite(DomainRulesTestCase),
+        unittest.makeSuite(RetryTestCase),
     ))
     result = unittest.TextTestRunner().run(suite)
     sys.exit(not result.wasSuccessful())
@@ -0,0 +1,66 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Сравнение get_counters с прежней реализацией на регулярных выражениях.
+
+Запуск: ./source/benchmarks/bench_counters.py
+"""
+import os
+import re
+import sys
+import timeit
+
+source_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, source_dir)
+
+from lib import get_counters
+from benchmarks.bench_meta import make_page
+
+REGEX_COUNTER_TYPES = (
+    ('GOOGLE_ANALYTICS', re.compile(r'.*google-analytics\.com/ga\.js.*', re.I+re.S)),
+    ('YA_METRICA', re.compile(r'.*mc\.yandex\.ru/metrika/watch\.js.*', re.I+re.S)),
+    ('TOP_MAIL_RU', re.compile(r'.*top-fwz1\.mail\.ru/counter.*', re.I+re.S)),
+    ('TOP_MAIL_RU', re.compile(r'.*top\.mail\.ru/jump\?from.*', re.I+re.S)),
+    ('DOUBLECLICK', re.compile(r'.*//googleads\.g\.doubleclick\.net/pagead/viewthroughconversion.*', re.I+re.S)),
+    ('VISUALDNA', re.compile(r'.*//a1\.vdna-assets\.com/analytics\.js.*', re.I+re.S)),
+    ('LI_RU', re.compile(r'.*/counter\.yadro\.ru/hit.*', re.I+re.S)),
+    ('RAMBLER_TOP100', re.compile(r'.*counter\.rambler\.ru/top100.*', re.I+re.S))
+)
+
+COUNTER_SCRIPTS = (
+    '<script src="//mc.yandex.ru/metrika/watch.js"></script>'
+    '<script src="http://www.Google-Analytics.com/ga.js"></script>'
+    '<img src="//top-fwz1.mail.ru/counter?id=1">'
+)
+
+
+def regex_get_counters(content):
+    """
+    Прежняя реализация get_counters: отдельное регулярное выражение на каждый счетчик
+    """
+    counters = []
+    for counter_name, regexp in REGEX_COUNTER_TYPES:
+        if re.match(regexp, content):
+            counters.append(counter_name)
+    return counters
+
+
+def bench(name, content):
+    number = max(1, 2 * 1024 * 1024 / len(content))
+    old = timeit.timeit(lambda: regex_get_counters(content), number=number) / number
+    new = timeit.timeit(lambda: get_counters(content), number=number) / number
+    print '{:<28} {:>10.2f} {:>10.2f} {:>10.1f} {:>8.1f}x'.format(
+        name, old * 1e3, new * 1e3, len(content) / new / 1024 / 1024, old / new
+    )
+
+
+def main():
+    print '{:<28} {:>10} {:>10} {:>10} {:>9}'.format('page', 'regex, ms', 'new, ms', 'new, MB/s', 'speedup')
+    for size in (10 * 1024, 100 * 1024, 1024 * 1024, 5 * 1024 * 1024):
+        page = make_page(size, meta=False)
+        bench('{}KB no counters'.format(size / 1024), page)
+        bench('{}KB counters at end'.format(size / 1024), page + COUNTER_SCRIPTS)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Стоимость обращений к кэшу переходов через процесс CacheManager
+в сравнении с прежними вызовами get/set на каждый переход цепочки.
+
+Каждый вызов метода прокси - синхронный запрос к процессу менеджера,
+поэтому время цепочки определяется количеством вызовов.
+
+Запуск: ./source/benchmarks/bench_hop_cache.py
+"""
+import os
+import sys
+import timeit
+
+source_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, source_dir)
+
+from lib.cache import start_cache_manager
+
+MAX_REDIRECTS = 30
+
+
+def chain(name, length):
+    urls = ['http://{}.ru/{}'.format(name, i) for i in xrange(length + 1)]
+    return [(urls[i], (urls[i + 1], 'http_status')) for i in xrange(length)]
+
+
+def old_cached_walk(hop_cache, hops):
+    # get for every known hop and a miss on the final url
+    url = hops[0][0]
+    while True:
+        hop = hop_cache.get(url)
+        if hop is None:
+            return
+        url = hop[0]
+
+
+def new_cached_walk(hop_cache, hops):
+    hop_cache.follow(hops[0][0], MAX_REDIRECTS)
+
+
+def old_fetched_walk(hop_cache, hops):
+    # a miss before every request and a set after it
+    for url, hop in hops:
+        hop_cache.get(url)
+        hop_cache.set(url, hop)
+    hop_cache.get(hops[-1][1][0])
+
+
+def new_fetched_walk(hop_cache, hops):
+    hop_cache.follow(hops[0][0], MAX_REDIRECTS)
+    for index, (url, hop) in enumerate(hops):
+        hop_cache.remember(url, hop, MAX_REDIRECTS - index)
+
+
+def bench(name, old, new, hop_cache, chains, number):
+    # fetched chains must not be cached by the previous run, so every run gets its own chain
+    old_chains, new_chains = iter(chains('old')), iter(chains('new'))
+    old_time = timeit.timeit(lambda: old(hop_cache, next(old_chains)), number=number) / number
+    new_time = timeit.timeit(lambda: new(hop_cache, next(new_chains)), number=number) / number
+    print '{:<28} {:>10.1f} {:>10.1f} {:>8.1f}x'.format(name, old_time * 1e6, new_time * 1e6, old_time / new_time)
+
+
+def main():
+    manager = start_cache_manager()
+    try:
+        hop_cache = manager.HopCache(10000, 600)
+        number = 2000
+        start = timeit.default_timer()
+        for _ in xrange(number):
+            hop_cache.get('http://missing.ru/')
+        print 'round trip to the manager: {:.1f} us'.format((timeit.default_timer() - start) / number * 1e6)
+        print '{:<28} {:>10} {:>10} {:>9}'.format('chain', 'old, us', 'new, us', 'speedup')
+        for length in (1, 3, 10):
+            hops = chain('cached{}'.format(length), length)
+            for url, hop in hops:
+                hop_cache.set(url, hop)
+            bench('{} cached hops'.format(length), old_cached_walk, new_cached_walk, hop_cache,
+                  lambda prefix: [hops] * number, number)
+        for length in (1, 3, 10):
+            bench('{} fetched hops'.format(length), old_fetched_walk, new_fetched_walk, hop_cache,
+                  lambda prefix: [chain('{}{}-{}'.format(prefix, length, i), length) for i in xrange(number)],
+                  number)
+    finally:
+        manager.shutdown()
+
+
+if __name__ == '__main__':
+    main()
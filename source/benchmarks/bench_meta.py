@@ -0,0 +1,82 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Сравнение check_for_meta с прежней реализацией на BeautifulSoup.
+
+Запуск: ./source/benchmarks/bench_meta.py
+"""
+import os
+import re
+import sys
+import timeit
+from urlparse import urljoin
+
+source_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, source_dir)
+
+from bs4 import BeautifulSoup
+
+from lib import check_for_meta, to_unicode
+from tests.fixtures import read_fixtures
+
+URL = 'http://example.com/start'
+
+
+def soup_check_for_meta(content, url):
+    """
+    Прежняя реализация check_for_meta, строящая полное дерево документа
+    """
+    soup = BeautifulSoup(content, "html.parser")
+    result = soup.find("meta")
+    if result and 'content' in result.attrs:
+        for attr, value in result.attrs.items():
+            if attr == 'http-equiv' and value.lower() == 'refresh':
+                splitted = result['content'].split(";")
+                if len(splitted) != 2:
+                    return
+                wait, text = splitted
+                text = text.strip()
+                m = re.search(r"url\s*=\s*['\"]?([^'\"]+)", text, re.I)
+                if m:
+                    meta_url = m.groups()[0]
+                    return urljoin(url, to_unicode(meta_url, 'ignore'))
+
+
+def make_page(body_size, meta=True):
+    """Страница с типичной секцией <head> и телом заданного размера"""
+    head = [
+        '<!DOCTYPE html><html><head>',
+        '<meta http-equiv="refresh" content="0; url=/next">' if meta else '',
+        '<meta name="viewport" content="width=device-width">',
+        '<title>Landing</title>',
+    ]
+    head.extend('<link rel="stylesheet" href="/static/{}.css">'.format(i) for i in xrange(20))
+    head.append('<script>var config = {"a": 1, "b": [1, 2, 3]};</script></head>')
+    row = '<div class="item"><a href="/item/{0}">Item {0}</a><p>Description</p></div>\n'
+    body = []
+    size = 0
+    while size < body_size:
+        body.append(row.format(len(body)))
+        size += len(body[-1])
+    return ''.join(head) + '<body>' + ''.join(body) + '</body></html>'
+
+
+def bench(name, content, number):
+    old = timeit.timeit(lambda: soup_check_for_meta(content, URL), number=number)
+    new = timeit.timeit(lambda: check_for_meta(content, URL), number=number)
+    print '{:<32} {:>10.1f} {:>10.1f} {:>8.1f}x'.format(
+        name, old / number * 1e6, new / number * 1e6, old / new
+    )
+
+
+def main():
+    print '{:<32} {:>10} {:>10} {:>9}'.format('page', 'soup, us', 'new, us', 'speedup')
+    for name, content in read_fixtures('meta'):
+        bench(name, content, 2000)
+    for size in (10 * 1024, 100 * 1024, 1024 * 1024):
+        bench('generated {}KB meta'.format(size / 1024), make_page(size), 20)
+        bench('generated {}KB no meta'.format(size / 1024), make_page(size, meta=False), 20)
+
+
+if __name__ == '__main__':
+    main()
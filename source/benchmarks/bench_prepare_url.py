@@ -0,0 +1,61 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Сравнение prepare_url с прежней реализацией без запоминания на корпусе урлов
+из tests/fixtures/urls.
+
+Запуск: ./source/benchmarks/bench_prepare_url.py
+"""
+import os
+import sys
+import timeit
+
+source_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, source_dir)
+
+from lib import prepare_url
+from tests.test_prepare_url import original_prepare_url, read_corpus
+
+
+def run(func, urls):
+    for url in urls:
+        try:
+            func(url)
+        except (UnicodeError, ValueError):
+            pass
+
+
+def run_cold(urls):
+    # every url is normalized again, only the ascii fast path helps
+    for url in urls:
+        prepare_url.clear()
+        try:
+            prepare_url(url)
+        except (UnicodeError, ValueError):
+            pass
+
+
+def bench(name, urls, number):
+    old = timeit.timeit(lambda: run(original_prepare_url, urls), number=number)
+    cold = timeit.timeit(lambda: run_cold(urls), number=number)
+    prepare_url.clear()
+    warm = timeit.timeit(lambda: run(prepare_url, urls), number=number)
+    count = float(number * len(urls))
+    print '{:<24} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.1f}x'.format(
+        name, old / count * 1e6, cold / count * 1e6, warm / count * 1e6, old / warm
+    )
+
+
+def main():
+    corpus = read_corpus()
+    ascii_urls = [url for url in corpus if all(ord(char) < 128 for char in url)]
+    print '{:<24} {:>8} {:>8} {:>8} {:>9}'.format('urls', 'old, us', 'cold, us', 'warm, us', 'speedup')
+    bench('corpus', corpus, 500)
+    bench('corpus ascii', ascii_urls, 500)
+    bench('corpus utf-8 str', [url.encode('utf8') for url in corpus], 500)
+    # a redirect chain normalizes each hop url three times
+    bench('chain hops', [url for url in corpus for _ in xrange(3)], 200)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python2.7
+# coding: utf-8
+"""
+Сравнение сериализации уведомлений pusher'а с прежней реализацией
+(копия данных задачи + json.dumps) для каждой установленной библиотеки JSON.
+
+Запуск: ./source/benchmarks/bench_serializer.py
+"""
+import json
+import os
+import sys
+import timeit
+
+source_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, source_dir)
+
+from lib.serializer import JSON_BACKENDS, dumps_without, get_json_backend
+
+TASK_ID = 123456
+
+
+def copy_dumps(data):
+    """
+    Прежняя реализация из notification_worker
+    """
+    data = data.copy()
+    url = data.pop('callback_url')
+    data['id'] = TASK_ID
+    return url, json.dumps(data)
+
+
+def make_task_data(size):
+    """Данные задачи с сериализованным размером около size байт"""
+    data = {
+        'callback_url': 'https://partner.example.com/api/v1/notifications/callback',
+        'user_id': 42,
+        'event': 'payment.completed',
+    }
+    i = 0
+    while len(json.dumps(data)) < size:
+        data['field_{}'.format(i)] = {'amount': i * 10, 'currency': 'RUB', 'comment': u'Оплата заказа'}
+        i += 1
+    return data
+
+
+def get_backends():
+    backends = []
+    for name in JSON_BACKENDS:
+        try:
+            backends.append(get_json_backend(name))
+        except ImportError:
+            pass
+    return backends
+
+
+def main():
+    backends = get_backends()
+    print '{:<10} {:>12}'.format('size', 'copy+json') + ''.join(' {:>12}'.format(name) for name, _ in backends)
+    for size in (100, 1024, 10 * 1024, 100 * 1024, 1024 * 1024):
+        data = make_task_data(size)
+        number = max(5, 20 * 1024 * 1024 / size)
+        results = [timeit.timeit(lambda: copy_dumps(data), number=number) / number]
+        for name, dumps in backends:
+            results.append(timeit.timeit(
+                lambda: dumps_without(data, 'callback_url', 'id', TASK_ID, dumps), number=number
+            ) / number)
+        print '{:<10} '.format('{}B'.format(size)) + ' '.join('{:>10.1f}us'.format(t * 1e6) for t in results)
+
+
+if __name__ == '__main__':
+    main()
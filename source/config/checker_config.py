@@ -13,17 +13,106 @@ OUTPUT_QUEUE_SPACE = 0
 OUTPUT_QUEUE_TUBE = 'url_redirect.queue'
 
 WORKER_POOL_SIZE = 10
+# a worker exits after taking MAX_TASKS_PER_CHILD tasks and is respawned at once, 0 disables it
+MAX_TASKS_PER_CHILD = 10000
+# a worker that exits within RESPAWN_MIN_LIFETIME seconds is respawned after RESPAWN_DELAY seconds,
+# doubled with every such exit in a row up to RESPAWN_MAX_DELAY
+RESPAWN_MIN_LIFETIME = 5
+RESPAWN_DELAY = 1
+RESPAWN_MAX_DELAY = 60
 QUEUE_TAKE_TIMEOUT = 0.1
 
+# 'simple' - one task at a time, 'multi' - up to MULTI_CONCURRENCY tasks via pycurl.CurlMulti,
+# 'green' - up to GREEN_CONCURRENCY tasks in gevent greenlets, new tasks are taken after any task
+# is done or every GREEN_TAKE_INTERVAL seconds; each of WORKER_POOL_SIZE processes runs its own engine
+WORKER_ENGINE = 'simple'
+MULTI_CONCURRENCY = 50
+MULTI_TAKE_TIMEOUT = 0.001
+GREEN_CONCURRENCY = 200
+GREEN_TAKE_INTERVAL = 0.05
+# reused curl handles kept per worker process, should be >= MULTI_CONCURRENCY or GREEN_CONCURRENCY
+CURL_POOL_SIZE = 50
+
+# redirect hops cache shared by all workers, 0 disables it; it lives in the manager process,
+# so every lookup is a round trip of ~20 us (see benchmarks/bench_hop_cache.py)
+HOP_CACHE_SIZE = 10000
+HOP_CACHE_TTL = 600
+
+# results of the urls checked in the last RESULT_CACHE_TTL seconds are shared by all workers and
+# written to every task with the same normalized url; a url being checked is checked once, other tasks
+# poll for its result every RESULT_CACHE_POLL_INTERVAL seconds, or check it themselves if the checking
+# worker doesn't finish in RESULT_CACHE_CLAIM_TTL seconds; 0 disables it
+RESULT_CACHE_SIZE = 10000
+RESULT_CACHE_TTL = 300
+RESULT_CACHE_CLAIM_TTL = 60
+RESULT_CACHE_POLL_INTERVAL = 0.1
+
+# task results are put and acked in batches of up to RESULT_BATCH_SIZE,
+# a result waits no longer than RESULT_FLUSH_INTERVAL seconds
+RESULT_BATCH_SIZE = 20
+RESULT_FLUSH_INTERVAL = 1
+
+# Prometheus metrics of all workers are served on http://METRICS_HOST:METRICS_PORT/metrics,
+# None disables them; workers send their metrics to the parent every METRICS_PUSH_INTERVAL seconds
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None
+METRICS_PUSH_INTERVAL = 1
+
+# per-task timings (curl getinfo times of every hop, meta and counters parsing, queue take) are sent
+# to TIMING_SINK: 'log', 'metrics', a 'package.module.function' path or None to skip measuring;
+# every PROFILE_EVERY-th task ('multi' engine: event loop turn) is profiled by cProfile into PROFILE_DIR,
+# the 'green' engine is not profiled: cProfile does not follow greenlet switches
+TIMING_SINK = None
+PROFILE_EVERY = 0
+PROFILE_DIR = '/tmp/redirect_checker_profiles'
+
 SLEEP = 10
+# stopped workers (SIGTERM or SIGINT) release or finish their tasks and are killed if still alive
+# after DRAIN_TIMEOUT seconds; SIGUSR1/SIGUSR2 to the parent pause/resume task taking
+DRAIN_TIMEOUT = 10
 
 HTTP_TIMEOUT = 3
 MAX_REDIRECTS = 30
 RECHECK_DELAY = 300
+# a check failed with an error of a kind ('dns', 'timeout', 'refused', 'tls' or 'other') is retried up to
+# 'attempts' times from the url that failed; the n-th retry is delayed by 'delay' * 2 ** (n - 1) seconds,
+# at most RETRY_MAX_DELAY, minus a random share of up to RETRY_JITTER so failed tasks don't come back at once
+RETRY_POLICY = {
+    'dns': {'attempts': 2, 'delay': RECHECK_DELAY},
+    'timeout': {'attempts': 3, 'delay': 60},
+    'refused': {'attempts': 3, 'delay': 60},
+    'tls': {'attempts': 1, 'delay': RECHECK_DELAY},
+    'other': {'attempts': 1, 'delay': RECHECK_DELAY},
+}
+RETRY_MAX_DELAY = 3600
+RETRY_JITTER = 0.5
+# page content is downloaded up to this size, only the beginning is checked for counters
+MAX_BODY_BYTES = 512 * 1024
 USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/31.0.1650.63 Safari/537.36"
 
 CHECK_URL = "http://t.mail.ru"
 
+# per-domain rules (see lib.domain_rules.DomainRules): 'skip' - the task url is not checked,
+# 'stop' - the redirect url is recorded but not requested, 'ignore' - a redirect to the url is not followed;
+# 'host': 'a.ru' is the host itself, '.a.ru' - the host and its subdomains; optional 'path' prefix and
+# 'contains' substring of the rest of the url; lookups are hashed by host, so the table may be large
+DOMAIN_RULES = (
+    {'type': 'skip', 'host': 'odnoklassniki.ru'},
+    {'type': 'skip', 'host': 'www.odnoklassniki.ru'},
+    {'type': 'skip', 'host': 'my.mail.ru', 'path': '/apps/'},
+    {'type': 'ignore', 'host': 'odnoklassniki.ru', 'contains': 'st.redirect'},
+    {'type': 'ignore', 'host': 'www.odnoklassniki.ru', 'contains': 'st.redirect'},
+)
+# every HEALTH_INTERVAL seconds all HEALTH_PROBE_URLS are requested at once in the background, a probe round
+# succeeds if at least HEALTH_QUORUM of them respond in HTTP_TIMEOUT; workers are paused when less than
+# HEALTH_DOWN_RATIO of the last HEALTH_WINDOW rounds succeeded and resumed when at least HEALTH_UP_RATIO did
+HEALTH_PROBE_URLS = (CHECK_URL, "http://mail.ru")
+HEALTH_QUORUM = 1
+HEALTH_INTERVAL = 2
+HEALTH_WINDOW = 10
+HEALTH_DOWN_RATIO = 0.5
+HEALTH_UP_RATIO = 0.8
+
 LOGGING = {
     'version': 1,
     'formatters': {
@@ -8,11 +8,48 @@ QUEUE_TAKE_TIMEOUT = 0.1
 QUEUE_TUBE = 'api.push_notifications'
 
 HTTP_CONNECTION_TIMEOUT = 30
+# 'ujson', 'simplejson' or 'json'; None picks the first one installed in this order
+JSON_BACKEND = None
+# the main loop waits for a free worker at most SLEEP seconds before checking for shutdown
 SLEEP = 0.1
 SLEEP_ON_FAIL = 10
 
 WORKER_POOL_SIZE = 10
 
+# callbacks keep up to WORKER_POOL_SIZE connections per host alive, for up to HTTP_POOL_HOSTS hosts;
+# HTTP_HOST_POOL_SIZE overrides it for particular hosts, e.g. {'api.partner.ru': 50}
+HTTP_POOL_HOSTS = 100
+HTTP_HOST_POOL_SIZE = {}
+HTTP_POOL_STATS_INTERVAL = 60
+
+# concurrent callbacks per host: up to HOST_MAX_CONCURRENCY, halved after an error or a response
+# slower than HOST_LATENCY_THRESHOLD seconds and grown back by successes;
+# tasks for a host at its limit wait in the pusher for a free slot, up to HOST_MAX_PENDING tasks per host
+# and up to HOST_PENDING_TIMEOUT seconds (keep it below the tube ttr, 60 s by default), the rest
+# are returned to the tube for HOST_BUSY_RELEASE_DELAY seconds
+HOST_MAX_CONCURRENCY = 5
+HOST_LATENCY_THRESHOLD = 5
+HOST_MAX_PENDING = 50
+HOST_PENDING_TIMEOUT = 30
+HOST_BUSY_RELEASE_DELAY = 1
+
+# after CIRCUIT_FAILURE_THRESHOLD failed callbacks in a row a host gets no requests until a probe;
+# failed tasks are returned to the tube with a delay doubling from CIRCUIT_BASE_DELAY up to CIRCUIT_MAX_DELAY
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_BASE_DELAY = 10
+CIRCUIT_MAX_DELAY = 600
+
+# a task is buried after MAX_TASK_FAILURES failed callbacks (tasks with a malformed callback_url at once);
+# failures are counted by this pusher for up to TASK_FAILURES_CACHE_SIZE tasks, each for TASK_FAILURES_TTL
+# seconds since its last failure, so a restart or an evicted count only gives a task more attempts
+MAX_TASK_FAILURES = 10
+TASK_FAILURES_CACHE_SIZE = 100000
+TASK_FAILURES_TTL = 24 * 3600
+
+# Prometheus metrics are served on http://METRICS_HOST:METRICS_PORT/metrics, None disables them
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = None
+
 LOGGING = {
     'version': 1,
     'formatters': {
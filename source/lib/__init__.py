@@ -1,33 +1,50 @@
 # coding: utf-8
-from StringIO import StringIO
+from codecs import getincrementaldecoder, register_error
+from HTMLParser import HTMLParseError, HTMLParser
 from logging import getLogger, NullHandler
+import os
 import re
 from urllib import quote, quote_plus
 from urlparse import urljoin, urlsplit, urlparse, urlunparse
 
-from bs4 import BeautifulSoup
 import pycurl
 
+from .cache import memoize
+from .domain_rules import IGNORE_REDIRECT, SKIP_TASK, STOP_CHAIN, DomainRules
+from .retry import classify_error
+
 logger = getLogger('redirect_checker')
 logger.addHandler(NullHandler())
 
 REDIRECT_META = 'meta_tag'
 REDIRECT_HTTP = 'http_status'
 
-OK_REDIRECT = re.compile(r'http://(www\.)?odnoklassniki\.ru/.*st\.redirect', re.I)
-OK_URL = re.compile(r'http(?:s)?://(www\.)?odnoklassniki\.ru/', re.I)
-MM_URL = re.compile(r'http(?:s)?://my\.mail\.ru/apps/', re.I)
+CURL_POOL_SIZE = 10
+MAX_BODY_BYTES = 512 * 1024
+PREPARED_URLS_CACHE_SIZE = 10000
+META_FEED_CHUNK = 4096
+
+# only a hint for ResponseBuffer: where <head> really ends (not in a script or a comment) MetaParser decides
+HEAD_END = re.compile(r'</head[\s>]|<body[\s/>]', re.I)
+META_TAG = re.compile(r'<meta[\s/>]', re.I)
+META_URL = re.compile(r"url\s*=\s*['\"]?([^'\"]+)", re.I)
+
+ASCII_TEXT = re.compile(r'[\x00-\x7f]*\Z')
+QUOTED_PATH = re.compile(r"[A-Za-z0-9_.\-/%+$!*'(),]*\Z")
+QUOTED_PARAMS = re.compile(r"[A-Za-z0-9_.\-:&%=+$!*'(),]*\Z")
+"""Части урла, которые quote и quote_plus в prepare_url оставили бы без изменений"""
 
 COUNTER_TYPES = (
-    ('GOOGLE_ANALYTICS', re.compile(r'.*google-analytics\.com/ga\.js.*', re.I+re.S)),
-    ('YA_METRICA', re.compile(r'.*mc\.yandex\.ru/metrika/watch\.js.*', re.I+re.S)),
-    ('TOP_MAIL_RU', re.compile(r'.*top-fwz1\.mail\.ru/counter.*', re.I+re.S)),
-    ('TOP_MAIL_RU', re.compile(r'.*top\.mail\.ru/jump\?from.*', re.I+re.S)),
-    ('DOUBLECLICK', re.compile(r'.*//googleads\.g\.doubleclick\.net/pagead/viewthroughconversion.*', re.I+re.S)),
-    ('VISUALDNA', re.compile(r'.*//a1\.vdna-assets\.com/analytics\.js.*', re.I+re.S)),
-    ('LI_RU', re.compile(r'.*/counter\.yadro\.ru/hit.*', re.I+re.S)),
-    ('RAMBLER_TOP100', re.compile(r'.*counter\.rambler\.ru/top100.*', re.I+re.S))
+    ('GOOGLE_ANALYTICS', 'google-analytics.com/ga.js'),
+    ('YA_METRICA', 'mc.yandex.ru/metrika/watch.js'),
+    ('TOP_MAIL_RU', 'top-fwz1.mail.ru/counter'),
+    ('TOP_MAIL_RU', 'top.mail.ru/jump?from'),
+    ('DOUBLECLICK', '//googleads.g.doubleclick.net/pagead/viewthroughconversion'),
+    ('VISUALDNA', '//a1.vdna-assets.com/analytics.js'),
+    ('LI_RU', '/counter.yadro.ru/hit'),
+    ('RAMBLER_TOP100', 'counter.rambler.ru/top100'),
 )
+"""Типы счетчиков и подстроки (в нижнем регистре), по которым счетчик находится в странице"""
 
 
 def break_func_for_test():
@@ -45,29 +62,102 @@ def to_str(val, errors='strict'):
 def get_counters(content):
     """
     Ищет в хтмл-странице счетичик и возвращает массив типов найденных
+
+    Страница один раз приводится к нижнему регистру, после чего подстроки
+    счетчиков ищутся без регулярных выражений.
     """
+    content = content.lower()
     counters = []
-    for counter_name, regexp in COUNTER_TYPES:
-        if re.match(regexp, content):
+    for counter_name, signature in COUNTER_TYPES:
+        if signature in content:
             counters.append(counter_name)
     return counters
 
 
+def decode_as_latin1(error):
+    """
+    Обработчик ошибок декодирования: недопустимые в utf-8 байты читаются как latin-1
+    """
+    return error.object[error.start:error.end].decode('latin-1'), error.end
+
+register_error('latin1_fallback', decode_as_latin1)
+
+
+class StopParsing(Exception):
+    pass
+
+
+class CheckStopped(Exception):
+    """Проверка цепочки прервана между переходами: обработчик останавливается"""
+    pass
+
+
+class MetaParser(HTMLParser):
+    """
+    Ищет первый тег <meta> в хтмл-странице.
+
+    Разбор останавливается на первом теге <meta>, на </head> или на <body>.
+    """
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.attrs = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            # the same attributes as BeautifulSoup builds with "html.parser"
+            self.attrs = dict((attr, '' if value is None else value) for attr, value in attrs)
+            raise StopParsing
+        if tag == 'body':
+            raise StopParsing
+
+    def handle_endtag(self, tag):
+        if tag == 'head':
+            raise StopParsing
+
+
+def find_first_meta(content):
+    """
+    Возвращает атрибуты первого тега <meta> из секции <head> хтмл-страницы
+
+    Конец <head> определяет MetaParser, поэтому </head> и <body> в скриптах,
+    комментариях и атрибутах его не обманывают. Страница декодируется
+    и отдается парсеру кусками по META_FEED_CHUNK байт, пока он не остановится.
+
+    Кодировка берется utf-8, а байты, недопустимые в ней, читаются как latin-1:
+    объявить другую кодировку страница может только тегом <meta>, а дальше
+    первого <meta> разбор не идет.
+    """
+    if not META_TAG.search(content):
+        return
+
+    content = to_str(content, 'ignore')
+    decoder = getincrementaldecoder('utf8')('latin1_fallback')
+    parser = MetaParser()
+    try:
+        for start in xrange(0, len(content), META_FEED_CHUNK):
+            parser.feed(decoder.decode(content[start:start + META_FEED_CHUNK]))
+        parser.feed(decoder.decode('', final=True))
+        parser.close()
+    except (StopParsing, HTMLParseError):
+        pass
+    return parser.attrs
+
+
 def check_for_meta(content, url):
     """
     Ищет в хтмл-странице мета-редирект теги и возраещет урл редиректа
     """
-    soup = BeautifulSoup(content, "html.parser")
-    result = soup.find("meta")
-    if result and 'content' in result.attrs:
-        for attr, value in result.attrs.items():
+    attrs = find_first_meta(content)
+    if attrs and 'content' in attrs:
+        for attr, value in attrs.items():
             if attr == 'http-equiv' and value.lower() == 'refresh':
-                splitted = result['content'].split(";")
+                splitted = attrs['content'].split(";")
                 if len(splitted) != 2:
                     return
                 wait, text = splitted
                 text = text.strip()
-                m = re.search(r"url\s*=\s*['\"]?([^'\"]+)", text, re.I)
+                m = META_URL.search(text)
                 if m:
                     meta_url = m.groups()[0]
                     return urljoin(url, to_unicode(meta_url, 'ignore'))
@@ -78,52 +168,257 @@ def fix_market_url(url):
     return 'http://play.google.com/store/apps/' + url.lstrip("market://")
 
 
-def make_pycurl_request(url, timeout, useragent=None):
-    """Делает http запрос (без перехода по редиректам)
-    Возвращает контент ответа и возможный редирект
-    :return: содержимое ответа, урл редиректа
+class ResponseBuffer(object):
+    """
+    Буфер для содержимого ответа, загружаемого потоково.
+
+    Прерывает загрузку, как только содержимое перестает быть нужным:
+     * ответ является http-редиректом - тело не загружается совсем;
+     * в загруженной секции <head> найден мета-редирект;
+     * загружено max_size байт - остальное содержимое отбрасывается.
+    """
+
+    def __init__(self, url, max_size=MAX_BODY_BYTES):
+        self.url = url
+        self.max_size = max_size
+        self.chunks = []
+        self.size = 0
+        self.status = None
+        self.has_location = False
+        self.head_checked = False
+        self.tail = ''
+        self.aborted = False
+
+    def header(self, line):
+        if line.startswith('HTTP/'):
+            # every response (including 1xx ones) starts with a status line
+            parts = line.split(None, 2)
+            self.status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+            self.has_location = False
+        elif line[:9].lower() == 'location:':
+            self.has_location = True
+
+    def write(self, data):
+        if self.status is not None and 300 <= self.status < 400 and self.has_location:
+            return self.abort()
+
+        room = self.max_size - self.size
+        if len(data) >= room:
+            self.append(data[:room])
+            return self.abort()
+
+        self.append(data)
+        if not self.head_checked:
+            self.check_head(data)
+            if self.aborted:
+                return 0
+
+    def append(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def abort(self):
+        self.aborted = True
+        return 0
+
+    def check_head(self, data):
+        window = self.tail + data
+        if HEAD_END.search(window):
+            self.head_checked = True
+            if check_for_meta(self.getvalue(), self.url):
+                self.aborted = True
+        self.tail = window[-6:]
+
+    def getvalue(self):
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if self.chunks else ''
+
+
+def setup_curl(curl, url, timeout, useragent=None, max_body_bytes=MAX_BODY_BYTES):
+    """Настраивает curl-хендл на запрос урла (без перехода по редиректам)
+    :return: буфер, в который будет записано содержимое ответа
 
     """
     prepared_url = to_str(prepare_url(url), 'ignore')
-    buff = StringIO()
-    curl = pycurl.Curl()
+    buff = ResponseBuffer(url, max_body_bytes)
     curl.setopt(curl.URL, prepared_url)
     if useragent:
         curl.setopt(curl.USERAGENT, useragent)
-    curl.setopt(curl.WRITEDATA, buff)
+    curl.setopt(curl.HEADERFUNCTION, buff.header)
+    curl.setopt(curl.WRITEFUNCTION, buff.write)
     curl.setopt(curl.FOLLOWLOCATION, False)
     # curl.setopt(curl.CONNECTTIMEOUT, timeout)
     curl.setopt(curl.TIMEOUT, timeout)
-    curl.perform()
+    return buff
+
+
+def read_curl_response(curl, buff):
+    """Забирает результат выполненного запроса из curl-хендла
+    :return: содержимое ответа, урл редиректа
+
+    """
     content = buff.getvalue()
     redirect_url = curl.getinfo(curl.REDIRECT_URL)
-    curl.close()
     if redirect_url is not None:
         redirect_url = to_unicode(redirect_url, 'ignore')
     return content, redirect_url
 
 
-def get_url(url, timeout, user_agent=None):
+class CurlPool(object):
     """
-    :return: урл, тип редиректа, содержимое страницы (если есть)
+    Пул переиспользуемых curl-хендлов процесса.
+
+    Хендлы не закрываются после запроса, а сбрасываются и возвращаются в пул,
+    поэтому открытые keep-alive соединения переживают переходы по цепочке
+    и переключения между задачами. Все хендлы пула используют общий CurlShare
+    с кэшем DNS, cookie и SSL-сессиями.
+    """
+
+    def __init__(self, size=CURL_POOL_SIZE):
+        self.size = size
+        self.pid = os.getpid()
+        self.free = []
+        self.share = pycurl.CurlShare()
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_COOKIE)
+        self.share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+
+    def get(self):
+        if self.free:
+            return self.free.pop()
+        curl = pycurl.Curl()
+        # curl_easy_reset keeps the share, so it is set only once per handle
+        curl.setopt(pycurl.SHARE, self.share)
+        return curl
+
+    def put(self, curl):
+        if len(self.free) < self.size:
+            curl.reset()
+            self.free.append(curl)
+        else:
+            curl.close()
+
+    def close(self):
+        for curl in self.free:
+            curl.close()
+        self.free = []
+
+
+curl_pool = None
+
+
+def get_curl_pool(size=None):
+    """
+    Возвращает пул curl-хендлов текущего процесса.
+
+    Пул, унаследованный от родительского процесса при fork, не используется:
+    его соединения разделяются с родителем.
+
+    :param size: максимальное количество свободных хендлов в пуле
+    """
+    global curl_pool
+    if curl_pool is None or curl_pool.pid != os.getpid():
+        curl_pool = CurlPool(size or CURL_POOL_SIZE)
+    elif size:
+        curl_pool.size = size
+    return curl_pool
+
+
+curl_driver = None
+
+
+def set_curl_driver(driver):
+    """
+    Задает, чем выполняются запросы make_pycurl_request в текущем процессе.
+
+    :param driver: объект с методом perform(curl), например lib.green.GreenCurlMulti;
+                   None - запросы выполняются блокирующим curl.perform
+    """
+    global curl_driver
+    curl_driver = driver
+
+
+domain_rules = DomainRules()
+
+
+def set_domain_rules(rules):
+    """
+    Задает правила для доменов (lib.domain_rules.DomainRules), по которым
+    проверяются урлы в текущем процессе и процессах, запущенных после вызова.
+    """
+    global domain_rules
+    domain_rules = rules
+
+
+def make_pycurl_request(url, timeout, useragent=None, max_body_bytes=MAX_BODY_BYTES, timing=None):
+    """Делает http запрос (без перехода по редиректам)
+    Возвращает контент ответа и возможный редирект
+    :param timing: lib.timing.TaskTiming, в который добавляются тайминги запроса
+    :return: содержимое ответа, урл редиректа
+
+    """
+    pool = get_curl_pool()
+    curl = pool.get()
+    try:
+        buff = setup_curl(curl, url, timeout, useragent, max_body_bytes)
+        try:
+            if curl_driver is None:
+                curl.perform()
+            else:
+                curl_driver.perform(curl)
+        except pycurl.error:
+            # the transfer was stopped by the buffer on purpose
+            if not buff.aborted:
+                raise
+        finally:
+            if timing is not None:
+                timing.add_hop(url, curl)
+        return read_curl_response(curl, buff)
+    finally:
+        pool.put(curl)
+
+
+def fetch_url(url, timeout, user_agent=None, max_body_bytes=MAX_BODY_BYTES, timing=None):
+    """
+    То же, что get_url, но возвращает и исключение, с которым завершился запрос
+    :return: (урл, тип редиректа, содержимое страницы), исключение или None
     """
     content = None
     try:
-        content, new_redirect_url = make_pycurl_request(url, timeout, user_agent)
+        content, new_redirect_url = make_pycurl_request(url, timeout, user_agent, max_body_bytes, timing)
     except (pycurl.error, ValueError) as e:
         logger.error(u'error in url {} {}'.format(url, e))
-        return url, 'ERROR', content  # TODO add exception in ERROR
+        return (url, 'ERROR', content), e
+
+    return process_response(url, content, new_redirect_url, timing), None
+
+
+def get_url(url, timeout, user_agent=None, max_body_bytes=MAX_BODY_BYTES, timing=None):
+    """
+    :return: урл, тип редиректа, содержимое страницы (если есть)
+    """
+    return fetch_url(url, timeout, user_agent, max_body_bytes, timing)[0]
+
 
+def process_response(url, content, new_redirect_url, timing=None):
+    """
+    Определяет тип редиректа по ответу на запрос урла
+    :param timing: lib.timing.TaskTiming, в который добавляется время поиска мета-редиректа
+    :return: урл, тип редиректа, содержимое страницы (если есть)
+    """
     redirect_type = None
 
-    # ignoring ok login redirects
-    if new_redirect_url and OK_REDIRECT.match(new_redirect_url):
+    if new_redirect_url and domain_rules.match(new_redirect_url, IGNORE_REDIRECT):
         return None, redirect_type, content
 
     if new_redirect_url:
         redirect_type = REDIRECT_HTTP
     else:
-        new_redirect_url = check_for_meta(content, url)
+        if timing is None:
+            new_redirect_url = check_for_meta(content, url)
+        else:
+            new_redirect_url = timing.call('check_for_meta', check_for_meta, content, url)
         if new_redirect_url:
             redirect_type = REDIRECT_META
 
@@ -133,7 +428,117 @@ def get_url(url, timeout, user_agent=None):
     return prepare_url(new_redirect_url), redirect_type, content
 
 
-def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
+class RedirectHistory(object):
+    """
+    Состояние обхода цепочки редиректов одного урла.
+
+    Хранит найденные редиректы и урл, который нужно запросить следующим.
+    Урлы, подходящие под правила SKIP_TASK (для начального урла) и STOP_CHAIN
+    (для урлов редиректов) из domain_rules, не запрашиваются.
+    Если обход прервался ошибкой, в error остается ее вид (см. lib.retry).
+    """
+
+    def __init__(self, url, max_redirects=30):
+        self.max_redirects = max_redirects
+        self.history_types = []
+        self.history_urls = [url]
+        self.redirect_url = url
+        self.content = None
+        self.error = None
+        self.finished = domain_rules.match(url, SKIP_TASK)
+
+    @classmethod
+    def resumed(cls, history_types, history_urls, max_redirects=30):
+        """
+        Продолжает прерванный обход: урлы history_urls, кроме последнего,
+        уже пройдены, последний запрашивается следующим.
+        """
+        history_urls = [to_unicode(url, 'ignore') for url in history_urls]
+        history = cls(history_urls[0], max_redirects)
+        history.history_types = list(history_types)
+        history.history_urls = history_urls
+        history.redirect_url = history_urls[-1]
+        history.finished = False
+        return history
+
+    def add(self, redirect_url, redirect_type, content, error=None):
+        """
+        Добавляет в историю результат запроса очередного урла цепочки.
+
+        :param error: исключение, с которым завершился запрос (для redirect_type ERROR)
+        :return: True, если обход цепочки нужно продолжать
+        """
+        self.content = content
+        self.redirect_url = redirect_url
+        if not redirect_url:
+            self.finished = True
+            return False
+
+        self.history_types.append(redirect_type)
+        self.history_urls.append(redirect_url)
+
+        if redirect_type == 'ERROR':
+            self.error = classify_error(error)
+            self.finished = True
+        elif len(self.history_urls) > self.max_redirects or (redirect_url in self.history_urls[:-1]):
+            self.finished = True
+        elif domain_rules.match(redirect_url, STOP_CHAIN):
+            # counters are searched on the final url, which is not requested
+            self.content = None
+            self.finished = True
+        return not self.finished
+
+    def hops_left(self):
+        """Сколько переходов можно добавить, прежде чем обход остановится по max_redirects"""
+        return self.max_redirects + 1 - len(self.history_urls)
+
+    def result(self, timing=None):
+        """
+        :param timing: lib.timing.TaskTiming, в который добавляется время поиска счетчиков
+        :return: типы редиректов, урлы редиректов, счетчики на конечном урле
+        """
+        if not self.content:
+            counters = []
+        elif timing is None:
+            counters = get_counters(self.content)
+        else:
+            counters = timing.call('get_counters', get_counters, self.content)
+        return self.history_types, self.history_urls, counters
+
+
+def add_cached_hops(history, hops):
+    for redirect_url, redirect_type in hops:
+        if history.finished:
+            return
+        history.add(redirect_url, redirect_type, None)
+
+
+def follow_cached_hops(history, hop_cache):
+    """
+    Проходит по переходам цепочки, которые уже есть в кэше (lib.cache.HopCache),
+    не запрашивая урлы. Все они получаются одним запросом к кэшу.
+    """
+    if not history.finished:
+        add_cached_hops(history, hop_cache.follow(history.redirect_url, history.hops_left()))
+
+
+def record_hop(history, hop_cache, hop, error=None):
+    """
+    Добавляет в историю результат запроса очередного урла цепочки.
+
+    С кэшем переходов сохраняет в него переход по редиректу (ошибки и конечные
+    страницы не кэшируются) и тем же запросом к кэшу получает известное
+    продолжение цепочки, которое тоже добавляется в историю.
+    """
+    url = history.redirect_url
+    redirect_url, redirect_type, content = hop
+    history.add(redirect_url, redirect_type, content, error)
+    if hop_cache is not None and redirect_url and redirect_type in (REDIRECT_HTTP, REDIRECT_META):
+        add_cached_hops(history, hop_cache.remember(url, (redirect_url, redirect_type), history.hops_left()))
+
+
+def get_redirect_history(url, timeout, max_redirects=30, user_agent=None, max_body_bytes=MAX_BODY_BYTES,
+                         hop_cache=None, timing=None, history=None, stopped=None):
     """
     Входные параметры:
 
@@ -141,6 +546,14 @@ def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
     + timeout - таймаут на проверку *одного* урла
     + max_redirects - максимальное количество редиректов, после превышения проверка останавливается
     + user_agent - юзер-агент, если не передает, то будет дефолтный из pycurl
+    + max_body_bytes - сколько байт содержимого страницы загружать не больше
+    + hop_cache - кэш переходов (lib.cache.HopCache), по известным переходам урлы не запрашиваются
+    + timing - lib.timing.TaskTiming, в который записываются тайминги запросов и этапов проверки
+    + history - RedirectHistory, обход которой нужно продолжить (например, RedirectHistory.resumed),
+      после проверки в ней остается вид ошибки, прервавшей обход
+    + stopped - функция без аргументов, проверяется перед каждым запросом: если она вернет истину,
+      обход прерывается исключением CheckStopped, чтобы остановка обработчика не ждала
+      конца цепочки (до max_redirects запросов по timeout секунд)
 
 
     Выходные параметры:
@@ -151,54 +564,73 @@ def get_redirect_history(url, timeout, max_redirects=30, user_agent=None):
     3. установленные счетчики на конечном урле
 
     """
-    url = prepare_url(url)
-    history_types = []
-    history_urls = [url]
-    redirect_url = url
+    if history is None:
+        history = RedirectHistory(prepare_url(url), max_redirects)
 
-    # ignore mm / ok domains
-    if re.match(MM_URL, url) or re.match(OK_URL, url):
-        return history_types, history_urls, []
+    if hop_cache is not None:
+        follow_cached_hops(history, hop_cache)
 
-    content = None
-    while True:
-        redirect_url, redirect_type, content = get_url(
-            url=redirect_url,
+    while not history.finished:
+        if stopped is not None and stopped():
+            raise CheckStopped
+
+        hop, error = fetch_url(
+            url=history.redirect_url,
             timeout=timeout,
-            user_agent=user_agent
+            user_agent=user_agent,
+            max_body_bytes=max_body_bytes,
+            timing=timing
         )
-        if not redirect_url:
-            break
-
-        history_types.append(redirect_type)
-        history_urls.append(redirect_url)
-
-        if redirect_type == 'ERROR':
-            break
-
-        if len(history_urls) > max_redirects or (redirect_url in history_urls[:-1]):
-            break
+        record_hop(history, hop_cache, hop, error)
 
         if break_func_for_test():
             break
 
-    counters = get_counters(content) if content else []
+    return history.result(timing)
 
-    return history_types, history_urls, counters
+
+def warm_up():
+    """
+    Проверяет страницу с мета-редиректом без сетевых запросов, чтобы модули,
+    кодеки (idna) и регулярные выражения, которые загружаются и компилируются
+    при первом использовании, были загружены до запуска обработчиков:
+    их страницы памяти будут общими для родителя и всех обработчиков (copy-on-write).
+    """
+    url = prepare_url(u'http://пример.рф/путь?q=значение&r=1')
+    history = RedirectHistory(url)
+    history.add(*process_response(
+        url, '<html><head><meta http-equiv="refresh" content="0; url=/next"></head><body></body></html>', None
+    ))
+    history.add(None, None, '<html><body>{}</body></html>'.format(COUNTER_TYPES[0][1]))
+    return history.result()
 
 
+@memoize(PREPARED_URLS_CACHE_SIZE)
 def prepare_url(url):
-    """Нормализация урла"""
+    """
+    Нормализация урла.
+
+    Результаты запоминаются для последних PREPARED_URLS_CACHE_SIZE урлов:
+    каждый урл цепочки нормализуется несколько раз. Кодирование в IDNA
+    и экранирование пропускаются для частей урла, которые от них не
+    изменятся (ASCII-домен, уже экранированные путь и параметры). Урлы без
+    схемы нормализуются полностью: для них от этого зависит тип результата.
+    """
     if url is None:
         return url
     scheme, netloc, path, qs, anchor, fragments = urlparse(
         to_unicode(url),
         allow_fragments=False
     )
-    try:
-        netloc = netloc.encode('idna')
-    except UnicodeError:
-        pass
-    path = quote(to_str(path, 'ignore'), safe='/%+$!*\'(),')
-    qs = quote_plus(to_str(qs, 'ignore'), safe=':&%=+$!*\'(),')
+    # the idna codec leaves ascii labels as they are
+    is_ascii = scheme and ASCII_TEXT.match(netloc)
+    if not is_ascii:
+        try:
+            netloc = netloc.encode('idna')
+        except UnicodeError:
+            pass
+    if not is_ascii or not QUOTED_PATH.match(path):
+        path = quote(to_str(path, 'ignore'), safe='/%+$!*\'(),')
+    if not is_ascii or not QUOTED_PARAMS.match(qs):
+        qs = quote_plus(to_str(qs, 'ignore'), safe=':&%=+$!*\'(),')
     return urlunparse((scheme, netloc, path, qs, anchor, fragments))
\ No newline at end of file
@@ -0,0 +1,204 @@
+# coding: utf-8
+from collections import OrderedDict
+from functools import wraps
+from multiprocessing.managers import BaseManager
+from threading import Lock
+from time import time
+
+from metrics import Registry
+
+
+class LRUCache(object):
+    """
+    Кэш ограниченного размера с временем жизни записей.
+
+    При переполнении вытесняются записи, которые дольше всего не запрашивались.
+    Считает попадания и промахи, чтобы по ним можно было подобрать размер кэша.
+
+    Через CacheManager методы вызываются из потоков процесса менеджера,
+    обслуживающих разные обработчики, поэтому выполняются под блокировкой.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.pop(key, None)
+            if item is None or item[0] < time():
+                self.misses += 1
+                return None
+            self.data[key] = item
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.data.pop(key, None)
+            self.data[key] = (time() + self.ttl, value)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.data),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class HopCache(LRUCache):
+    """
+    Кэш переходов по редиректам: урл -> (урл редиректа, тип редиректа).
+
+    Через CacheManager каждый вызов метода - синхронный запрос к процессу
+    менеджера (десятки микросекунд, см. benchmarks/bench_hop_cache.py),
+    поэтому известные переходы цепочки отдаются одним вызовом, а сохранение
+    перехода совмещено с поиском продолжения цепочки.
+    """
+
+    def follow(self, url, limit):
+        """
+        :return: до limit известных кэшу переходов подряд, начиная с url
+        """
+        hops = []
+        while len(hops) < limit:
+            hop = self.get(url)
+            if hop is None:
+                break
+            hops.append(hop)
+            url = hop[0]
+        return hops
+
+    def remember(self, url, hop, limit):
+        """
+        Сохраняет переход из url, если он еще не сохранен (срок жизни записи
+        не продлевается), и возвращает follow от урла, в который он ведет.
+        """
+        with self.lock:
+            item = self.data.get(url)
+            cached = item is not None and item[1] == hop and item[0] >= time()
+        if not cached:
+            self.set(url, hop)
+        return self.follow(hop[0], limit)
+
+
+class ResultCache(object):
+    """
+    Результаты проверки урлов, общие для всех обработчиков, и урлы, которые проверяются прямо сейчас.
+
+    Обработчик, взявший задачу, вызывает claim: если урл недавно проверен,
+    он получает готовый результат; если урл уже проверяет другой обработчик,
+    он ждет, повторяя claim; иначе проверяет урл сам и сохраняет результат
+    через complete. Если проверяющий обработчик не вызвал complete или release
+    за claim_ttl секунд (например, был убит), урл может проверить другой.
+
+    Методы вызываются из потоков процесса менеджера, обслуживающих разные
+    обработчики, поэтому выполняются под блокировкой.
+    """
+
+    def __init__(self, size, ttl, claim_ttl):
+        self.results = LRUCache(size, ttl)
+        self.claim_ttl = claim_ttl
+        self.claims = {}
+        self.lock = Lock()
+
+    def claim(self, url, since=0):
+        """
+        :param since: результаты, полученные раньше этого времени, не подходят
+        :return: (результат проверки или None, должен ли вызвавший проверить урл сам)
+        """
+        with self.lock:
+            item = self.results.get(url)
+            if item is not None and item[0] >= since:
+                return item[1], False
+            now = time()
+            if self.claims.get(url, 0) > now:
+                return None, False
+            self.claims[url] = now + self.claim_ttl
+            return None, True
+
+    def complete(self, url, result):
+        with self.lock:
+            self.claims.pop(url, None)
+            self.results.set(url, (time(), result))
+
+    def release(self, urls):
+        """Снимает проверку урлов, которые вызвавший не проверит (например, завершаясь)"""
+        with self.lock:
+            for url in urls:
+                self.claims.pop(url, None)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.results.stats(), in_flight=len(self.claims))
+
+
+def memoize(size):
+    """
+    Запоминает результаты функции одного хешируемого аргумента для последних
+    size различных аргументов (LRU). Исключения не запоминаются.
+
+    Записи связаны в двусвязный список по давности использования, поэтому
+    попадание обходится несколькими присваиваниями, без перестройки
+    OrderedDict. Не потокобезопасен: рассчитан на вызовы из одного потока
+    процесса-обработчика (greenlet'ы переключаются только на вводе-выводе).
+    Функция-обертка получает метод clear, очищающий запомненное.
+    """
+    def decorator(func):
+        # link: [previous, next, key, value], root.next is the least recently used
+        root = []
+        cache = {}
+
+        def clear():
+            cache.clear()
+            root[:] = [root, root, None, None]
+
+        @wraps(func)
+        def wrapper(key):
+            link = cache.get(key)
+            if link is not None:
+                previous, next_link, key, value = link
+                previous[1] = next_link
+                next_link[0] = previous
+            else:
+                value = func(key)
+                if len(cache) >= size:
+                    oldest = root[1]
+                    root[1] = oldest[1]
+                    oldest[1][0] = root
+                    del cache[oldest[2]]
+                link = cache[key] = [None, None, key, value]
+            last = root[0]
+            last[1] = root[0] = link
+            link[0] = last
+            link[1] = root
+            return value
+
+        clear()
+        wrapper.clear = clear
+        return wrapper
+    return decorator
+
+
+class CacheManager(BaseManager):
+    """
+    Процесс, в котором живут кэши и реестр метрик, разделяемые между процессами-обработчиками.
+    """
+    pass
+
+CacheManager.register('HopCache', HopCache)
+CacheManager.register('ResultCache', ResultCache)
+CacheManager.register('MetricsRegistry', Registry)
+
+
+def start_cache_manager():
+    manager = CacheManager()
+    manager.start()
+    return manager
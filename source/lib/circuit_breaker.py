@@ -0,0 +1,90 @@
+# coding: utf-8
+from math import ceil
+from time import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class HostCircuit(object):
+    def __init__(self):
+        self.failures = 0
+        self.retry_at = 0
+        self.probing = False
+
+
+class CircuitBreaker(object):
+    """
+    Размыкатель цепи для хостов, запросы к которым раз за разом завершаются ошибкой.
+
+    После failure_threshold ошибок подряд цепь хоста размыкается: запросы
+    к нему не выполняются, пока не пройдет задержка, растущая вдвое с каждой
+    ошибкой от base_delay до max_delay. Затем цепь становится полуоткрытой:
+    выполняется один пробный запрос, успех которого замыкает цепь, а ошибка
+    снова размыкает ее на удвоенное время.
+    """
+
+    def __init__(self, failure_threshold, base_delay, max_delay):
+        self.failure_threshold = failure_threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hosts = {}
+
+    def state(self, host):
+        circuit = self.hosts.get(host)
+        if circuit is None or circuit.failures < self.failure_threshold:
+            return CLOSED
+        if circuit.probing or time() >= circuit.retry_at:
+            return HALF_OPEN
+        return OPEN
+
+    def allow(self, host):
+        """
+        Можно ли выполнить запрос к хосту. В полуоткрытом состоянии
+        разрешает только один пробный запрос.
+        """
+        state = self.state(host)
+        if state == CLOSED:
+            return True
+        circuit = self.hosts[host]
+        if state == OPEN or circuit.probing:
+            return False
+        circuit.probing = True
+        return True
+
+    def success(self, host):
+        self.hosts.pop(host, None)
+
+    def cancel(self, host):
+        """
+        Запрос к хосту, разрешенный allow, не выполнен или завершился ошибкой,
+        не зависящей от хоста: не считается ни успехом, ни ошибкой,
+        в полуоткрытом состоянии можно выполнить другой пробный запрос.
+        """
+        circuit = self.hosts.get(host)
+        if circuit is not None:
+            circuit.probing = False
+
+    def failure(self, host):
+        """
+        Запоминает ошибку запроса к хосту.
+
+        :return: через сколько секунд стоит повторить неудавшийся запрос
+        """
+        circuit = self.hosts.get(host)
+        if circuit is None:
+            circuit = self.hosts[host] = HostCircuit()
+        circuit.failures += 1
+        circuit.probing = False
+        delay = min(self.max_delay, self.base_delay * 2 ** (circuit.failures - 1))
+        if circuit.failures >= self.failure_threshold:
+            circuit.retry_at = time() + delay
+        return delay
+
+    def retry_delay(self, host):
+        """Через сколько секунд повторить запрос, который allow не разрешил"""
+        circuit = self.hosts.get(host)
+        if circuit is None:
+            return self.base_delay
+        return max(self.base_delay, int(ceil(circuit.retry_at - time())))
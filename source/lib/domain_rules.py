@@ -0,0 +1,93 @@
+# coding: utf-8
+from urlparse import urlsplit
+
+SKIP_TASK = 'skip'
+STOP_CHAIN = 'stop'
+IGNORE_REDIRECT = 'ignore'
+RULE_TYPES = (SKIP_TASK, STOP_CHAIN, IGNORE_REDIRECT)
+
+DEFAULT_RULES = (
+    # odnoklassniki.ru pages and my.mail.ru apps are not checked
+    {'type': SKIP_TASK, 'host': 'odnoklassniki.ru'},
+    {'type': SKIP_TASK, 'host': 'www.odnoklassniki.ru'},
+    {'type': SKIP_TASK, 'host': 'my.mail.ru', 'path': '/apps/'},
+    # odnoklassniki.ru login redirects
+    {'type': IGNORE_REDIRECT, 'host': 'odnoklassniki.ru', 'contains': 'st.redirect'},
+    {'type': IGNORE_REDIRECT, 'host': 'www.odnoklassniki.ru', 'contains': 'st.redirect'},
+)
+"""Правила, заменившие регулярные выражения OK_URL, MM_URL и OK_REDIRECT"""
+
+
+class DomainRules(object):
+    """
+    Таблица правил для отдельных доменов.
+
+    Правило - словарь с ключами:
+
+    + type - что делать с урлом:
+      SKIP_TASK - не проверять задачу с таким урлом,
+      STOP_CHAIN - записать урл в цепочку, но не запрашивать его,
+      IGNORE_REDIRECT - не считать переход на урл редиректом
+    + host - 'example.com' - только этот хост, '.example.com' - он и все его поддомены
+    + path - необязательный префикс пути урла
+    + contains - необязательная подстрока части урла после хоста
+
+    Сравнение идет без учета регистра, правила применяются только к http и https урлам.
+    Правила хранятся в словарях по хостам, поэтому поиск занимает по одному
+    обращению к словарю на каждую метку хоста урла, сколько бы ни было правил.
+    """
+
+    def __init__(self, rules=DEFAULT_RULES):
+        self.exact = {}
+        self.suffixes = {}
+        self.types = set()
+        for rule in rules:
+            if rule['type'] not in RULE_TYPES:
+                raise ValueError('Unknown domain rule type {}'.format(rule['type']))
+            host = rule['host'].lower().rstrip('.')
+            table = self.exact
+            if host.startswith('.'):
+                host = host[1:]
+                table = self.suffixes
+            table.setdefault(host, []).append(
+                (rule['type'], rule.get('path', '').lower(), rule.get('contains', '').lower())
+            )
+            self.types.add(rule['type'])
+        self.count = len(rules)
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, host):
+        """Правила хоста host и всех доменов, поддоменом которых он является"""
+        rules = list(self.exact.get(host, ()))
+        suffix = host
+        while True:
+            rules.extend(self.suffixes.get(suffix, ()))
+            dot = suffix.find('.')
+            if dot == -1:
+                return rules
+            suffix = suffix[dot + 1:]
+
+    def match(self, url, rule_type):
+        """
+        Подходит ли к урлу правило типа rule_type.
+        """
+        if rule_type not in self.types or not url:
+            return False
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            return False
+        rest = None
+        for found_type, path, contains in self.lookup(parts.hostname.rstrip('.')):
+            if found_type != rule_type:
+                continue
+            if path and not parts.path.lower().startswith(path):
+                continue
+            if contains:
+                if rest is None:
+                    rest = url[len(parts.scheme) + 3 + len(parts.netloc):].lower()
+                if contains not in rest:
+                    continue
+            return True
+        return False
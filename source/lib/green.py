@@ -0,0 +1,117 @@
+# coding: utf-8
+from gevent.event import AsyncResult
+from gevent.hub import get_hub
+import pycurl
+
+READ = 1
+WRITE = 2
+
+POLL_EVENTS = {
+    pycurl.POLL_IN: READ,
+    pycurl.POLL_OUT: WRITE,
+    pycurl.POLL_INOUT: READ | WRITE,
+}
+"""События сокета, которых ждет curl, в терминах цикла событий gevent"""
+
+
+class GreenCurlMulti(object):
+    """
+    Кооперативное выполнение запросов curl-хендлов из greenlet'ов.
+
+    Все запросы процесса выполняются одним pycurl.CurlMulti, сокеты и таймеры
+    которого отслеживает цикл событий gevent. Greenlet, вызвавший perform,
+    переключается на другие, пока его запрос не завершится, поэтому
+    блокирующий код проверки цепочки (get_redirect_history) может выполняться
+    сотнями greenlet'ов одновременно.
+    """
+
+    def __init__(self):
+        self.loop = get_hub().loop
+        self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self.on_socket)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self.on_timer)
+        self.watchers = {}
+        self.timer = None
+        self.results = {}
+
+    def __len__(self):
+        """Количество выполняющихся запросов"""
+        return len(self.results)
+
+    def perform(self, curl):
+        """
+        Выполняет запрос настроенного curl-хендла, как curl.perform.
+
+        :raise pycurl.error: запрос завершился ошибкой
+        """
+        result = AsyncResult()
+        self.results[curl] = result
+        self.multi.add_handle(curl)
+        try:
+            # not every libcurl asks for a timeout on add_handle, so the transfer is started here
+            self.socket_action(pycurl.SOCKET_TIMEOUT, 0)
+            error = result.get()
+        finally:
+            if self.results.pop(curl, None) is not None:
+                # the greenlet was killed before the transfer completed
+                self.multi.remove_handle(curl)
+        if error is not None:
+            raise pycurl.error(*error)
+
+    def on_socket(self, event, fd, multi, data):
+        watcher = self.watchers.pop(fd, None)
+        if watcher is not None:
+            watcher.stop()
+        if event == pycurl.POLL_REMOVE:
+            return
+        watcher = self.watchers[fd] = self.loop.io(fd, POLL_EVENTS[event])
+        watcher.start(self.on_io, fd, pass_events=True)
+
+    def on_timer(self, timeout_ms):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+        if timeout_ms >= 0:
+            # socket_action can't be called from curl callbacks, so even a zero timeout goes to the loop
+            self.timer = self.loop.timer(timeout_ms / 1000.0)
+            self.timer.start(self.socket_action, pycurl.SOCKET_TIMEOUT, 0)
+
+    def on_io(self, events, fd):
+        action = 0
+        if events & READ:
+            action |= pycurl.CSELECT_IN
+        if events & WRITE:
+            action |= pycurl.CSELECT_OUT
+        self.socket_action(fd, action)
+
+    def socket_action(self, fd, action):
+        while True:
+            ret, running = self.multi.socket_action(fd, action)
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        self.read_completed()
+
+    def read_completed(self):
+        while True:
+            num_queued, ok_list, err_list = self.multi.info_read()
+            for curl in ok_list:
+                self.complete(curl, None)
+            for curl, errno, errmsg in err_list:
+                self.complete(curl, (errno, errmsg))
+            if num_queued == 0:
+                break
+
+    def complete(self, curl, error):
+        result = self.results.pop(curl, None)
+        self.multi.remove_handle(curl)
+        if result is not None:
+            result.set(error)
+
+    def close(self):
+        for watcher in self.watchers.values():
+            watcher.stop()
+        self.watchers = {}
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+        self.multi.close()
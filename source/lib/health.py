@@ -0,0 +1,105 @@
+# coding: utf-8
+from collections import deque
+from threading import Event, Thread
+from time import time
+
+from utils import check_network_status
+
+
+class HealthWindow(object):
+    """
+    Скользящее окно результатов последних size проверок сети с гистерезисом.
+
+    Сеть считается упавшей, когда доля успешных проверок в окне становится
+    меньше down_ratio, и поднявшейся, когда она снова достигает up_ratio.
+    Первая проверка заполняет все окно, поэтому одна неудачная проверка
+    после нее не меняет статус.
+    """
+
+    def __init__(self, size, down_ratio, up_ratio):
+        self.results = deque(maxlen=size)
+        self.down_ratio = down_ratio
+        self.up_ratio = up_ratio
+        self.up = None
+
+    def ratio(self):
+        return float(sum(self.results)) / len(self.results)
+
+    def add(self, ok):
+        """
+        Добавляет результат проверки.
+
+        :return: доступна ли сеть
+        """
+        if self.up is None:
+            self.results.extend([ok] * self.results.maxlen)
+            self.up = ok
+            return self.up
+        self.results.append(ok)
+        if self.up and self.ratio() < self.down_ratio:
+            self.up = False
+        elif not self.up and self.ratio() >= self.up_ratio:
+            self.up = True
+        return self.up
+
+
+class HealthMonitor(object):
+    """
+    Фоновая проверка доступности сети.
+
+    Раз в interval секунд одновременно запрашивает все урлы urls, проверка
+    успешна, если ответили хотя бы quorum из них. Результаты собираются
+    в HealthWindow(window_size, down_ratio, up_ratio), статус которого
+    доступен без ожидания в атрибуте up.
+    """
+
+    def __init__(self, urls, timeout, interval, window_size, down_ratio, up_ratio, quorum=1):
+        self.urls = urls
+        self.timeout = timeout
+        self.interval = interval
+        self.window = HealthWindow(window_size, down_ratio, up_ratio)
+        self.quorum = quorum
+        self.up = None
+        self.checked_at = None
+        self.stopped = Event()
+        self.thread = None
+
+    def probe(self):
+        """
+        Запрашивает все урлы одновременно.
+
+        :return: количество ответивших урлов
+        """
+        results = []
+        threads = [Thread(target=lambda url=url: results.append(check_network_status(url, self.timeout)),
+                          name='health.probe') for url in self.urls]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        deadline = time() + self.timeout + 1
+        for thread in threads:
+            # urlopen timeout covers each socket operation, not the whole request
+            thread.join(max(0, deadline - time()))
+        return sum(results)
+
+    def check(self):
+        self.up = self.window.add(self.probe() >= self.quorum)
+        self.checked_at = time()
+        return self.up
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def start(self):
+        """
+        Выполняет первую проверку, чтобы статус был известен сразу,
+        и запускает следующие в фоновом потоке.
+        """
+        self.check()
+        self.thread = Thread(target=self.run, name='health')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
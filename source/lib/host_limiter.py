@@ -0,0 +1,124 @@
+# coding: utf-8
+from collections import deque
+from time import time
+from urlparse import urlsplit
+
+
+def get_host(url):
+    """Хост (с портом, если он указан) урла"""
+    return urlsplit(url).netloc.lower()
+
+
+class HostState(object):
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+
+
+class HostLimiter(object):
+    """
+    Ограничение количества одновременных запросов к одному хосту.
+
+    Лимит хоста меняется по схеме AIMD: после каждого медленного
+    (дольше latency_threshold секунд) или неудачного запроса он умножается
+    на decrease, после удачного растет так, что за limit удачных запросов
+    подряд увеличивается на единицу. Лимит не выходит за границы
+    [min_limit, max_limit].
+    """
+
+    def __init__(self, max_limit, min_limit=1, latency_threshold=5, decrease=0.5):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.latency_threshold = latency_threshold
+        self.decrease = decrease
+        self.hosts = {}
+
+    def limit(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            return self.max_limit
+        return int(state.limit)
+
+    def acquire(self, host):
+        """
+        Занимает место под запрос к хосту.
+
+        :return: False, если к хосту уже выполняется максимум запросов
+        """
+        state = self.hosts.get(host)
+        if state is None:
+            state = self.hosts[host] = HostState(self.max_limit)
+        if state.in_flight >= int(state.limit):
+            return False
+        state.in_flight += 1
+        return True
+
+    def release(self, host, latency, error=False):
+        """
+        Освобождает место, занятое acquire, и пересчитывает лимит хоста.
+
+        :param latency: время выполнения запроса в секундах
+        :param error: запрос завершился ошибкой
+        """
+        state = self.hosts[host]
+        state.in_flight -= 1
+        if error or latency > self.latency_threshold:
+            state.limit = max(self.min_limit, state.limit * self.decrease)
+        else:
+            state.limit = min(self.max_limit, state.limit + 1.0 / state.limit)
+
+        if state.in_flight == 0 and state.limit >= self.max_limit:
+            # nothing to remember about a healthy idle host
+            del self.hosts[host]
+
+
+class PendingTasks(object):
+    """
+    Задачи, взятые для хостов, к которым уже выполняется максимум запросов.
+
+    У каждого хоста ждут не больше max_per_host задач, в порядке взятия.
+    Задача ждет не дольше timeout секунд: он должен быть меньше ttr очереди,
+    иначе tarantool.queue сам вернет взятую задачу и отдаст ее снова.
+    """
+
+    def __init__(self, max_per_host, timeout):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.hosts = {}
+
+    def __len__(self):
+        return sum(len(tasks) for tasks in self.hosts.itervalues())
+
+    def add(self, host, task):
+        """
+        :return: False, если у хоста уже ждут max_per_host задач
+        """
+        tasks = self.hosts.setdefault(host, deque())
+        if len(tasks) >= self.max_per_host:
+            return False
+        tasks.append((time() + self.timeout, task))
+        return True
+
+    def first(self, host):
+        return self.hosts[host][0][1]
+
+    def pop(self, host):
+        tasks = self.hosts[host]
+        task = tasks.popleft()[1]
+        if not tasks:
+            del self.hosts[host]
+        return task
+
+    def expired(self):
+        """Забирает задачи, которые ждут дольше timeout секунд"""
+        now = time()
+        expired = []
+        for host in self.hosts.keys():
+            while host in self.hosts and self.hosts[host][0][0] <= now:
+                expired.append(self.pop(host))
+        return expired
+
+    def pop_all(self):
+        tasks = [task for host_tasks in self.hosts.itervalues() for expires_at, task in host_tasks]
+        self.hosts.clear()
+        return tasks
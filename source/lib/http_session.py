@@ -0,0 +1,49 @@
+# coding: utf-8
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def make_session(pool_size, pool_hosts=100, host_pool_sizes=None):
+    """
+    Создает сессию requests, переиспользующую соединения между запросами.
+
+    Сессию можно использовать из нескольких greenlet'ов одновременно:
+    свободное соединение берется из пула хоста, а после ответа
+    возвращается в него.
+
+    :param pool_size: сколько соединений с одним хостом держать открытыми
+    :param pool_hosts: для скольких хостов держать открытые соединения
+    :param host_pool_sizes: словарь {хост[:порт]: pool_size} для хостов,
+                            которым нужен свой размер пула
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    for host, size in (host_pool_sizes or {}).iteritems():
+        host_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        for scheme in ('http', 'https'):
+            session.mount('{}://{}/'.format(scheme, host), host_adapter)
+    return session
+
+
+def get_pool_stats(session):
+    """
+    Статистика пулов соединений сессии.
+
+    :return: словарь {(схема, хост, порт): (попадания, промахи)}, где
+             попадания - запросы, отправленные через уже открытое соединение,
+             промахи - запросы, для которых пришлось открыть новое
+    """
+    stats = {}
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            hits = max(0, pool.num_requests - pool.num_connections)
+            stats[key] = (hits, pool.num_connections)
+    return stats
@@ -0,0 +1,228 @@
+# coding: utf-8
+import BaseHTTPServer
+from bisect import bisect_left
+from logging import getLogger
+from threading import Lock, Thread
+from time import time
+
+logger = getLogger('redirect_checker')
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+"""Границы корзин гистограмм времени, в секундах"""
+
+CHAIN_LENGTH_BUCKETS = (1, 2, 3, 4, 5, 10, 20, 30)
+"""Границы корзин гистограммы длины цепочки редиректов"""
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+
+def format_labels(labels, **extra):
+    items = list(labels) + sorted(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in items
+    ) + '}'
+
+
+class Registry(object):
+    """
+    Счетчики, значения и гистограммы в формате, который читает Prometheus.
+
+    Каждая метрика хранится отдельно для каждого набора меток, переданных
+    именованными аргументами. Состояние, которое возвращает take, можно
+    добавить в другой реестр через merge: так метрики процессов-обработчиков
+    собираются в общем реестре, живущем в процессе менеджера.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.buckets = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                self.buckets[name] = buckets
+                histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0, 0]
+            histogram[0][bisect_left(buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def sum(self, name):
+        """Сумма значений метрики name по всем наборам меток"""
+        with self.lock:
+            return sum(value for (gauge, labels), value in self.gauges.items() if gauge == name)
+
+    def retain(self, label, values):
+        """
+        Удаляет значения с меткой label, не входящей в values,
+        например значения завершившихся процессов-обработчиков.
+        """
+        values = set(values)
+        with self.lock:
+            for key in self.gauges.keys():
+                labels = dict(key[1])
+                if label in labels and labels[label] not in values:
+                    del self.gauges[key]
+
+    def take(self):
+        """
+        Возвращает состояние реестра и обнуляет счетчики и гистограммы.
+
+        :return: счетчики, значения, гистограммы, границы корзин гистограмм
+        """
+        with self.lock:
+            state = self.counters, dict(self.gauges), self.histograms, dict(self.buckets)
+            self.counters, self.histograms = {}, {}
+        return state
+
+    def merge(self, state):
+        """
+        Добавляет к реестру состояние, которое вернул take другого реестра:
+        счетчики и гистограммы складываются, значения заменяются.
+        """
+        counters, gauges, histograms, buckets = state
+        with self.lock:
+            for key, value in counters.iteritems():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(gauges)
+            self.buckets.update(buckets)
+            for key, (counts, total, count) in histograms.iteritems():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    self.histograms[key] = [list(counts), total, count]
+                    continue
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+                histogram[2] += count
+
+    def render(self):
+        """Метрики в текстовом формате Prometheus"""
+        lines = []
+        with self.lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                last_name = None
+                for (name, labels), value in sorted(values.items()):
+                    if name != last_name:
+                        lines.append('# TYPE {} {}'.format(name, kind))
+                        last_name = name
+                    lines.append('{}{} {}'.format(name, format_labels(labels), format_value(value)))
+
+            last_name = None
+            for (name, labels), (counts, total, count) in sorted(self.histograms.items()):
+                if name != last_name:
+                    lines.append('# TYPE {} histogram'.format(name))
+                    last_name = name
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets[name] + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels, le=bound), cumulative))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), format_value(total)))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsBuffer(Registry):
+    """
+    Метрики процесса-обработчика, раз в interval секунд добавляемые в общий реестр.
+
+    Если общего реестра нет (метрики выключены), накопленное просто отбрасывается.
+    """
+
+    def __init__(self, shared, interval):
+        Registry.__init__(self)
+        self.shared = shared
+        self.interval = interval
+        self.pushed_at = time()
+
+    def push_if_due(self):
+        if time() - self.pushed_at >= self.interval:
+            self.push()
+
+    def push(self):
+        self.pushed_at = time()
+        state = self.take()
+        if self.shared is None:
+            return
+        try:
+            self.shared.merge(state)
+        except (IOError, EOFError) as e:
+            # the manager process is gone, the parent is probably shutting down
+            logger.warning(u'Metrics push fail: {}'.format(e))
+
+
+class Timer(object):
+    """Записывает в гистограмму реестра время выполнения блока with"""
+
+    def __init__(self, registry, name, **labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds = time() - self.started
+        self.registry.observe(self.name, self.seconds, **self.labels)
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    """
+    HTTP-сервер, отдающий по адресу /metrics то, что возвращает render.
+    """
+
+    def __init__(self, address, render):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MetricsHandler)
+        self.render = render
+
+
+def start_metrics_server(host, port, render):
+    """
+    Запускает MetricsServer в фоновом потоке.
+
+    :param render: функция, возвращающая метрики в текстовом формате Prometheus
+    """
+    server = MetricsServer((host, port), render)
+    thread = Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    return server
@@ -0,0 +1,135 @@
+# coding: utf-8
+from logging import getLogger
+from time import sleep
+
+import pycurl
+
+from . import (MAX_BODY_BYTES, RedirectHistory, follow_cached_hops, get_curl_pool,
+               prepare_url, process_response, read_curl_response, record_hop,
+               setup_curl)
+
+logger = getLogger('redirect_checker')
+
+
+class MultiRedirectChecker(object):
+    """
+    Одновременный обход нескольких цепочек редиректов через pycurl.CurlMulti.
+
+    Каждая цепочка продвигается на один переход за оборот цикла событий:
+    как только запрос очередного урла завершается, в мульти-хендл
+    добавляется запрос следующего урла этой цепочки.
+
+    Curl-хендлы берутся из пула процесса (см. get_curl_pool).
+    """
+
+    def __init__(self, timeout, max_redirects=30, user_agent=None, max_body_bytes=MAX_BODY_BYTES,
+                 hop_cache=None):
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.user_agent = user_agent
+        self.max_body_bytes = max_body_bytes
+        self.hop_cache = hop_cache
+        self.multi = pycurl.CurlMulti()
+        self.pool = get_curl_pool()
+        self.handles = {}
+        self.timings = {}
+        self.finished = []
+
+    def __len__(self):
+        """Количество цепочек, которые еще не обойдены до конца"""
+        return len(self.handles) + len(self.finished)
+
+    def add(self, key, url, timing=None, history=None):
+        """
+        Добавляет урл на проверку.
+
+        :param key: ключ, с которым будет возвращен результат проверки
+        :param url: урл для которого необходимо получить редиректы
+        :param timing: lib.timing.TaskTiming, в который записываются тайминги проверки
+        :param history: RedirectHistory, обход которой нужно продолжить вместо обхода url с начала
+        """
+        if history is None:
+            history = RedirectHistory(prepare_url(url), self.max_redirects)
+        if timing is not None:
+            self.timings[key] = timing
+        if self.hop_cache is not None:
+            follow_cached_hops(history, self.hop_cache)
+        self.start(key, history)
+
+    def start(self, key, history):
+        if history.finished:
+            self.finished.append((key, history.result(self.timings.pop(key, None))))
+            return
+
+        curl = self.pool.get()
+        try:
+            buff = setup_curl(curl, history.redirect_url, self.timeout, self.user_agent, self.max_body_bytes)
+        except (pycurl.error, ValueError) as e:
+            self.pool.put(curl)
+            self.add_hop(key, history, (history.redirect_url, 'ERROR', None), e)
+            return
+        self.handles[curl] = (key, history, buff)
+        self.multi.add_handle(curl)
+
+    def add_hop(self, key, history, hop, error=None):
+        if error is not None:
+            logger.error(u'error in url {} {}'.format(history.redirect_url, error))
+        record_hop(history, self.hop_cache, hop, error)
+        self.start(key, history)
+
+    def complete(self, curl, error=None):
+        self.multi.remove_handle(curl)
+        key, history, buff = self.handles.pop(curl)
+        if buff.aborted:
+            # the transfer was stopped by the buffer on purpose
+            error = None
+        timing = self.timings.get(key)
+        if timing is not None:
+            timing.add_hop(history.redirect_url, curl)
+        if error is None:
+            content, new_redirect_url = read_curl_response(curl, buff)
+            hop = process_response(history.redirect_url, content, new_redirect_url, timing)
+        else:
+            hop = history.redirect_url, 'ERROR', None
+        self.pool.put(curl)
+        self.add_hop(key, history, hop, error)
+
+    def perform(self, timeout=1.0):
+        """
+        Один оборот цикла событий: ждет активности на сокетах не дольше timeout
+        секунд и продвигает цепочки, запросы которых завершились.
+
+        :return: список пар (ключ, (типы редиректов, урлы редиректов, счетчики))
+                 для полностью обойденных цепочек
+        """
+        if self.handles:
+            if self.multi.select(timeout) == -1:
+                # curl еще не открыл ни одного сокета (например, резолвит хост)
+                sleep(min(timeout, 0.01))
+            self.read_completed()
+
+        finished, self.finished = self.finished, []
+        return finished
+
+    def read_completed(self):
+        while True:
+            ret, num_handles = self.multi.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+
+        while True:
+            num_queued, ok_list, err_list = self.multi.info_read()
+            for curl in ok_list:
+                self.complete(curl)
+            for curl, errno, errmsg in err_list:
+                self.complete(curl, pycurl.error(errno, errmsg))
+            if num_queued == 0:
+                break
+
+    def close(self):
+        for curl in self.handles.keys():
+            self.multi.remove_handle(curl)
+            self.pool.put(curl)
+        self.handles = {}
+        self.timings = {}
+        self.multi.close()
@@ -0,0 +1,66 @@
+# coding: utf-8
+import random
+
+import pycurl
+
+DNS = 'dns'
+TIMEOUT = 'timeout'
+REFUSED = 'refused'
+TLS = 'tls'
+OTHER = 'other'
+ERROR_KINDS = (DNS, TIMEOUT, REFUSED, TLS, OTHER)
+
+# CURLE_PEER_FAILED_VERIFICATION has no pycurl constant
+CURLE_PEER_FAILED_VERIFICATION = 51
+
+CURL_ERROR_KINDS = {
+    pycurl.E_COULDNT_RESOLVE_HOST: DNS,
+    pycurl.E_COULDNT_RESOLVE_PROXY: DNS,
+    pycurl.E_OPERATION_TIMEDOUT: TIMEOUT,
+    pycurl.E_COULDNT_CONNECT: REFUSED,
+    pycurl.E_SSL_CONNECT_ERROR: TLS,
+    CURLE_PEER_FAILED_VERIFICATION: TLS,
+    pycurl.E_SSL_CERTPROBLEM: TLS,
+    pycurl.E_SSL_CIPHER: TLS,
+    pycurl.E_SSL_CACERT: TLS,
+    pycurl.E_SSL_CACERT_BADFILE: TLS,
+}
+
+
+def classify_error(error):
+    """
+    Вид ошибки запроса урла (DNS, TIMEOUT, REFUSED, TLS или OTHER).
+
+    :param error: pycurl.error или другое исключение запроса, None - ошибка неизвестна
+    """
+    if isinstance(error, pycurl.error) and error.args:
+        return CURL_ERROR_KINDS.get(error.args[0], OTHER)
+    return OTHER
+
+
+class RetryPolicy(object):
+    """
+    Сколько раз и через сколько секунд повторять проверку, завершившуюся ошибкой.
+
+    kinds - словарь вида ошибки в {'attempts': повторов, 'delay': задержка первого
+    повтора}, вид, которого в нем нет, не повторяется. Задержка удваивается с
+    каждым повтором, но не превышает max_delay, и уменьшается на случайную
+    долю до jitter, чтобы задачи, упавшие вместе (например, при сбое DNS),
+    не возвращались в очередь одной волной.
+    """
+
+    def __init__(self, kinds, max_delay, jitter):
+        self.kinds = kinds
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def attempts(self, kind):
+        return self.kinds.get(kind, {}).get('attempts', 0)
+
+    def delay(self, kind, attempt):
+        """
+        :param attempt: номер повтора, начиная с 1
+        :return: целое число секунд
+        """
+        delay = min(self.max_delay, self.kinds.get(kind, {}).get('delay', 0) * 2 ** (attempt - 1))
+        return int(delay * (1 - random.uniform(0, self.jitter)))
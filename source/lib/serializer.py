@@ -0,0 +1,52 @@
+# coding: utf-8
+from importlib import import_module
+
+JSON_BACKENDS = ('ujson', 'simplejson', 'json')
+"""Библиотеки сериализации в JSON в порядке предпочтения"""
+
+
+def get_json_backend(name=None):
+    """
+    Выбирает библиотеку сериализации в JSON.
+
+    :param name: имя библиотеки из JSON_BACKENDS; если не задано,
+                 берется первая установленная
+    :return: имя библиотеки, ее функция dumps
+    """
+    names = (name,) if name else JSON_BACKENDS
+    for backend in names:
+        if backend not in JSON_BACKENDS:
+            raise ValueError('Unknown JSON backend {}'.format(backend))
+        try:
+            module = import_module(backend)
+        except ImportError:
+            continue
+        return backend, module.dumps
+    raise ImportError('JSON backend {} is not installed'.format(name))
+
+
+json_backend, json_dumps = get_json_backend()
+
+
+_missing = object()
+
+
+def dumps_without(data, removed_key, key, value, dumps=json_dumps):
+    """
+    Сериализует словарь без поля removed_key и с полем key=value, не копируя
+    его: словарь изменяется на время сериализации и восстанавливается после нее.
+
+    :param dumps: функция сериализации
+    :return: значение поля removed_key, сериализованный словарь
+    """
+    removed = data.pop(removed_key)
+    old_value = data.get(key, _missing)
+    data[key] = value
+    try:
+        return removed, dumps(data)
+    finally:
+        if old_value is _missing:
+            del data[key]
+        else:
+            data[key] = old_value
+        data[removed_key] = removed
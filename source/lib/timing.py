@@ -0,0 +1,128 @@
+# coding: utf-8
+import cProfile
+from contextlib import contextmanager
+from functools import partial
+from importlib import import_module
+from logging import getLogger
+import os
+from time import time
+
+import pycurl
+
+logger = getLogger('redirect_checker')
+
+CURL_TIMES = (
+    ('namelookup', pycurl.NAMELOOKUP_TIME),
+    ('connect', pycurl.CONNECT_TIME),
+    ('appconnect', pycurl.APPCONNECT_TIME),
+    ('starttransfer', pycurl.STARTTRANSFER_TIME),
+    ('total', pycurl.TOTAL_TIME),
+)
+"""Замеры curl getinfo, сохраняемые для каждого перехода (секунды от начала запроса)"""
+
+
+class TaskTiming(object):
+    """
+    Замеры времени проверки одной задачи: тайминги curl для каждого
+    запрошенного урла цепочки и суммарное время этапов обработки.
+    """
+
+    def __init__(self, task_id):
+        self.task_id = task_id
+        self.started = time()
+        self.total = None
+        self.hops = []
+        self.stages = {}
+
+    def add_hop(self, url, curl):
+        self.hops.append((url, dict((name, curl.getinfo(info)) for name, info in CURL_TIMES)))
+
+    def add_stage(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    def call(self, stage, func, *args):
+        """Вызывает func, добавляя время вызова к этапу stage"""
+        started = time()
+        try:
+            return func(*args)
+        finally:
+            self.add_stage(stage, time() - started)
+
+    def finish(self):
+        self.total = time() - self.started
+
+
+def log_timing(timing):
+    logger.info(u'Task id={} timing: total={:.4f} {} {}'.format(
+        timing.task_id,
+        timing.total,
+        ' '.join('{}={:.4f}'.format(stage, seconds) for stage, seconds in sorted(timing.stages.items())),
+        ' '.join(u'[{} {}]'.format(url, ' '.join(
+            '{}={:.4f}'.format(name, times[name]) for name, info in CURL_TIMES
+        )) for url, times in timing.hops)
+    ))
+
+
+def observe_timing(metrics, timing):
+    for url, times in timing.hops:
+        for phase, seconds in times.iteritems():
+            metrics.observe('checker_hop_seconds', seconds, phase=phase)
+    for stage, seconds in timing.stages.iteritems():
+        metrics.observe('checker_stage_seconds', seconds, stage=stage)
+
+
+def get_timing_sink(name, metrics=None):
+    """
+    Выбирает, куда отправлять замеры задач.
+
+    :param name: 'log' - в лог, 'metrics' - в гистограммы metrics,
+                 путь к функции вида 'package.module.function' - в эту функцию,
+                 None - замеры не нужны
+    :return: функция, принимающая TaskTiming, или None
+    """
+    if not name:
+        return None
+    if name == 'log':
+        return log_timing
+    if name == 'metrics':
+        return partial(observe_timing, metrics)
+    module, _, function = name.rpartition('.')
+    if not module:
+        raise ValueError('Unknown timing sink {}'.format(name))
+    return getattr(import_module(module), function)
+
+
+class Profiler(object):
+    """
+    Профилирует через cProfile каждый every-й блок sample, 0 выключает профилирование.
+
+    Статистика сохраняется в directory в файлы {pid}-{номер блока}-{имя блока}.prof,
+    которые читаются через pstats или snakeviz.
+    """
+
+    def __init__(self, every, directory):
+        self.every = every
+        self.directory = directory
+        self.count = 0
+
+    @contextmanager
+    def sample(self, name):
+        self.count += 1
+        if not self.every or self.count % self.every:
+            yield
+            return
+
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self.save(profile, name)
+
+    def save(self, profile, name):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, '{}-{}-{}.prof'.format(os.getpid(), self.count, name))
+        profile.dump_stats(path)
+        logger.info(u'Profile saved to {}'.format(path))
@@ -1,8 +1,14 @@
 # coding: utf-8
 import argparse
+from collections import OrderedDict
+import errno
+import fcntl
 from multiprocessing import Process
 import os
+import select
+import signal
 import socket
+import time
 import urllib2
 
 from tarantool_queue import tarantool_queue
@@ -106,6 +112,154 @@ def get_tube(host, port, space, name):
     return queue.tube(name)
 
 
+def task_from_row(queue, row):
+    """
+    Создает задачу по строке ответа queue.take.
+
+    Последнее поле строки - приоритет задачи в том виде, в котором он был
+    передан в queue.put, он сохраняется в task.pri.
+    """
+    task = tarantool_queue.Task(
+        queue, space=queue.space, task_id=row[0], tube=row[1], status=row[2], raw_data=row[3]
+    )
+    task.pri = int(row[-1])
+    return task
+
+
+def take_task(tube, timeout):
+    """
+    Берет задачу из очереди вместе с ее приоритетом (см. task_from_row).
+
+    :param tube: очередь, полученная через get_tube
+    :param timeout: время ожидания задачи в секундах
+    :rtype: tarantool_queue.Task или None
+    """
+    queue = tube.queue
+    response = queue.tnt.call('queue.take', (str(queue.space), str(tube.opt['tube']), str(timeout)))
+    if response.rowcount == 0:
+        return None
+    return task_from_row(queue, response[0])
+
+
+def take_tasks(tube, count, timeout):
+    """
+    Берет из очереди до count задач за один запрос (queue.take_many).
+
+    Ждет не дольше timeout секунд только первую задачу, остальные берутся,
+    если они уже готовы к выполнению.
+
+    :param tube: очередь, полученная через get_tube
+    :param count: максимальное количество задач
+    :param timeout: время ожидания первой задачи в секундах
+    :rtype: list
+    """
+    queue = tube.queue
+    response = queue.tnt.call('queue.take_many', (
+        str(queue.space), str(tube.opt['tube']), str(count), str(timeout)
+    ))
+    return [task_from_row(queue, row) for row in response]
+
+
+def put_tasks(tube, items):
+    """
+    Кладет в очередь несколько задач за один запрос (queue.put_many).
+
+    :param tube: очередь, полученная через get_tube
+    :param items: список пар (данные задачи, словарь с параметрами
+                  delay, ttl, ttr, pri как у Tube.put)
+    :return: количество положенных задач
+    """
+    if not items:
+        return 0
+    queue = tube.queue
+    args = [str(queue.space), str(tube.opt['tube'])]
+    for data, kwargs in items:
+        opt = dict(tube.opt, **kwargs)
+        args.extend((
+            str(opt['delay']), str(opt['ttl']), str(opt['ttr']), str(opt['pri']), tube.serialize(data)
+        ))
+    return len(queue.tnt.call('queue.put_many', tuple(args)))
+
+
+def _sorted_keys(data):
+    if isinstance(data, dict):
+        return OrderedDict((key, _sorted_keys(data[key])) for key in sorted(data))
+    if isinstance(data, (list, tuple)):
+        return [_sorted_keys(item) for item in data]
+    return data
+
+
+def task_fingerprint(tube, data):
+    """
+    Сериализует данные задачи с отсортированными ключами словарей, чтобы равные
+    данные всегда давали одинаковые байты: по ним queue.put_unique находит
+    уже положенную задачу, сколько бы раз и в каком порядке ключей ее ни клали.
+    """
+    return tube.serialize(_sorted_keys(data))
+
+
+def put_unique_tasks(tube, items):
+    """
+    Кладет в очередь несколько задач за один запрос (queue.put_unique_many),
+    пропуская задачи, данные которых совпадают с готовой или отложенной задачей очереди.
+
+    Требует четвертого индекса по данным задачи (см. provision/tarantool.cfg).
+
+    :param tube: очередь, полученная через get_tube
+    :param items: список пар (данные задачи, словарь с параметрами
+                  delay, ttl, ttr, pri как у Tube.put)
+    :return: количество новых и найденных в очереди задач
+    """
+    if not items:
+        return 0
+    queue = tube.queue
+    args = [str(queue.space), str(tube.opt['tube'])]
+    for data, kwargs in items:
+        opt = dict(tube.opt, **kwargs)
+        args.extend((
+            str(opt['delay']), str(opt['ttl']), str(opt['ttr']), str(opt['pri']), task_fingerprint(tube, data)
+        ))
+    return len(queue.tnt.call('queue.put_unique_many', tuple(args)))
+
+
+def _finish_tasks(procedure, tasks, *args):
+    if not tasks:
+        return set()
+    queue = tasks[0].queue
+    for task in tasks:
+        task.modified = True
+    response = queue.tnt.call(procedure, (str(queue.space),) + args + tuple(task.task_id for task in tasks))
+    return set(row[0] for row in response)
+
+
+def ack_tasks(tasks):
+    """
+    Подтверждает выполнение нескольких задач одной очереди за один запрос.
+
+    :return: множество идентификаторов подтвержденных задач
+    """
+    return _finish_tasks('queue.ack_many', tasks)
+
+
+def bury_tasks(tasks):
+    """
+    Хоронит несколько задач одной очереди за один запрос.
+
+    :return: множество идентификаторов похороненных задач
+    """
+    return _finish_tasks('queue.bury_many', tasks)
+
+
+def release_tasks(tasks, delay=0):
+    """
+    Возвращает в очередь несколько задач одной очереди за один запрос.
+
+    :param delay: через сколько секунд задачи снова можно будет взять
+    :return: множество идентификаторов возвращенных задач
+    """
+    return _finish_tasks('queue.release_many', tasks, str(delay))
+
+
 class Config(object):
     """
     Класс для хранения настроек приложения.
@@ -113,11 +267,129 @@ class Config(object):
     pass
 
 
-def spawn_workers(num, target, args, parent_pid):
+def run_worker(target, *args, **kwargs):
+    """
+    Запускает обработчик в дочернем процессе, сбросив унаследованную от родителя
+    обработку сигналов (см. ChildWatcher).
+
+    Сигналы паузы игнорируются, пока обработчик не установит свои:
+    по умолчанию SIGUSR1 и SIGUSR2 завершают процесс.
+    """
+    signal.set_wakeup_fd(-1)
+    for signum in (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, signal.SIG_DFL)
+    for signum in (signal.SIGUSR1, signal.SIGUSR2):
+        signal.signal(signum, signal.SIG_IGN)
+    target(*args, **kwargs)
+
+
+def spawn_workers(num, target, args, parent_pid, kwargs=None):
+    """
+    :return: список запущенных процессов
+    """
+    kwargs = dict(kwargs or {}, parent_pid=parent_pid)
+    processes = []
     for _ in xrange(num):
-        p = Process(target=target, args=args, kwargs={'parent_pid': parent_pid})
+        p = Process(target=run_worker, args=(target,) + tuple(args), kwargs=kwargs)
         p.daemon = True
         p.start()
+        processes.append(p)
+    return processes
+
+
+class RespawnBackoff(object):
+    """
+    Откладывает запуск обработчиков взамен тех, что завершаются вскоре после
+    запуска (например, не могут подключиться к очереди), чтобы не запускать их в цикле.
+
+    Если среди завершившихся есть обработчик, проживший меньше min_lifetime
+    секунд, это n-я неудача подряд, и следующие обработчики запускаются не
+    раньше чем через delay * 2 ** (n - 1) секунд (но не больше max_delay) после
+    предыдущего запуска. Завершение только проработавших дольше обработчиков
+    (например, перезапускаемых после MAX_TASKS_PER_CHILD задач) сбрасывает счетчик.
+    """
+
+    def __init__(self, min_lifetime, delay, max_delay):
+        self.min_lifetime = min_lifetime
+        self.delay = delay
+        self.max_delay = max_delay
+        self.started = {}
+        self.failures = 0
+        self.spawned_at = 0
+
+    def spawned(self, processes):
+        self.spawned_at = time.time()
+        for p in processes:
+            self.started[p.pid] = self.spawned_at
+
+    def update(self, pids):
+        """
+        Учитывает завершившиеся обработчики.
+
+        :param pids: pid'ы живых обработчиков
+        """
+        now = time.time()
+        lifetimes = [now - self.started.pop(pid) for pid in self.started.keys() if pid not in pids]
+        if not lifetimes:
+            return
+        if min(lifetimes) < self.min_lifetime:
+            self.failures += 1
+        else:
+            self.failures = 0
+
+    def spawn_at(self):
+        """Время, раньше которого новые обработчики не запускаются"""
+        if not self.failures:
+            return 0
+        return self.spawned_at + min(self.max_delay, self.delay * 2 ** (self.failures - 1))
+
+
+class ChildWatcher(object):
+    """
+    Ожидание, которое прерывается, как только завершается любой дочерний процесс.
+
+    Обработчик SIGCHLD ничего не делает: сигнал будит ожидание через
+    signal.set_wakeup_fd, поэтому сигнал, пришедший до начала ожидания, не теряется.
+    Прерванные сигналом системные вызовы (кроме select) перезапускаются.
+    Сами процессы собирает multiprocessing.active_children.
+    """
+
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        for fd in (self.read_fd, self.write_fd):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self.write_fd)
+        signal.signal(signal.SIGCHLD, self.handle)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def handle(self, signum, frame):
+        pass
+
+    def wait(self, timeout):
+        """
+        Ждет timeout секунд или сигнала.
+
+        :return: True, если ожидание прервал сигнал
+        """
+        try:
+            readable = select.select([self.read_fd], [], [], max(0, timeout))[0]
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = True
+        try:
+            while os.read(self.read_fd, 1024):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        return bool(readable)
+
+    def close(self):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.set_wakeup_fd(-1)
+        os.close(self.read_fd)
+        os.close(self.write_fd)
 
 
 def check_network_status(check_url, timeout):
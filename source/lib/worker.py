@@ -1,32 +1,70 @@
 # coding: utf-8
 from logging import getLogger
 import os.path
+import signal
+from time import sleep, time
 
+import gevent
+from gevent.event import Event
+from gevent.pool import Pool
 from tarantool.error import DatabaseError
-from . import to_unicode, get_redirect_history
+from . import (MAX_BODY_BYTES, CheckStopped, RedirectHistory, to_unicode, get_curl_pool, get_redirect_history,
+               prepare_url, set_curl_driver)
+from green import GreenCurlMulti
+from metrics import CHAIN_LENGTH_BUCKETS, MetricsBuffer, Registry, Timer
+from multi import MultiRedirectChecker
+from retry import OTHER, RetryPolicy
+from timing import Profiler, TaskTiming, get_timing_sink
 
-from utils import get_tube
+from utils import ack_tasks, get_tube, put_tasks, put_unique_tasks, release_tasks, take_task, take_tasks
 
 logger = getLogger('redirect_checker')
 
+RESULT_CACHE_POLL_INTERVAL = 0.1
+
+run_application = True
+"""Флаг, определяющий, должен ли обработчик продолжать работу (сбрасывается по SIGTERM)"""
+
+take_paused = False
+"""Флаг, запрещающий брать новые задачи (SIGUSR1 ставит, SIGUSR2 снимает)"""
+
 
 def break_func_for_test():
     return False
 
 
-def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None):
+def log_task(task):
     url = to_unicode(task.data['url'], 'ignore')
     is_recheck = bool(task.data.get('recheck'))
 
     logger.info(u'Task id={} url={} url_id={} is_recheck={}'.format(
         task.task_id, url, task.data["url_id"], is_recheck
     ))
+    return url
 
-    history_types, history_urls, counters = get_redirect_history(
-        url, timeout, max_redirects, user_agent
-    )
-    if 'ERROR' in history_types and not is_recheck:
+
+def make_task_result(task, history_types, history_urls, counters, error=None, retry_policy=None):
+    """
+    Формирует результат задачи по найденной истории редиректов.
+
+    Задача, проверка которой прервалась ошибкой вида error, возвращается на
+    перепроверку, пока число ее повторов (task.data['attempt']) меньше
+    разрешенного retry_policy для этого вида, без retry_policy - один раз.
+    Перепроверка продолжает обход с урла, на котором он прервался
+    (task.data['resume'], см. task_history).
+
+    :return: признак возврата задачи во входную очередь (на перепроверку), данные задачи
+    """
+    is_recheck = bool(task.data.get('recheck'))
+    error = error or OTHER
+    attempt = task.data.get('attempt', int(is_recheck))
+    attempts = 1 if retry_policy is None else retry_policy.attempts(error)
+    if 'ERROR' in history_types and attempt < attempts:
         task.data['recheck'] = True
+        task.data['attempt'] = attempt + 1
+        task.data['error'] = error
+        # the last url is the one that failed, it is requested again
+        task.data['resume'] = [history_types[:-1], history_urls[:-1]]
         data = task.data
         is_input = True
     else:
@@ -42,7 +80,105 @@ def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=N
     return is_input, data
 
 
-def worker(config, parent_pid):
+def task_history(task, url, max_redirects):
+    """
+    История обхода для задачи: новая или, для перепроверки после ошибки,
+    продолжающая обход с урла, на котором он прервался.
+    """
+    resume = task.data.get('resume')
+    if resume:
+        return RedirectHistory.resumed(resume[0], resume[1], max_redirects)
+    return RedirectHistory(prepare_url(url), max_redirects)
+
+
+def observe_history(metrics, history_types, started):
+    metrics.observe('checker_check_seconds', time() - started)
+    metrics.observe('checker_redirect_chain_length', len(history_types), CHAIN_LENGTH_BUCKETS)
+
+
+def result_cache_key(url):
+    """Ключ урла в общем кэше результатов (нормализованный урл), None - урл не кэшируется"""
+    try:
+        return prepare_url(url)
+    except (UnicodeError, ValueError):
+        return None
+
+
+class WaitCancelled(Exception):
+    """Обработчик остановлен, пока задача ждала результата проверки урла другим обработчиком"""
+    pass
+
+
+def claim_url(result_cache, key, task, started, metrics):
+    """
+    Ищет результат проверки урла задачи в общем кэше или берет его проверку на себя.
+
+    Перепроверяемой задаче (recheck) подходит только результат, полученный
+    после того, как она взята, иначе ей достался бы тот же ERROR.
+
+    :return: (история редиректов или None, должен ли вызвавший проверить урл сам)
+    """
+    if key is None:
+        return None, True
+    since = started if task.data.get('recheck') else 0
+    history, is_owner = result_cache.claim(key, since)
+    if metrics is not None:
+        if history is not None:
+            metrics.inc('checker_result_cache_total', outcome='hit')
+        elif is_owner:
+            metrics.inc('checker_result_cache_total', outcome='check')
+    return history, is_owner
+
+
+def get_redirect_history_from_task(task, timeout, max_redirects=30, user_agent=None, max_body_bytes=MAX_BODY_BYTES,
+                                   hop_cache=None, metrics=None, timing=None, result_cache=None,
+                                   poll_interval=RESULT_CACHE_POLL_INTERVAL, wait=sleep, retry_policy=None,
+                                   stopped=None):
+    """
+    Проверяет урл задачи и формирует ее результат.
+
+    С общим кэшем результатов (result_cache) недавно проверенный урл не
+    проверяется снова, а пока урл проверяет другой обработчик, задача ждет
+    его результата, опрашивая кэш раз в poll_interval секунд (wait - функция
+    ожидания движка). Результат формируется для каждой задачи отдельно,
+    поэтому у нее остаются свои url_id, recheck и suspicious. Если во время
+    ожидания stopped() вернет истину, бросается WaitCancelled, а во время
+    проверки между переходами цепочки - CheckStopped: задача не проверена.
+    Повторять ли проверку при ошибке, решает retry_policy (см. make_task_result).
+    """
+    url = log_task(task)
+
+    started = time()
+    key = result_cache_key(url) if result_cache is not None else None
+    while True:
+        history, is_owner = claim_url(result_cache, key, task, started, metrics)
+        if history is not None:
+            return make_task_result(task, *history, retry_policy=retry_policy)
+        if is_owner:
+            break
+        if stopped is not None and stopped():
+            raise WaitCancelled
+        wait(poll_interval)
+
+    history = task_history(task, url, max_redirects)
+    try:
+        history_types, history_urls, counters = get_redirect_history(
+            url, timeout, max_redirects, user_agent, max_body_bytes, hop_cache, timing, history, stopped
+        )
+    except BaseException:
+        # tasks waiting for the url don't wait until the claim expires
+        if key is not None:
+            result_cache.release([key])
+        raise
+    result = history_types, history_urls, counters, history.error
+    if key is not None:
+        result_cache.complete(key, result)
+    if metrics is not None:
+        observe_history(metrics, history_types, started)
+    return make_task_result(task, *result, retry_policy=retry_policy)
+
+
+def connect_tubes(config):
     input_tube = get_tube(
         host=config.INPUT_QUEUE_HOST,
         port=config.INPUT_QUEUE_PORT,
@@ -68,38 +204,469 @@ def worker(config, parent_pid):
         space=output_tube.queue.space,
         name=output_tube.opt['tube']
     ))
+    return input_tube, output_tube
+
+
+def tasks_left(config, taken):
+    """
+    Сколько задач обработчик может взять, прежде чем завершиться и быть запущенным
+    заново (config.MAX_TASKS_PER_CHILD), None - без ограничения.
+    """
+    if not config.MAX_TASKS_PER_CHILD:
+        return None
+    return max(0, config.MAX_TASKS_PER_CHILD - taken)
+
+
+def log_recycle(taken):
+    logger.info(u'Worker took {} tasks, exiting to be respawned.'.format(taken))
+
+
+def stop_handler(signum, frame):
+    """
+    Останавливает обработчик: новые задачи не берутся, взятые
+    возвращаются в очередь или доделываются (см. release_in_flight).
+    """
+    global run_application
+    logger.info('Got signal #{}. stopping worker'.format(signum))
+    run_application = False
+
+
+def pause_handler(signum, frame):
+    global take_paused
+    logger.info('Got signal #{}. pausing task taking'.format(signum))
+    take_paused = True
+
+
+def resume_handler(signum, frame):
+    global take_paused
+    logger.info('Got signal #{}. resuming task taking'.format(signum))
+    take_paused = False
+
+
+def install_signal_handlers():
+    """
+    Устанавливает обработчики сигналов остановки и паузы процесса-обработчика.
+
+    Сигналы не прерывают системные вызовы, поэтому запросы к очередям
+    доделываются, а флаги проверяются циклом обработчика между задачами
+    (флаг остановки - еще и между переходами цепочки редиректов).
+    """
+    global run_application, take_paused
+    run_application = True
+    take_paused = False
+    for signum, handler in ((signal.SIGTERM, stop_handler), (signal.SIGINT, stop_handler),
+                            (signal.SIGUSR1, pause_handler), (signal.SIGUSR2, resume_handler)):
+        signal.signal(signum, handler)
+        signal.siginterrupt(signum, False)
+
+
+def release_in_flight(tasks, metrics):
+    """
+    Возвращает во входную очередь взятые, но не проверенные задачи,
+    чтобы другие обработчики взяли их сразу, а не через ttr.
+    """
+    if not tasks:
+        return
+    try:
+        released = release_tasks(tasks)
+    except DatabaseError as e:
+        logger.info('Task release fail')
+        logger.exception(e)
+        return
+    metrics.inc('checker_tasks_released_total', len(released))
+    logger.info(u'Released in-flight tasks {}'.format(', '.join(str(task_id) for task_id in sorted(released))))
+
+
+class ResultBatch(object):
+    """
+    Результаты выполненных задач, отправляемые в очереди пачками.
+
+    Пачка отправляется, когда в ней накопилось config.RESULT_BATCH_SIZE
+    результатов или первый из них ждет дольше config.RESULT_FLUSH_INTERVAL
+    секунд. Сначала в очереди кладутся результаты всех задач пачки (один
+    запрос на очередь; задачи на перепроверку кладутся через put_unique_tasks,
+    поэтому перепроверка, уже ждущая в очереди после сбоя или повтора, не
+    дублируется), затем одним запросом подтверждаются задачи,
+    результаты которых удалось положить. Задача, результат которой положить
+    не удалось, не подтверждается и будет выполнена повторно.
+    Задачи на перепроверку откладываются на время, которое retry_policy
+    (из config.RETRY_POLICY) назначает виду ошибки и номеру повтора.
+    """
+
+    def __init__(self, config, input_tube, output_tube, metrics=None):
+        self.config = config
+        self.input_tube = input_tube
+        self.output_tube = output_tube
+        self.metrics = metrics if metrics is not None else Registry()
+        self.retry_policy = RetryPolicy(config.RETRY_POLICY, config.RETRY_MAX_DELAY, config.RETRY_JITTER)
+        self.items = []
+        self.started = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, task, result):
+        if not self.items:
+            self.started = time()
+        self.items.append((task, result))
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if not self.items:
+            return
+        if (len(self.items) >= self.config.RESULT_BATCH_SIZE or
+                time() - self.started >= self.config.RESULT_FLUSH_INTERVAL):
+            self.flush()
+
+    def flush(self):
+        if not self.items:
+            return
+        items, self.items = self.items, []
+        rechecks, outputs, done = [], [], []
+        for task, result in items:
+            if not result:
+                done.append(task)
+                continue
+            is_input, data = result
+            if is_input:
+                delay = self.retry_policy.delay(data.get('error', OTHER), data.get('attempt', 1))
+                rechecks.append((task, (data, {'delay': delay, 'pri': task.pri})))
+            else:
+                outputs.append((task, (data, {})))
+            logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
+
+        for tube, batch, put in ((self.input_tube, rechecks, put_unique_tasks),
+                                 (self.output_tube, outputs, put_tasks)):
+            if not batch:
+                continue
+            try:
+                with Timer(self.metrics, 'checker_queue_request_seconds', request='put'):
+                    put(tube, [item for task, item in batch])
+            except DatabaseError as e:
+                logger.info(u'Result put fail for tasks {}'.format(
+                    ', '.join(str(task.task_id) for task, item in batch)
+                ))
+                logger.exception(e)
+                continue
+            if tube is self.input_tube:
+                self.metrics.inc('checker_tasks_requeued_total', len(batch))
+            done.extend(task for task, item in batch)
+
+        try:
+            with Timer(self.metrics, 'checker_queue_request_seconds', request='ack'):
+                acked = ack_tasks(done)
+        except DatabaseError as e:
+            logger.info('Task ack fail')
+            logger.exception(e)
+            return
+        self.metrics.inc('checker_tasks_acked_total', len(acked))
+        for task in done:
+            if task.task_id in acked:
+                logger.info(u'Task id={} done'.format(task.task_id))
+            else:
+                logger.info(u'Task id={} ack fail'.format(task.task_id))
+
+
+def worker(config, parent_pid, hop_cache=None, metrics=None, result_cache=None):
+    input_tube, output_tube = connect_tubes(config)
+    get_curl_pool(config.CURL_POOL_SIZE)
+    worker_metrics = MetricsBuffer(metrics, config.METRICS_PUSH_INTERVAL)
+    worker_metrics.set('checker_worker_capacity', 1, worker=os.getpid())
+    results = ResultBatch(config, input_tube, output_tube, worker_metrics)
+    timing_sink = get_timing_sink(config.TIMING_SINK, worker_metrics)
+    profiler = Profiler(config.PROFILE_EVERY, config.PROFILE_DIR)
+    install_signal_handlers()
+    taken = 0
 
     parent_proc = '/proc/{}'.format(parent_pid)
 
+    def stopped():
+        return not run_application or not os.path.exists(parent_proc)
+
     # run while parent is alive
     while os.path.exists(parent_proc):
-        task = input_tube.take(config.QUEUE_TAKE_TIMEOUT)
+        if not run_application:
+            # the task taken last is already checked or released, so there is nothing to release
+            break
+        if tasks_left(config, taken) == 0:
+            log_recycle(taken)
+            break
+        worker_metrics.set('checker_tasks_in_flight', 0, worker=os.getpid())
+        if take_paused:
+            results.flush_if_due()
+            worker_metrics.push_if_due()
+            sleep(config.QUEUE_TAKE_TIMEOUT)
+            continue
+        with Timer(worker_metrics, 'checker_queue_request_seconds', request='take') as take_timer:
+            task = take_task(input_tube, config.QUEUE_TAKE_TIMEOUT)
         if task:
+            taken += 1
             logger.info(u'Starting task id={}.'.format(task.task_id))
-            result = get_redirect_history_from_task(
-                task,
-                config.HTTP_TIMEOUT,
-                config.MAX_REDIRECTS,
-                config.USER_AGENT
-            )
-            if result:
-                is_input, data = result
-                if is_input:
-                    input_tube.put(
-                        data,
-                        delay=config.RECHECK_DELAY,
-                        pri=task.meta()['pri']
-                    )
-                else:
-                    output_tube.put(data)
-                logger.debug(u'Task id={} data:{}'.format(task.task_id, data))
+            worker_metrics.inc('checker_tasks_taken_total')
+            worker_metrics.set('checker_tasks_in_flight', 1, worker=os.getpid())
+            timing = None
+            if timing_sink is not None:
+                timing = TaskTiming(task.task_id)
+                timing.add_stage('queue_take', take_timer.seconds)
             try:
-                task.ack()
-                logger.info(u'Task id={} done'.format(task.task_id))
-            except DatabaseError as e:
-                logger.info('Task ack fail')
-                logger.exception(e)
+                with profiler.sample(task.task_id):
+                    result = get_redirect_history_from_task(
+                        task,
+                        config.HTTP_TIMEOUT,
+                        config.MAX_REDIRECTS,
+                        config.USER_AGENT,
+                        config.MAX_BODY_BYTES,
+                        hop_cache,
+                        worker_metrics,
+                        timing,
+                        result_cache,
+                        config.RESULT_CACHE_POLL_INTERVAL,
+                        sleep,
+                        results.retry_policy,
+                        stopped
+                    )
+            except (WaitCancelled, CheckStopped):
+                # the worker is stopping in the middle of the task, so it is not acked but returned at once
+                release_in_flight([task], worker_metrics)
+                continue
+            results.add(task, result)
+            if timing is not None:
+                timing.finish()
+                timing_sink(timing)
+        results.flush_if_due()
+        worker_metrics.push_if_due()
         if break_func_for_test():
             break
     else:
         logger.info('Parent is dead. exiting')
+    results.flush()
+    worker_metrics.push()
+
+
+def multi_worker(config, parent_pid, hop_cache=None, metrics=None, result_cache=None):
+    """
+    Обработчик, одновременно проверяющий до config.MULTI_CONCURRENCY задач.
+
+    Задачи на все свободные места берет из входной очереди одним запросом
+    и добавляет их в MultiRedirectChecker, после чего продвигает все цепочки редиректов
+    на один оборот цикла событий и отправляет результаты завершенных задач.
+    Задачи, урлы которых проверяют другие обработчики (см. result_cache),
+    ждут их результатов, не занимая MultiRedirectChecker, и опрашивают кэш на каждом обороте.
+    """
+    input_tube, output_tube = connect_tubes(config)
+    get_curl_pool(config.CURL_POOL_SIZE)
+    checker = MultiRedirectChecker(
+        config.HTTP_TIMEOUT, config.MAX_REDIRECTS, config.USER_AGENT, config.MAX_BODY_BYTES, hop_cache
+    )
+    worker_metrics = MetricsBuffer(metrics, config.METRICS_PUSH_INTERVAL)
+    worker_metrics.set('checker_worker_capacity', config.MULTI_CONCURRENCY, worker=os.getpid())
+    results = ResultBatch(config, input_tube, output_tube, worker_metrics)
+    timing_sink = get_timing_sink(config.TIMING_SINK, worker_metrics)
+    # tasks are checked together, so whole event loop turns are profiled
+    profiler = Profiler(config.PROFILE_EVERY, config.PROFILE_DIR)
+    install_signal_handlers()
+    tasks = {}
+    # tasks whose urls are checked by other workers (or other tasks of this one)
+    waiting = {}
+    # result cache keys of the urls checked by this worker
+    claimed = {}
+    taken = 0
+
+    parent_proc = '/proc/{}'.format(parent_pid)
+
+    # run while parent is alive
+    while os.path.exists(parent_proc):
+        if not run_application:
+            break
+        left = tasks_left(config, taken)
+        if left == 0 and not tasks and not waiting:
+            log_recycle(taken)
+            break
+        free_count = config.MULTI_CONCURRENCY - len(tasks) - len(waiting)
+        if left is not None:
+            free_count = min(free_count, left)
+        if take_paused:
+            free_count = 0
+            if not tasks and not waiting:
+                sleep(config.QUEUE_TAKE_TIMEOUT)
+        if free_count > 0:
+            # don't block in-flight requests while waiting for new tasks
+            take_timeout = config.MULTI_TAKE_TIMEOUT if tasks or waiting else config.QUEUE_TAKE_TIMEOUT
+            with Timer(worker_metrics, 'checker_queue_request_seconds', request='take'):
+                new_tasks = take_tasks(input_tube, free_count, take_timeout)
+            taken += len(new_tasks)
+            worker_metrics.inc('checker_tasks_taken_total', len(new_tasks))
+            for task in new_tasks:
+                logger.info(u'Starting task id={}.'.format(task.task_id))
+                timing = TaskTiming(task.task_id) if timing_sink is not None else None
+                url = log_task(task)
+                key = result_cache_key(url) if result_cache is not None else None
+                waiting[task.task_id] = (task, url, key, time(), timing)
+
+        for task_id, (task, url, key, started, timing) in waiting.items():
+            history, is_owner = claim_url(result_cache, key, task, started, worker_metrics)
+            if history is not None:
+                del waiting[task_id]
+                results.add(task, make_task_result(task, *history, retry_policy=results.retry_policy))
+                if timing is not None:
+                    timing.finish()
+                    timing_sink(timing)
+            elif is_owner:
+                del waiting[task_id]
+                history = task_history(task, url, config.MAX_REDIRECTS)
+                tasks[task_id] = (task, started, timing, history)
+                if key is not None:
+                    claimed[task_id] = key
+                checker.add(task_id, url, timing, history)
+
+        if tasks:
+            with profiler.sample('perform'):
+                finished = checker.perform(config.HTTP_TIMEOUT)
+            for task_id, result in finished:
+                task, started, timing, history = tasks.pop(task_id)
+                result += (history.error,)
+                if task_id in claimed:
+                    result_cache.complete(claimed.pop(task_id), result)
+                observe_history(worker_metrics, result[0], started)
+                results.add(task, make_task_result(task, *result, retry_policy=results.retry_policy))
+                if timing is not None:
+                    timing.finish()
+                    timing_sink(timing)
+        elif waiting:
+            # nothing to perform while the urls are checked elsewhere
+            sleep(config.RESULT_CACHE_POLL_INTERVAL)
+        worker_metrics.set('checker_tasks_in_flight', len(tasks) + len(waiting), worker=os.getpid())
+        results.flush_if_due()
+        worker_metrics.push_if_due()
+        if break_func_for_test():
+            break
+    else:
+        logger.info('Parent is dead. exiting')
+    results.flush()
+    release_in_flight(
+        [task for task, started, timing, history in tasks.itervalues()] +
+        [task for task, url, key, started, timing in waiting.itervalues()],
+        worker_metrics
+    )
+    if claimed:
+        result_cache.release(claimed.values())
+    checker.close()
+    worker_metrics.push()
+
+
+def check_task_green(config, task, results, hop_cache, worker_metrics, timing_sink, task_done, tasks,
+                     result_cache=None):
+    """
+    Проверяет задачу в greenlet'е green_worker'а и добавляет ее результат в пачку.
+
+    :param tasks: взятые и еще не проверенные задачи обработчика по task_id,
+                  задача удаляется из них, когда ее результат добавлен в пачку
+    """
+    timing = TaskTiming(task.task_id) if timing_sink is not None else None
+    try:
+        result = get_redirect_history_from_task(
+            task,
+            config.HTTP_TIMEOUT,
+            config.MAX_REDIRECTS,
+            config.USER_AGENT,
+            config.MAX_BODY_BYTES,
+            hop_cache,
+            worker_metrics,
+            timing,
+            result_cache,
+            config.RESULT_CACHE_POLL_INTERVAL,
+            gevent.sleep,
+            results.retry_policy
+        )
+        results.add(task, result)
+        tasks.pop(task.task_id, None)
+        if timing is not None:
+            timing.finish()
+            timing_sink(timing)
+    finally:
+        task_done.set()
+
+
+def green_worker(config, parent_pid, hop_cache=None, metrics=None, result_cache=None):
+    """
+    Обработчик, одновременно проверяющий до config.GREEN_CONCURRENCY задач в greenlet'ах.
+
+    Каждая задача проверяется обычным get_redirect_history в своем greenlet'е,
+    запросы всех greenlet'ов выполняет общий GreenCurlMulti. Задачи на все
+    свободные места берутся из входной очереди одним запросом: после
+    завершения любой из задач, но не реже раза в config.GREEN_TAKE_INTERVAL секунд.
+    Запросы к очередям и кэшу не кооперативные и выполняются между переключениями greenlet'ов.
+    """
+    # the hub must not be shared with the parent process
+    gevent.reinit()
+    input_tube, output_tube = connect_tubes(config)
+    get_curl_pool(config.CURL_POOL_SIZE)
+    driver = GreenCurlMulti()
+    set_curl_driver(driver)
+    worker_metrics = MetricsBuffer(metrics, config.METRICS_PUSH_INTERVAL)
+    worker_metrics.set('checker_worker_capacity', config.GREEN_CONCURRENCY, worker=os.getpid())
+    results = ResultBatch(config, input_tube, output_tube, worker_metrics)
+    timing_sink = get_timing_sink(config.TIMING_SINK, worker_metrics)
+    pool = Pool(config.GREEN_CONCURRENCY)
+    task_done = Event()
+    install_signal_handlers()
+    tasks = {}
+    taken = 0
+
+    parent_proc = '/proc/{}'.format(parent_pid)
+
+    # run while parent is alive
+    while os.path.exists(parent_proc):
+        if not run_application:
+            break
+        left = tasks_left(config, taken)
+        if left == 0 and not len(pool):
+            log_recycle(taken)
+            break
+        free_count = pool.free_count()
+        if left is not None:
+            free_count = min(free_count, left)
+        if take_paused:
+            free_count = 0
+            if not len(pool):
+                gevent.sleep(config.QUEUE_TAKE_TIMEOUT)
+        if free_count > 0:
+            # don't block in-flight requests while waiting for new tasks
+            take_timeout = config.MULTI_TAKE_TIMEOUT if len(pool) else config.QUEUE_TAKE_TIMEOUT
+            with Timer(worker_metrics, 'checker_queue_request_seconds', request='take'):
+                new_tasks = take_tasks(input_tube, free_count, take_timeout)
+            taken += len(new_tasks)
+            worker_metrics.inc('checker_tasks_taken_total', len(new_tasks))
+            for task in new_tasks:
+                logger.info(u'Starting task id={}.'.format(task.task_id))
+                tasks[task.task_id] = task
+                pool.spawn(
+                    check_task_green, config, task, results, hop_cache, worker_metrics, timing_sink, task_done, tasks,
+                    result_cache
+                )
+
+        worker_metrics.set('checker_tasks_in_flight', len(pool), worker=os.getpid())
+        if len(pool):
+            task_done.clear()
+            task_done.wait(config.GREEN_TAKE_INTERVAL)
+        results.flush_if_due()
+        worker_metrics.push_if_due()
+        if break_func_for_test():
+            break
+    else:
+        logger.info('Parent is dead. exiting')
+    # killed greenlets leave their tasks in tasks
+    pool.kill()
+    results.flush()
+    release_in_flight(tasks.values(), worker_metrics)
+    set_curl_driver(None)
+    driver.close()
+    worker_metrics.push()
+
+
+WORKER_ENGINES = {
+    'simple': worker,
+    'multi': multi_worker,
+    'green': green_worker,
+}
+"""Обработчики задач, доступные для выбора через config.WORKER_ENGINE"""
@@ -2,17 +2,20 @@
 # coding: utf-8
 
 import argparse
-import json
 import logging
 import os
 import signal
 import sys
+from functools import partial
 from logging.config import dictConfig
 from threading import current_thread
+from time import time
 
 import gevent
 from gevent import Greenlet
 from gevent import queue as gevent_queue
+from gevent.event import Event
+from gevent.lock import Semaphore
 from gevent import sleep
 from gevent.monkey import patch_all
 from gevent.pool import Pool
@@ -20,6 +23,14 @@ import requests
 import tarantool
 import tarantool_queue
 
+from lib.cache import LRUCache
+from lib.circuit_breaker import CircuitBreaker
+from lib.host_limiter import HostLimiter, PendingTasks, get_host
+from lib.http_session import get_pool_stats, make_session
+from lib.metrics import Registry, Timer, start_metrics_server
+from lib.serializer import dumps_without, get_json_backend
+from lib.utils import ack_tasks, bury_tasks, release_tasks, take_tasks
+
 SIGNAL_EXIT_CODE_OFFSET = 128
 """Коды выхода рассчитываются как 128 + номер сигнала"""
 
@@ -29,8 +40,37 @@ run_application = True
 exit_code = 0
 """Код возврата приложения"""
 
+http_session = requests
+"""Через что отправляются уведомления, main_loop заменяет на сессию с пулом соединений"""
+
+json_dumps = get_json_backend()[1]
+"""Функция сериализации уведомлений, main_loop выбирает ее по config.JSON_BACKEND"""
+
 logger = logging.getLogger('pusher')
 
+metrics = Registry()
+"""Метрики приложения, отдаются по HTTP, если задан config.METRICS_PORT"""
+
+BULK_ACTIONS = {
+    'ack': ack_tasks,
+    'bury': bury_tasks,
+    'release': release_tasks,
+}
+"""Функции, выполняющие действие над несколькими задачами за один запрос"""
+
+PERMANENT_ERRORS = (
+    requests.exceptions.MissingSchema,
+    requests.exceptions.InvalidSchema,
+    requests.exceptions.InvalidURL,
+)
+"""Ошибки, с которыми уведомление не отправить, сколько его ни повторяй"""
+
+ACTION_COUNTERS = {
+    'ack': 'pusher_tasks_acked_total',
+    'bury': 'pusher_tasks_buried_total',
+    'release': 'pusher_tasks_released_total',
+}
+
 
 def break_func_for_test():
     return False
@@ -46,23 +86,23 @@ def notification_worker(task, task_queue, *args, **kwargs):
 
     :param task: задача
     :type task: tarantool_queue.Task
-    :param task_queue: очередь для обработанных задач
+    :param task_queue: очередь для обработанных задач, в нее кладется задача,
+                       уведомление по которой удалось отправить
     :type task_queue: gevent.queue.Queue
     :param args:
     :param kwargs:
+    :return: True - уведомление отправлено, False - не отправлено из-за ошибки,
+             которая может пройти, None - его не отправить (см. PERMANENT_ERRORS)
     """
     try:
         current_thread().name = "pusher.worker#{task_id}".format(task_id=task.task_id)
 
-        data = task.data.copy()
-
-        url = data.pop('callback_url')
-        data['id'] = task.task_id
+        url, payload = dumps_without(task.data, 'callback_url', 'id', task.task_id, json_dumps)
 
         logger.info('Send data to callback url [{url}].'.format(url=url))
 
-        response = requests.post(
-            url, data=json.dumps(data), *args, **kwargs
+        response = http_session.post(
+            url, data=payload, *args, **kwargs
         )
 
         logger.info('Callback url [{url}] response status code={status_code}.'.format(
@@ -70,33 +110,204 @@ def notification_worker(task, task_queue, *args, **kwargs):
         ))
 
         task_queue.put((task, 'ack'))
+        return True
+    except PERMANENT_ERRORS as exc:
+        logger.exception(exc)
+        return None
     except requests.RequestException as exc:
         logger.exception(exc)
-        task_queue.put((task, 'bury'))
+        return False
 
 
 def done_with_processed_tasks(task_queue):
     """
     Удаляет завешенные задачи.
 
-    :param task_queue: очередь, хранящая кортежи (объект задачи, имя действия)
+    Задачи с одинаковым действием отправляются в tarantool.queue одним запросом.
+
+    :param task_queue: очередь, хранящая кортежи (объект задачи, имя действия,
+                       аргументы действия...)
     """
     logger.debug('Send info about finished tasks to queue.')
 
+    tasks = {}
     for _ in xrange(task_queue.qsize()):
         try:
-            task, action_name = task_queue.get_nowait()
+            item = task_queue.get_nowait()
+        except gevent_queue.Empty:
+            break
+
+        task, action = item[0], item[1:]
+        logger.debug('{name} task#{task_id}.'.format(
+            name=action[0].capitalize(),
+            task_id=task.task_id
+        ))
+        tasks.setdefault(action, []).append(task)
+
+    for action, action_tasks in tasks.iteritems():
+        try:
+            with Timer(metrics, 'pusher_queue_request_seconds', request=action[0]):
+                done = BULK_ACTIONS[action[0]](action_tasks, *action[1:])
+        except tarantool.DatabaseError as exc:
+            logger.exception(exc)
+            continue
+        metrics.inc(ACTION_COUNTERS[action[0]], len(done))
+
 
-            logger.debug('{name} task#{task_id}.'.format(
-                name=action_name.capitalize(),
-                task_id=task.task_id
+def worker_finished(host_limiter, circuit_breaker, task_queue, task, host, started, worker_done, failures,
+                    max_failures, worker):
+    """
+    Освобождает место, занятое обработчиком у хоста, и сообщает
+    основному циклу о завершении обработчика.
+
+    Если уведомление не отправить (неверный callback_url, обработчик упал),
+    задача сразу хоронится, а хосту это не засчитывается. Если отправить
+    не удалось, задача возвращается в tarantool.queue с задержкой, которую
+    назначил размыкатель цепи хоста, или хоронится, если это max_failures-я
+    неудачная отправка. Неудачи считаются в failures (LRUCache по task_id):
+    возвраты задачи без отправки (хост занят, цепь разомкнута) в них не входят.
+    """
+    sent = worker.value
+    latency = time() - started
+    metrics.observe('pusher_http_seconds', latency)
+    host_limiter.release(host, latency, sent is False)
+    if sent:
+        circuit_breaker.success(host)
+    elif sent is None:
+        circuit_breaker.cancel(host)
+        logger.info('Bury task id={task_id}, its callback can not be sent.'.format(task_id=task.task_id))
+        task_queue.put((task, 'bury'))
+    else:
+        delay = circuit_breaker.failure(host)
+        failed = (failures.get(task.task_id) or 0) + 1
+        if failed >= max_failures:
+            logger.info('Bury task id={task_id} failed {failed} times, host [{host}] circuit is {state}.'.format(
+                task_id=task.task_id, failed=failed, host=host, state=circuit_breaker.state(host)
             ))
-            try:
-                getattr(task, action_name)()
-            except tarantool.DatabaseError as exc:
-                logger.exception(exc)
+            task_queue.put((task, 'bury'))
+        else:
+            failures.set(task.task_id, failed)
+            logger.info('Release task id={task_id} for {delay} s, host [{host}] circuit is {state}.'.format(
+                task_id=task.task_id, delay=delay, host=host, state=circuit_breaker.state(host)
+            ))
+            task_queue.put((task, 'release', delay))
+    worker_done.set()
+
+
+class Dispatcher(object):
+    """
+    Запускает обработчики задач с учетом состояния хостов callback_url.
+
+    Если цепь хоста разомкнута (см. CircuitBreaker), задача возвращается
+    в tarantool.queue до пробного запроса к хосту. Если к хосту уже выполняется
+    максимум запросов (см. HostLimiter), задача ждет в pending, пока
+    worker_finished не освободит место (см. drain); не поместившиеся в pending
+    и прождавшие слишком долго задачи возвращаются в tarantool.queue
+    на config.HOST_BUSY_RELEASE_DELAY секунд. Возвраты отправляются пачками
+    через task_queue.
+    """
+
+    def __init__(self, config, worker_pool, host_limiter, circuit_breaker, pending, failures, task_queue,
+                 worker_done):
+        self.config = config
+        self.worker_pool = worker_pool
+        self.host_limiter = host_limiter
+        self.circuit_breaker = circuit_breaker
+        self.pending = pending
+        self.failures = failures
+        self.task_queue = task_queue
+        self.worker_done = worker_done
+
+    def add(self, tasks):
+        """Запускает обработчики взятых задач, задачи занятых хостов откладывает"""
+        for task in tasks:
+            host = get_host(task.data.get('callback_url', ''))
+            if not self.dispatch(task, host) and not self.pending.add(host, task):
+                self.release_busy(task, host)
+
+    def drain(self):
+        """Запускает обработчики отложенных задач хостов, у которых освободилось место"""
+        for task in self.pending.expired():
+            self.release_busy(task, get_host(task.data.get('callback_url', '')))
+        for host in self.pending.hosts.keys():
+            while self.worker_pool.free_count() and host in self.pending.hosts:
+                if not self.dispatch(self.pending.first(host), host):
+                    break
+                self.pending.pop(host)
+
+    def dispatch(self, task, host):
+        """
+        :return: False, если к хосту уже выполняется максимум запросов и задача осталась у вызвавшего
+        """
+        if not self.circuit_breaker.allow(host):
+            delay = self.circuit_breaker.retry_delay(host)
+            logger.info('Host [{host}] circuit is open, release task id={task_id} for {delay} s.'.format(
+                host=host, task_id=task.task_id, delay=delay
+            ))
+            self.task_queue.put((task, 'release', delay))
+            return True
+        if not self.host_limiter.acquire(host):
+            # the task is not sent, so it is not the half-open circuit probe
+            self.circuit_breaker.cancel(host)
+            return False
+
+        logger.info('Start worker for task id={task_id}.'.format(task_id=task.task_id))
+        worker = Greenlet(
+            notification_worker,
+            task,
+            self.task_queue,
+            timeout=self.config.HTTP_CONNECTION_TIMEOUT,
+            verify=False
+        )
+        self.worker_pool.add(worker)
+        worker.link(partial(
+            worker_finished, self.host_limiter, self.circuit_breaker, self.task_queue,
+            task, host, time(), self.worker_done, self.failures, self.config.MAX_TASK_FAILURES
+        ))
+        worker.start()
+        return True
+
+    def release_busy(self, task, host):
+        logger.info('Host [{host}] is busy, release task id={task_id} for {delay} s.'.format(
+            host=host, task_id=task.task_id, delay=self.config.HOST_BUSY_RELEASE_DELAY
+        ))
+        self.task_queue.put((task, 'release', self.config.HOST_BUSY_RELEASE_DELAY))
+
+    def release_pending(self):
+        """Возвращает в tarantool.queue все отложенные задачи, например при остановке"""
+        for task in self.pending.pop_all():
+            self.task_queue.put((task, 'release', 0))
+
+
+def log_http_pool_stats(session):
+    """
+    Пишет в лог попадания и промахи пулов соединений сессии по хостам.
+    """
+    for (scheme, host, port), (hits, misses) in sorted(get_pool_stats(session).items()):
+        logger.info('HTTP pool {scheme}://{host}:{port} hits={hits} misses={misses}.'.format(
+            scheme=scheme, host=host, port=port, hits=hits, misses=misses
+        ))
+
+
+def processed_tasks_worker(task_queue, queue_lock, stopped, timeout):
+    """
+    Обработчик завершенных задач: как только в очереди появляются задачи,
+    отправляет в tarantool.queue все накопившиеся к этому моменту.
+
+    :param task_queue: очередь, хранящая кортежи (объект задачи, имя действия)
+    :param queue_lock: блокировка соединения с tarantool.queue
+    :param stopped: событие остановки обработчика
+    :param timeout: как часто проверять stopped, если завершенных задач нет
+    """
+    current_thread().name = 'pusher.acker'
+
+    while not stopped.is_set():
+        try:
+            task_queue.peek(timeout=timeout)
         except gevent_queue.Empty:
-            break
+            continue
+        with queue_lock:
+            done_with_processed_tasks(task_queue)
 
 
 def stop_handler(signum):
@@ -126,12 +337,18 @@ def main_loop(config):
 
     Алгоритм:
      * Открываем соединение с tarantool.queue, использую config.QUEUE_* настройки.
-     * Создаем пул обработчиков.
-     * Создаем очередь куда обработчики будут помещать выполненные задачи.
-     * Пока количество обработчиков <= config.WORKER_POOL_SIZE, берем задачу из tarantool.queue
-       и запускаем greenlet для ее обработки.
-     * Посылаем уведомления о том, что задачи завершены в tarantool.queue.
-     * Спим config.SLEEP секунд.
+     * Создаем пул обработчиков и общую для них HTTP-сессию с пулом соединений.
+     * Создаем очередь куда обработчики будут помещать выполненные задачи
+       и запускаем greenlet, который сразу отправляет их в tarantool.queue.
+     * Запускаем обработчики отложенных задач хостов, у которых освободилось место.
+     * Берем из tarantool.queue одним запросом задачи на все свободные места в пуле
+       обработчиков и для каждой запускаем greenlet, если хост callback_url задачи
+       это позволяет (см. Dispatcher). Задачи, уведомление по которым
+       не отправить, сразу хоронятся, а задачи, отправить которые
+       не удалось config.MAX_TASK_FAILURES раз, хоронятся после последней ошибки.
+     * Если свободных мест нет или ни одна из взятых задач не запущена,
+       ждем завершения любого из обработчиков, но не дольше config.SLEEP секунд.
+     * При остановке отложенные задачи возвращаются в tarantool.queue.
     """
     logger.info('Connect to queue server on {host}:{port} space #{space}.'.format(
         host=config.QUEUE_HOST, port=config.QUEUE_PORT, space=config.QUEUE_SPACE
@@ -139,6 +356,9 @@ def main_loop(config):
     queue = tarantool_queue.Queue(
         host=config.QUEUE_HOST, port=config.QUEUE_PORT, space=config.QUEUE_SPACE
     )
+    # take and ack requests share one connection: only the consumer
+    # that took a task can ack it
+    queue_lock = Semaphore()
 
     logger.info('Use tube [{tube}], take timeout={take_timeout}.'.format(
         tube=config.QUEUE_TUBE,
@@ -149,46 +369,77 @@ def main_loop(config):
 
     logger.info('Create worker pool[{size}].'.format(size=config.WORKER_POOL_SIZE))
     worker_pool = Pool(config.WORKER_POOL_SIZE)
+    worker_done = Event()
+    host_limiter = HostLimiter(config.HOST_MAX_CONCURRENCY, latency_threshold=config.HOST_LATENCY_THRESHOLD)
+    circuit_breaker = CircuitBreaker(
+        config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_BASE_DELAY, config.CIRCUIT_MAX_DELAY
+    )
+    pending = PendingTasks(config.HOST_MAX_PENDING, config.HOST_PENDING_TIMEOUT)
+    failures = LRUCache(config.TASK_FAILURES_CACHE_SIZE, config.TASK_FAILURES_TTL)
+
+    global http_session
+    http_session = make_session(config.WORKER_POOL_SIZE, config.HTTP_POOL_HOSTS, config.HTTP_HOST_POOL_SIZE)
+
+    global json_dumps
+    backend, json_dumps = get_json_backend(config.JSON_BACKEND)
+    logger.info('Use {backend} to serialize notifications.'.format(backend=backend))
+    stats_logged_at = time()
 
     processed_task_queue = gevent_queue.Queue()
+    acker_stopped = Event()
+    acker = Greenlet(
+        processed_tasks_worker, processed_task_queue, queue_lock, acker_stopped, config.SLEEP
+    )
+    acker.start()
+    dispatcher = Dispatcher(
+        config, worker_pool, host_limiter, circuit_breaker, pending, failures, processed_task_queue, worker_done
+    )
 
     logger.info('Run main loop. Worker pool size={count}. Sleep time is {sleep}.'.format(
         count=config.WORKER_POOL_SIZE, sleep=config.SLEEP
     ))
 
-    while run_application:
-        free_workers_count = worker_pool.free_count()
-
-        logger.debug('Pool has {count} free workers.'.format(count=free_workers_count))
-
-        for number in xrange(free_workers_count):
-            logger.debug('Get task from tube for worker#{number}.'.format(number=number))
-
-            task = tube.take(config.QUEUE_TAKE_TIMEOUT)
-
-            if task:
-                logger.info('Start worker#{number} for task id={task_id}.'.format(
-                    task_id=task.task_id, number=number
-                ))
-
-                worker = Greenlet(
-                    notification_worker,
-                    task,
-                    processed_task_queue,
-                    timeout=config.HTTP_CONNECTION_TIMEOUT,
-                    verify=False
-                )
-                worker_pool.add(worker)
-                worker.start()
-
+    try:
+        while run_application:
+            dispatcher.drain()
+            free_workers_count = worker_pool.free_count()
+
+            logger.debug('Pool has {count} free workers.'.format(count=free_workers_count))
+
+            if free_workers_count:
+                logger.debug('Get up to {count} tasks from tube.'.format(count=free_workers_count))
+
+                with queue_lock, Timer(metrics, 'pusher_queue_request_seconds', request='take'):
+                    tasks = take_tasks(tube, free_workers_count, config.QUEUE_TAKE_TIMEOUT)
+                # the lock is free again, but the acker waiting for it only wakes up on a switch:
+                # without it an idle tube is taken over and over and acks wait for new tasks
+                sleep(0)
+                metrics.inc('pusher_tasks_taken_total', len(tasks))
+                dispatcher.add(tasks)
+
+            if not free_workers_count or (tasks and worker_pool.free_count() == free_workers_count):
+                # when only busy or failing hosts are left, they are not taken again at once
+                worker_done.clear()
+                worker_done.wait(config.SLEEP)
+
+            metrics.set('pusher_workers_in_flight', len(worker_pool))
+            metrics.set('pusher_pool_saturation', float(len(worker_pool)) / config.WORKER_POOL_SIZE)
+            metrics.set('pusher_tasks_pending', len(pending))
+
+            if time() - stats_logged_at >= config.HTTP_POOL_STATS_INTERVAL:
+                log_http_pool_stats(http_session)
+                stats_logged_at = time()
+
+            if break_func_for_test():
+                break
+        else:
+            logger.info('Stop application loop.')
+    finally:
+        dispatcher.release_pending()
+        acker_stopped.set()
+        acker.join()
         done_with_processed_tasks(processed_task_queue)
 
-        sleep(config.SLEEP)
-        if break_func_for_test():
-            break
-    else:
-        logger.info('Stop application loop.')
-
 
 def parse_cmd_args(args):
     """
@@ -328,6 +579,10 @@ def main(argv):
 
     install_signal_handlers()
 
+    if config.METRICS_PORT:
+        start_metrics_server(config.METRICS_HOST, config.METRICS_PORT, metrics.render)
+        logger.info('Serve metrics on {host}:{port}.'.format(host=config.METRICS_HOST, port=config.METRICS_PORT))
+
     while run_application and while_is_workig():
         try:
             main_loop(config)
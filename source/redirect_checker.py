@@ -1,51 +1,221 @@
 #!/usr/bin/env python2.7
 # coding: utf-8
+import gc
 import logging
 import os
+import signal
 import sys
 from logging.config import dictConfig
 from multiprocessing import active_children
-from time import sleep
+from time import time
 
-from lib.utils import (check_network_status, create_pidfile, daemonize,
-                       load_config_from_pyfile, parse_cmd_args, spawn_workers)
-from lib.worker import worker
+from lib import set_domain_rules, warm_up
+from lib.cache import start_cache_manager
+from lib.domain_rules import DomainRules
+from lib.health import HealthMonitor
+from lib.metrics import start_metrics_server
+from lib.utils import (ChildWatcher, RespawnBackoff, create_pidfile, daemonize, load_config_from_pyfile,
+                       parse_cmd_args, spawn_workers)
+from lib.worker import WORKER_ENGINES
 
 logger = logging.getLogger('redirect_checker')
 
+run_application = True
+"""Флаг, определяющий, должно ли приложение продолжать работу."""
+
+workers_paused = False
+"""Флаг, запрещающий обработчикам брать новые задачи (SIGUSR1 ставит, SIGUSR2 снимает)."""
+
 
 def break_func_for_test():
     return False
 
 
+def get_workers(manager=None):
+    """
+    Возвращает живые процессы-обработчики (без процесса менеджера разделяемых кэшей)
+    """
+    if manager is None:
+        return active_children()
+    return [c for c in active_children() if c.pid != manager._process.pid]
+
+
+def update_pool_metrics(metrics, workers, pool_size):
+    """
+    Обновляет метрики пула обработчиков: забывает завершившиеся обработчики
+    и считает загрузку пула - долю занятых мест под задачи во всех обработчиках.
+    """
+    metrics.retain('worker', [w.pid for w in workers])
+    metrics.set('checker_workers', len(workers))
+    metrics.set('checker_worker_pool_size', pool_size)
+    capacity = metrics.sum('checker_worker_capacity')
+    in_flight = metrics.sum('checker_tasks_in_flight')
+    metrics.set('checker_pool_saturation', float(in_flight) / capacity if capacity else 0.0)
+
+
+def stop_workers(child_watcher, timeout, manager=None):
+    """
+    Останавливает обработчики: посылает им SIGTERM и ждет не дольше timeout
+    секунд, пока они вернут взятые задачи в очередь или доделают их.
+    Не завершившиеся за это время обработчики убиваются SIGKILL.
+    """
+    workers = get_workers(manager)
+    for c in workers:
+        c.terminate()
+    deadline = time() + timeout
+    while workers and time() < deadline:
+        child_watcher.wait(deadline - time())
+        workers = get_workers(manager)
+    for c in workers:
+        logger.warning(u'Worker pid={} is not stopped in {} seconds. killing it'.format(c.pid, timeout))
+        os.kill(c.pid, signal.SIGKILL)
+
+
+def signal_workers(signum, manager=None):
+    for c in get_workers(manager):
+        os.kill(c.pid, signum)
+
+
 def main_loop(config):
-    global run_main_loop
+    """
+    Поддерживает config.WORKER_POOL_SIZE процессов-обработчиков.
+
+    Доступность сети проверяет в фоне HealthMonitor, пока сети нет,
+    обработчики приостанавливаются, как по SIGUSR1. Пока обработчики
+    приостановлены, новые не запускаются. Завершившийся обработчик (например, взявший
+    config.MAX_TASKS_PER_CHILD задач) перезапускается сразу по SIGCHLD, а завершающиеся
+    вскоре после запуска - с нарастающей задержкой (см. RespawnBackoff).
+    Обработчики запускаются fork'ом после warm_up, поэтому загруженные
+    модули и скомпилированные регулярные выражения у них общие с родителем.
+    """
     logger.info(
-        u'Run main loop. Worker pool size={}. Sleep time is {}.'.format(
-            config.WORKER_POOL_SIZE, config.SLEEP
+        u'Run main loop. Worker pool size={}. Worker engine={}. Sleep time is {}.'.format(
+            config.WORKER_POOL_SIZE, config.WORKER_ENGINE, config.SLEEP
         ))
     parent_pid = os.getpid()
-    while True:
-        if check_network_status(config.CHECK_URL, config.HTTP_TIMEOUT):
-            required_workers_count = config.WORKER_POOL_SIZE - len(
-                active_children())
-            if required_workers_count > 0:
+
+    manager = None
+    hop_cache = None
+    if config.HOP_CACHE_SIZE > 0:
+        manager = start_cache_manager()
+        hop_cache = manager.HopCache(config.HOP_CACHE_SIZE, config.HOP_CACHE_TTL)
+        logger.info(u'Hop cache size={} ttl={}.'.format(config.HOP_CACHE_SIZE, config.HOP_CACHE_TTL))
+
+    result_cache = None
+    if config.RESULT_CACHE_SIZE > 0:
+        if manager is None:
+            manager = start_cache_manager()
+        result_cache = manager.ResultCache(
+            config.RESULT_CACHE_SIZE, config.RESULT_CACHE_TTL, config.RESULT_CACHE_CLAIM_TTL
+        )
+        logger.info(u'Result cache size={} ttl={}.'.format(config.RESULT_CACHE_SIZE, config.RESULT_CACHE_TTL))
+
+    metrics = None
+    if config.METRICS_PORT:
+        if manager is None:
+            manager = start_cache_manager()
+        metrics = manager.MetricsRegistry()
+        start_metrics_server(config.METRICS_HOST, config.METRICS_PORT, metrics.render)
+        logger.info(u'Serve metrics on {}:{}.'.format(config.METRICS_HOST, config.METRICS_PORT))
+
+    health = HealthMonitor(
+        config.HEALTH_PROBE_URLS, config.HTTP_TIMEOUT, config.HEALTH_INTERVAL,
+        config.HEALTH_WINDOW, config.HEALTH_DOWN_RATIO, config.HEALTH_UP_RATIO, config.HEALTH_QUORUM
+    )
+    health.start()
+    warm_up()
+    # objects freed before fork are not collected (and their pages not touched) in every worker
+    gc.collect()
+    child_watcher = ChildWatcher()
+    backoff = RespawnBackoff(config.RESPAWN_MIN_LIFETIME, config.RESPAWN_DELAY, config.RESPAWN_MAX_DELAY)
+    ticked_at = None
+    network_is_up = True
+    paused = False
+
+    while run_application:
+        if ticked_at is None or time() - ticked_at >= config.SLEEP:
+            ticked_at = time()
+            if hop_cache is not None:
+                logger.info(u'Hop cache stats: {}'.format(hop_cache.stats()))
+            if result_cache is not None:
+                logger.info(u'Result cache stats: {}'.format(result_cache.stats()))
+
+        if network_is_up != health.up:
+            network_is_up = health.up
+            if network_is_up:
+                logger.info('Network is up')
+            else:
+                logger.critical('Network is down. pausing workers')
+
+        if paused != (workers_paused or not network_is_up):
+            paused = not paused
+            logger.info('{} workers'.format('Pausing' if paused else 'Resuming'))
+            signal_workers(signal.SIGUSR1 if paused else signal.SIGUSR2, manager)
+        elif paused:
+            # workers forked right before the pause ignored the first signal
+            signal_workers(signal.SIGUSR1, manager)
+
+        workers = get_workers(manager)
+        backoff.update([worker.pid for worker in workers])
+        wake_at = ticked_at + config.SLEEP
+        if not paused:
+            required_workers_count = config.WORKER_POOL_SIZE - len(workers)
+            spawn_at = backoff.spawn_at()
+            if required_workers_count > 0 and time() < spawn_at:
+                logger.warning('Workers exit right after start, spawning {} workers in {:.1f}s'.format(
+                    required_workers_count, spawn_at - time()))
+                wake_at = min(wake_at, spawn_at)
+            elif required_workers_count > 0:
                 logger.info(
                     'Spawning {} workers'.format(required_workers_count))
-                spawn_workers(
+                backoff.spawned(spawn_workers(
                     num=required_workers_count,
-                    target=worker,
+                    target=WORKER_ENGINES[config.WORKER_ENGINE],
                     args=(config,),
-                    parent_pid=parent_pid
-                )
-        else:
-            logger.critical('Network is down. stopping workers')
-            for c in active_children():
-                c.terminate()
-
-        sleep(config.SLEEP)
+                    parent_pid=parent_pid,
+                    kwargs={'hop_cache': hop_cache, 'metrics': metrics, 'result_cache': result_cache}
+                ))
+
+        if metrics is not None:
+            update_pool_metrics(metrics, get_workers(manager), config.WORKER_POOL_SIZE)
+            metrics.set('checker_network_up', int(network_is_up))
+
+        # wakes up at once when a worker exits
+        child_watcher.wait(wake_at - time())
         if break_func_for_test():
             break
+    else:
+        logger.info('Stopping workers')
+        stop_workers(child_watcher, config.DRAIN_TIMEOUT, manager)
+
+    health.stop()
+    child_watcher.close()
+    if manager is not None:
+        manager.shutdown()
+
+
+def stop_handler(signum, frame):
+    global run_application
+    logger.info('Got signal #{}.'.format(signum))
+    run_application = False
+
+
+def pause_handler(signum, frame):
+    global workers_paused
+    workers_paused = signum == signal.SIGUSR1
+
+
+def install_signal_handlers():
+    """
+    Устанавливает обработчики сигналов остановки и паузы.
+
+    Сигналы только меняют флаги и будят main_loop (см. ChildWatcher),
+    системные вызовы ими не прерываются.
+    """
+    for signum, handler in ((signal.SIGTERM, stop_handler), (signal.SIGINT, stop_handler),
+                            (signal.SIGUSR1, pause_handler), (signal.SIGUSR2, pause_handler)):
+        signal.signal(signum, handler)
+        signal.siginterrupt(signum, False)
 
 
 def main(argv):
@@ -60,6 +230,9 @@ def main(argv):
         os.path.realpath(os.path.expanduser(args.config))
     )
     dictConfig(config.LOGGING)
+    # workers inherit the rules on fork
+    set_domain_rules(DomainRules(config.DOMAIN_RULES))
+    install_signal_handlers()
     main_loop(config)
 
     return config.EXIT_CODE
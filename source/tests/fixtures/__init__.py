@@ -0,0 +1,20 @@
+# coding: utf-8
+import os
+
+FIXTURES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def fixture_path(*path):
+    return os.path.join(FIXTURES_DIR, *path)
+
+
+def read_fixtures(dirname):
+    """
+    Возвращает пары (имя файла, содержимое) для всех фикстур из директории
+    """
+    directory = fixture_path(dirname)
+    fixtures = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name)) as f:
+            fixtures.append((name, f.read()))
+    return fixtures
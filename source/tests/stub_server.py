@@ -0,0 +1,53 @@
+# coding: utf-8
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Отвечает через server.delay секунд: на GET /redirect* - редиректом на /end,
+    на остальные GET - страницей со счетчиком, на POST - пустым ответом 200.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        if self.path.startswith('/redirect'):
+            self.send_response(302)
+            self.send_header('Location', '/end')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = '<html><head></head><body>google-analytics.com/ga.js</body></html>'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Локальный HTTP-сервер для тестов, обслуживающий каждый запрос в своем потоке
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, delay):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.delay = delay
+        self.url = 'http://127.0.0.1:{}/'.format(self.server_address[1])
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
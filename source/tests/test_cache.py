@@ -0,0 +1,183 @@
+from threading import Thread
+import unittest
+from mock import patch, Mock
+from lib import cache
+
+
+class CacheTestCase(unittest.TestCase):
+    def test_get_miss(self):
+        lru = cache.LRUCache(2, 60)
+        self.assertEqual(lru.get('key'), None)
+        self.assertEqual(lru.stats(), {'size': 0, 'hits': 0, 'misses': 1})
+
+    def test_get_hit(self):
+        lru = cache.LRUCache(2, 60)
+        lru.set('key', ('url', 'http_status'))
+        self.assertEqual(lru.get('key'), ('url', 'http_status'))
+        self.assertEqual(lru.stats(), {'size': 1, 'hits': 1, 'misses': 0})
+
+    def test_get_expired(self):
+        lru = cache.LRUCache(2, 60)
+        with patch('lib.cache.time', Mock(return_value=100)):
+            lru.set('key', 'value')
+        with patch('lib.cache.time', Mock(return_value=161)):
+            self.assertEqual(lru.get('key'), None)
+        self.assertEqual(lru.stats()['size'], 0)
+
+    def test_set_evicts_least_recently_used(self):
+        lru = cache.LRUCache(2, 60)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertEqual(lru.get('c'), 3)
+
+    def test_concurrent_get_set(self):
+        lru = cache.LRUCache(16, 60)
+        errors = []
+
+        def run(offset):
+            try:
+                for i in xrange(5000):
+                    lru.set((offset + i) % 32, i)
+                    lru.get((offset + i * 7) % 32)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [Thread(target=run, args=(offset,)) for offset in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        stats = lru.stats()
+        # no counter update is lost
+        self.assertEqual(stats['hits'] + stats['misses'], 8 * 5000)
+        self.assertLessEqual(stats['size'], 16)
+
+    def test_start_cache_manager(self):
+        manager = Mock()
+        with patch('lib.cache.CacheManager', Mock(return_value=manager)):
+            self.assertEqual(cache.start_cache_manager(), manager)
+        self.assertTrue(manager.start.called)
+
+    def test_shared_between_processes(self):
+        manager = cache.start_cache_manager()
+        try:
+            hops = manager.HopCache(10, 60)
+            hops.set('key', ('url', 'meta_tag'))
+            self.assertEqual(hops.get('key'), ('url', 'meta_tag'))
+            self.assertEqual(hops.follow('key', 5), [('url', 'meta_tag')])
+            self.assertEqual(hops.stats()['hits'], 2)
+        finally:
+            manager.shutdown()
+
+    def test_hop_cache_follow(self):
+        hops = cache.HopCache(10, 60)
+        hops.set('a', ('b', 'http_status'))
+        hops.set('b', ('c', 'meta_tag'))
+        self.assertEqual(hops.follow('a', 5), [('b', 'http_status'), ('c', 'meta_tag')])
+        self.assertEqual(hops.follow('a', 1), [('b', 'http_status')])
+        self.assertEqual(hops.follow('c', 5), [])
+
+    def test_hop_cache_follow_loop_stops_at_limit(self):
+        hops = cache.HopCache(10, 60)
+        hops.set('a', ('b', 'http_status'))
+        hops.set('b', ('a', 'http_status'))
+        self.assertEqual(len(hops.follow('a', 3)), 3)
+
+    def test_hop_cache_remember_returns_continuation(self):
+        hops = cache.HopCache(10, 60)
+        hops.set('b', ('c', 'meta_tag'))
+        self.assertEqual(hops.remember('a', ('b', 'http_status'), 5), [('c', 'meta_tag')])
+        self.assertEqual(hops.get('a'), ('b', 'http_status'))
+
+    def test_hop_cache_remember_skips_cached_hop(self):
+        hops = cache.HopCache(10, 60)
+        hops.set('a', ('b', 'http_status'))
+        with patch.object(hops, 'set', Mock()) as set_hop:
+            self.assertEqual(hops.remember('a', ('b', 'http_status'), 5), [])
+        self.assertFalse(set_hop.called)
+        hops.remember('a', ('c', 'http_status'), 5)
+        self.assertEqual(hops.get('a'), ('c', 'http_status'))
+
+    def test_result_cache_claim_check_and_hit(self):
+        results = cache.ResultCache(10, 60, 30)
+        self.assertEqual(results.claim('url'), (None, True))
+        # another task with the same url waits for the result
+        self.assertEqual(results.claim('url'), (None, False))
+        self.assertEqual(results.stats()['in_flight'], 1)
+        results.complete('url', ['history'])
+        self.assertEqual(results.claim('url'), (['history'], False))
+        self.assertEqual(results.stats(), {'size': 1, 'hits': 1, 'misses': 2, 'in_flight': 0})
+
+    def test_result_cache_result_older_than_since(self):
+        results = cache.ResultCache(10, 60, 30)
+        with patch('lib.cache.time', Mock(return_value=100)):
+            results.complete('url', ['ERROR'])
+            self.assertEqual(results.claim('url', since=100), (['ERROR'], False))
+            self.assertEqual(results.claim('url', since=101), (None, True))
+
+    def test_result_cache_claim_expires(self):
+        results = cache.ResultCache(10, 60, 30)
+        with patch('lib.cache.time', Mock(return_value=100)):
+            self.assertEqual(results.claim('url'), (None, True))
+        with patch('lib.cache.time', Mock(return_value=129)):
+            self.assertEqual(results.claim('url'), (None, False))
+        # the checking worker died, so the url is checked again
+        with patch('lib.cache.time', Mock(return_value=131)):
+            self.assertEqual(results.claim('url'), (None, True))
+
+    def test_result_cache_release(self):
+        results = cache.ResultCache(10, 60, 30)
+        results.claim('url1')
+        results.claim('url2')
+        results.release(['url1', 'url2'])
+        self.assertEqual(results.claim('url1'), (None, True))
+        self.assertEqual(results.stats()['in_flight'], 1)
+
+    def test_result_cache_shared_between_processes(self):
+        manager = cache.start_cache_manager()
+        try:
+            results = manager.ResultCache(10, 60, 30)
+            self.assertEqual(results.claim('url'), (None, True))
+            results.complete('url', (['ERROR'], ['url'], []))
+            self.assertEqual(results.claim('url'), ((['ERROR'], ['url'], []), False))
+        finally:
+            manager.shutdown()
+
+    def test_memoize_evicts_least_recently_used(self):
+        calls = []
+
+        def func(key):
+            calls.append(key)
+            return key * 2
+
+        memoized = cache.memoize(2)(func)
+        self.assertEqual(memoized(1), 2)
+        memoized(2)
+        memoized(1)
+        memoized(3)
+        # 2 was used least recently
+        memoized(1)
+        memoized(3)
+        memoized(2)
+        self.assertEqual(calls, [1, 2, 3, 2])
+
+    def test_memoize_does_not_remember_errors(self):
+        results = [ValueError, 'value', 'new value']
+
+        def func(key):
+            result = results.pop(0)
+            if result is ValueError:
+                raise ValueError
+            return result
+
+        memoized = cache.memoize(2)(func)
+        self.assertRaises(ValueError, memoized, 'key')
+        self.assertEqual(memoized('key'), 'value')
+        self.assertEqual(memoized('key'), 'value')
+        memoized.clear()
+        self.assertEqual(memoized('key'), 'new value')
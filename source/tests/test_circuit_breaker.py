@@ -0,0 +1,68 @@
+import unittest
+from mock import patch, Mock
+from lib.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+    def get_breaker(self):
+        return CircuitBreaker(failure_threshold=2, base_delay=10, max_delay=30)
+
+    def test_closed_until_threshold(self):
+        breaker = self.get_breaker()
+        with patch('lib.circuit_breaker.time', Mock(return_value=100)):
+            self.assertEqual(breaker.failure('a.ru'), 10)
+            self.assertEqual(breaker.state('a.ru'), CLOSED)
+            self.assertTrue(breaker.allow('a.ru'))
+
+    def test_opens_after_threshold(self):
+        breaker = self.get_breaker()
+        with patch('lib.circuit_breaker.time', Mock(return_value=100)):
+            breaker.failure('a.ru')
+            self.assertEqual(breaker.failure('a.ru'), 20)
+            self.assertEqual(breaker.state('a.ru'), OPEN)
+            self.assertFalse(breaker.allow('a.ru'))
+            self.assertTrue(breaker.allow('b.ru'))
+        with patch('lib.circuit_breaker.time', Mock(return_value=105.5)):
+            self.assertEqual(breaker.retry_delay('a.ru'), 15)
+
+    def test_half_open_single_probe(self):
+        breaker = self.get_breaker()
+        with patch('lib.circuit_breaker.time', Mock(return_value=100)):
+            breaker.failure('a.ru')
+            breaker.failure('a.ru')
+        with patch('lib.circuit_breaker.time', Mock(return_value=120)):
+            self.assertEqual(breaker.state('a.ru'), HALF_OPEN)
+            self.assertTrue(breaker.allow('a.ru'))
+            self.assertFalse(breaker.allow('a.ru'))
+            self.assertEqual(breaker.retry_delay('a.ru'), 10)
+
+    def test_failed_probe_doubles_delay(self):
+        breaker = self.get_breaker()
+        with patch('lib.circuit_breaker.time', Mock(return_value=100)):
+            breaker.failure('a.ru')
+            breaker.failure('a.ru')
+        with patch('lib.circuit_breaker.time', Mock(return_value=120)):
+            breaker.allow('a.ru')
+            self.assertEqual(breaker.failure('a.ru'), 30)
+            self.assertEqual(breaker.state('a.ru'), OPEN)
+            self.assertEqual(breaker.failure('a.ru'), 30)
+
+    def test_successful_probe_closes(self):
+        breaker = self.get_breaker()
+        breaker.failure('a.ru')
+        breaker.failure('a.ru')
+        breaker.success('a.ru')
+        self.assertEqual(breaker.state('a.ru'), CLOSED)
+        self.assertEqual(breaker.retry_delay('a.ru'), 10)
+
+    def test_cancelled_probe_allows_next_probe(self):
+        breaker = self.get_breaker()
+        with patch('lib.circuit_breaker.time', Mock(return_value=100)):
+            breaker.failure('a.ru')
+            breaker.failure('a.ru')
+        with patch('lib.circuit_breaker.time', Mock(return_value=120)):
+            self.assertTrue(breaker.allow('a.ru'))
+            breaker.cancel('a.ru')
+            self.assertEqual(breaker.state('a.ru'), HALF_OPEN)
+            self.assertTrue(breaker.allow('a.ru'))
+        self.assertEqual(breaker.hosts['a.ru'].failures, 2)
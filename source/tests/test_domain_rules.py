@@ -0,0 +1,77 @@
+import timeit
+import unittest
+from mock import patch
+import lib
+from lib import RedirectHistory, process_response
+from lib.domain_rules import DEFAULT_RULES, IGNORE_REDIRECT, SKIP_TASK, STOP_CHAIN, DomainRules
+
+
+class DomainRulesTestCase(unittest.TestCase):
+    def test_default_rules(self):
+        rules = DomainRules()
+        self.assertTrue(rules.match(u'http://odnoklassniki.ru/group/1', SKIP_TASK))
+        self.assertTrue(rules.match('https://WWW.Odnoklassniki.RU/', SKIP_TASK))
+        self.assertFalse(rules.match('http://m.odnoklassniki.ru/', SKIP_TASK))
+        self.assertTrue(rules.match('http://my.mail.ru/APPS/42', SKIP_TASK))
+        self.assertFalse(rules.match('http://my.mail.ru/community/42', SKIP_TASK))
+        self.assertTrue(rules.match('http://www.odnoklassniki.ru/dk?st.cmd=a&st.redirect=1', IGNORE_REDIRECT))
+        self.assertFalse(rules.match('http://www.odnoklassniki.ru/dk?st.cmd=a', IGNORE_REDIRECT))
+        self.assertFalse(rules.match('http://www.odnoklassniki.ru/', STOP_CHAIN))
+
+    def test_suffix_rule(self):
+        rules = DomainRules([{'type': STOP_CHAIN, 'host': '.ads.example.com'}])
+        self.assertTrue(rules.match('http://ads.example.com/', STOP_CHAIN))
+        self.assertTrue(rules.match('http://a.b.ads.example.com./x', STOP_CHAIN))
+        self.assertTrue(rules.match('http://user@a.ads.example.com:8080/x', STOP_CHAIN))
+        self.assertFalse(rules.match('http://badads.example.com/', STOP_CHAIN))
+        self.assertFalse(rules.match('http://example.com/', STOP_CHAIN))
+        self.assertFalse(rules.match('ftp://ads.example.com/', STOP_CHAIN))
+        self.assertFalse(rules.match('/relative', STOP_CHAIN))
+        self.assertFalse(rules.match(None, STOP_CHAIN))
+
+    def test_unknown_type(self):
+        self.assertRaises(ValueError, DomainRules, [{'type': 'drop', 'host': 'a.ru'}])
+
+    def test_lookup_does_not_depend_on_rule_count(self):
+        url = 'http://www.shop.example.com/item?id=1'
+        small = DomainRules([{'type': STOP_CHAIN, 'host': '.example.com'}])
+        large = DomainRules([{'type': STOP_CHAIN, 'host': '.example.com'}] + [
+            {'type': STOP_CHAIN, 'host': '.domain{}.com'.format(i), 'contains': 'x'} for i in xrange(20000)
+        ])
+        self.assertEqual(len(large), 20001)
+        self.assertTrue(large.match(url, STOP_CHAIN))
+        small_time = min(timeit.repeat(lambda: small.match(url, STOP_CHAIN), number=2000, repeat=3))
+        large_time = min(timeit.repeat(lambda: large.match(url, STOP_CHAIN), number=2000, repeat=3))
+        self.assertLess(large_time, small_time * 3)
+
+    def test_stop_chain(self):
+        rules = DomainRules(DEFAULT_RULES + ({'type': STOP_CHAIN, 'host': 'tracker.ru'},))
+        with patch('lib.domain_rules', rules):
+            history = RedirectHistory(u'http://a.ru/')
+            self.assertTrue(history.add(u'http://b.ru/', 'http_status', 'page a'))
+            self.assertFalse(history.add(u'http://tracker.ru/click', 'http_status', 'page b'))
+        self.assertTrue(history.finished)
+        self.assertEqual(history.result(), (
+            ['http_status', 'http_status'], [u'http://a.ru/', u'http://b.ru/', u'http://tracker.ru/click'], []
+        ))
+
+    def test_skip_task(self):
+        with patch('lib.domain_rules', DomainRules([{'type': SKIP_TASK, 'host': '.a.ru'}])):
+            self.assertTrue(RedirectHistory(u'http://www.a.ru/').finished)
+            self.assertFalse(RedirectHistory(u'http://b.ru/').finished)
+
+    def test_ignore_redirect(self):
+        with patch('lib.domain_rules', DomainRules([{'type': IGNORE_REDIRECT, 'host': 'login.ru'}])):
+            self.assertEqual(process_response(u'http://a.ru/', 'page', 'http://login.ru/'), (None, None, 'page'))
+            self.assertEqual(
+                process_response(u'http://a.ru/', 'page', 'http://b.ru/'), (u'http://b.ru/', 'http_status', 'page')
+            )
+
+    def test_set_domain_rules(self):
+        rules = DomainRules([])
+        default = lib.domain_rules
+        try:
+            lib.set_domain_rules(rules)
+            self.assertIs(lib.domain_rules, rules)
+        finally:
+            lib.set_domain_rules(default)
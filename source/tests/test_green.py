@@ -0,0 +1,84 @@
+# coding: utf-8
+import socket
+import time
+import unittest
+
+import gevent
+import pycurl
+from mock import patch, Mock
+
+from lib import get_redirect_history, set_curl_driver
+from lib.green import GreenCurlMulti, READ, WRITE
+from tests.stub_server import StubServer
+
+
+def get_free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class GreenTestCase(unittest.TestCase):
+    def setUp(self):
+        self.driver = GreenCurlMulti()
+        set_curl_driver(self.driver)
+
+    def tearDown(self):
+        set_curl_driver(None)
+        self.driver.close()
+
+    def test_concurrent_chains(self):
+        server = StubServer(0.2)
+        started = time.time()
+        try:
+            greenlets = [
+                gevent.spawn(get_redirect_history, server.url + 'redirect{}'.format(i), 5) for i in xrange(30)
+            ]
+            gevent.joinall(greenlets, timeout=10)
+        finally:
+            server.shutdown()
+        elapsed = time.time() - started
+        for i, greenlet in enumerate(greenlets):
+            self.assertEqual(greenlet.value, (
+                ['http_status'], [server.url + 'redirect{}'.format(i), server.url + 'end'], ['GOOGLE_ANALYTICS']
+            ))
+        # 30 chains of 2 hops take 12 s one by one
+        self.assertLess(elapsed, 2)
+        self.assertEqual(len(self.driver), 0)
+
+    def test_error(self):
+        url = 'http://127.0.0.1:{}/'.format(get_free_port())
+        with patch('lib.logger', Mock()):
+            result = gevent.spawn(get_redirect_history, url, 5).get(timeout=10)
+        self.assertEqual(result, (['ERROR'], [url, url], []))
+
+    def test_killed_greenlet_removes_handle(self):
+        server = StubServer(1)
+        try:
+            greenlet = gevent.spawn(get_redirect_history, server.url, 5)
+            gevent.sleep(0.1)
+            self.assertEqual(len(self.driver), 1)
+            greenlet.kill()
+        finally:
+            server.shutdown()
+        self.assertEqual(len(self.driver), 0)
+
+    def test_on_socket(self):
+        driver = GreenCurlMulti()
+        driver.loop = Mock()
+        driver.on_socket(pycurl.POLL_INOUT, 5, None, None)
+        driver.loop.io.assert_called_once_with(5, READ | WRITE)
+        watcher = driver.watchers[5]
+        driver.on_socket(pycurl.POLL_REMOVE, 5, None, None)
+        self.assertTrue(watcher.stop.called)
+        self.assertEqual(driver.watchers, {})
+        driver.close()
+
+    def test_on_io(self):
+        driver = GreenCurlMulti()
+        with patch.object(driver, 'socket_action') as socket_action:
+            driver.on_io(READ | WRITE, 5)
+        socket_action.assert_called_once_with(5, pycurl.CSELECT_IN | pycurl.CSELECT_OUT)
+        driver.close()
@@ -0,0 +1,67 @@
+import time
+import unittest
+from mock import patch, Mock
+from lib.health import HealthMonitor, HealthWindow
+
+
+class HealthTestCase(unittest.TestCase):
+    def test_window_first_result_fills_window(self):
+        window = HealthWindow(4, 0.5, 0.75)
+        self.assertTrue(window.add(True))
+        self.assertEqual(list(window.results), [True] * 4)
+        # a single failed probe does not stop anything
+        self.assertTrue(window.add(False))
+        self.assertTrue(window.add(False))
+        self.assertFalse(window.add(False))
+
+    def test_window_hysteresis(self):
+        window = HealthWindow(4, 0.5, 0.75)
+        self.assertFalse(window.add(False))
+        self.assertFalse(window.add(True))
+        # half of the window is not enough to come back up
+        self.assertFalse(window.add(True))
+        self.assertTrue(window.add(True))
+        self.assertTrue(window.add(False))
+
+    def get_monitor(self, urls, quorum=1):
+        return HealthMonitor(urls, 1, 10, 2, 0.5, 1, quorum)
+
+    def test_probe_concurrent(self):
+        def check(url, timeout):
+            time.sleep(0.2)
+            return url != 'http://down/'
+
+        monitor = self.get_monitor(['http://a/', 'http://b/', 'http://down/'])
+        with patch('lib.health.check_network_status', Mock(side_effect=check)):
+            started = time.time()
+            self.assertEqual(monitor.probe(), 2)
+        self.assertLess(time.time() - started, 0.4)
+
+    def test_probe_does_not_wait_hung_url(self):
+        def check(url, timeout):
+            time.sleep(0.5 if url == 'http://hung/' else 0)
+            return True
+
+        # a probe round waits at most timeout + 1 seconds
+        monitor = HealthMonitor(['http://a/', 'http://hung/'], -0.9, 10, 2, 0.5, 1)
+        with patch('lib.health.check_network_status', Mock(side_effect=check)):
+            self.assertEqual(monitor.probe(), 1)
+
+    def test_check_quorum(self):
+        monitor = self.get_monitor(['http://a/', 'http://b/'], quorum=2)
+        with patch.object(monitor, 'probe', Mock(side_effect=[2, 1, 1])):
+            self.assertTrue(monitor.check())
+            self.assertTrue(monitor.check())
+            self.assertFalse(monitor.check())
+        self.assertFalse(monitor.up)
+
+    def test_start_checks_at_once(self):
+        monitor = HealthMonitor(['http://a/'], 1, 0.01, 2, 0.5, 1)
+        with patch('lib.health.check_network_status', Mock(return_value=True)) as check:
+            monitor.start()
+            self.assertTrue(monitor.up)
+            time.sleep(0.1)
+            monitor.stop()
+            monitor.thread.join(1)
+        self.assertFalse(monitor.thread.is_alive())
+        self.assertGreater(check.call_count, 1)
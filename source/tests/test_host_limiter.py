@@ -0,0 +1,81 @@
+# coding: utf-8
+import unittest
+
+from mock import Mock, patch
+
+from lib.host_limiter import HostLimiter, PendingTasks, get_host
+
+
+class HostLimiterTestCase(unittest.TestCase):
+    def test_get_host(self):
+        self.assertEqual(get_host('https://Partner.ru:8443/callback?a=1'), 'partner.ru:8443')
+
+    def test_acquire_up_to_limit(self):
+        limiter = HostLimiter(2)
+        self.assertTrue(limiter.acquire('a.ru'))
+        self.assertTrue(limiter.acquire('a.ru'))
+        self.assertFalse(limiter.acquire('a.ru'))
+        self.assertTrue(limiter.acquire('b.ru'))
+        limiter.release('a.ru', 0.1)
+        self.assertTrue(limiter.acquire('a.ru'))
+
+    def test_slow_response_decreases_limit(self):
+        limiter = HostLimiter(8, latency_threshold=1)
+        for _ in xrange(4):
+            limiter.acquire('a.ru')
+        limiter.release('a.ru', 2)
+        self.assertEqual(limiter.limit('a.ru'), 4)
+        limiter.release('a.ru', 0.1, error=True)
+        self.assertEqual(limiter.limit('a.ru'), 2)
+        self.assertFalse(limiter.acquire('a.ru'))
+
+    def test_limit_not_below_min(self):
+        limiter = HostLimiter(2, min_limit=1)
+        for _ in xrange(3):
+            limiter.acquire('a.ru')
+            limiter.release('a.ru', 0, error=True)
+        self.assertEqual(limiter.limit('a.ru'), 1)
+
+    def test_successes_increase_limit(self):
+        limiter = HostLimiter(4)
+        limiter.acquire('a.ru')
+        limiter.release('a.ru', 0, error=True)
+        limiter.release('a.ru', 0, error=True)
+        self.assertEqual(limiter.limit('a.ru'), 1)
+        limiter.acquire('a.ru')
+        limiter.release('a.ru', 0)
+        self.assertEqual(limiter.limit('a.ru'), 2)
+        for _ in xrange(3):
+            limiter.acquire('a.ru')
+            limiter.release('a.ru', 0)
+        self.assertEqual(limiter.limit('a.ru'), 3)
+
+    def test_idle_healthy_host_forgotten(self):
+        limiter = HostLimiter(2)
+        limiter.acquire('a.ru')
+        limiter.release('a.ru', 0)
+        self.assertEqual(limiter.hosts, {})
+
+    def test_pending_tasks_per_host_limit(self):
+        pending = PendingTasks(2, 30)
+        self.assertTrue(pending.add('a.ru', 1))
+        self.assertTrue(pending.add('a.ru', 2))
+        self.assertFalse(pending.add('a.ru', 3))
+        self.assertTrue(pending.add('b.ru', 4))
+        self.assertEqual(len(pending), 3)
+        self.assertEqual(pending.first('a.ru'), 1)
+        self.assertEqual(pending.pop('a.ru'), 1)
+        self.assertEqual(pending.pop('b.ru'), 4)
+        self.assertEqual(sorted(pending.hosts), ['a.ru'])
+        self.assertEqual(pending.pop_all(), [2])
+        self.assertEqual(len(pending), 0)
+
+    def test_pending_tasks_expire(self):
+        pending = PendingTasks(10, 30)
+        with patch('lib.host_limiter.time', Mock(side_effect=[100, 110, 120])):
+            pending.add('a.ru', 1)
+            pending.add('a.ru', 2)
+            pending.add('b.ru', 3)
+        with patch('lib.host_limiter.time', Mock(return_value=140)):
+            self.assertEqual(sorted(pending.expired()), [1, 2])
+        self.assertEqual(pending.pop_all(), [3])
@@ -0,0 +1,28 @@
+import unittest
+from mock import Mock
+from lib.http_session import get_pool_stats, make_session
+
+
+class HttpSessionTestCase(unittest.TestCase):
+    def test_make_session_pool_size(self):
+        session = make_session(15, 20)
+        adapter = session.get_adapter('http://a.ru/')
+        self.assertIs(adapter, session.get_adapter('https://b.ru/'))
+        self.assertEqual(adapter._pool_maxsize, 15)
+        self.assertEqual(adapter._pool_connections, 20)
+
+    def test_make_session_host_pool_size(self):
+        session = make_session(15, 20, {'partner.ru': 50, 'other.ru:8080': 2})
+        self.assertEqual(session.get_adapter('https://partner.ru/callback')._pool_maxsize, 50)
+        self.assertEqual(session.get_adapter('http://other.ru:8080/')._pool_maxsize, 2)
+        self.assertEqual(session.get_adapter('http://partner.ru.evil.com/')._pool_maxsize, 15)
+        self.assertEqual(session.get_adapter('http://other.ru/')._pool_maxsize, 15)
+
+    def test_get_pool_stats(self):
+        session = make_session(2)
+        pool = Mock(num_requests=5, num_connections=2)
+        session.get_adapter('http://a.ru/').poolmanager.pools[('http', 'a.ru', 80)] = pool
+        self.assertEqual(get_pool_stats(session), {('http', 'a.ru', 80): (3, 2)})
+
+    def test_get_pool_stats_empty(self):
+        self.assertEqual(get_pool_stats(make_session(2)), {})
@@ -1,9 +1,13 @@
 import unittest
 from mock import patch, Mock, MagicMock, mock_open
-from bs4 import BeautifulSoup
-from StringIO import StringIO
-from lib import to_unicode, to_str, get_counters, check_for_meta, fix_market_url, make_pycurl_request, get_url, \
-    get_redirect_history, break_func_for_test, prepare_url
+from HTMLParser import HTMLParseError
+import pycurl
+from lib import MAX_BODY_BYTES, to_unicode, to_str, get_counters, check_for_meta, fix_market_url, make_pycurl_request, get_url, \
+    get_redirect_history, break_func_for_test, prepare_url, process_response, RedirectHistory, CurlPool, \
+    get_curl_pool, ResponseBuffer, follow_cached_hops, fetch_url, CheckStopped
+from tests.fixtures import read_fixtures
+from benchmarks.bench_meta import soup_check_for_meta
+from benchmarks.bench_counters import regex_get_counters, COUNTER_SCRIPTS
 
 
 class InitTestCase(unittest.TestCase):
@@ -37,46 +41,75 @@ class InitTestCase(unittest.TestCase):
         res = get_counters('dfgsdhshstrhstrh')
         self.assertEqual(res, [])
 
+    def test_get_counters_matches_regex(self):
+        pages = [content for name, content in read_fixtures('meta')] + [
+            COUNTER_SCRIPTS,
+            '<IMG SRC="//TOP.MAIL.RU/JUMP?FROM=1"><img src="//top-fwz1.mail.ru/counter">',
+            '<script src="//a1.vdna-assets.com/analytics.js"></script>\n'
+            '<img src="http://counter.rambler.ru/top100.cnt?1">\n'
+            '<img src="//googleads.g.doubleclick.net/pagead/viewthroughconversion/1/">',
+            'google-analytics.com/ga_js mc.yandex.ru/metrika/tag.js //counter.yadro.ru/hit',
+        ]
+        for content in pages:
+            self.assertEqual(get_counters(content), regex_get_counters(content))
+
+    def test_check_for_meta_matches_soup_on_fixtures(self):
+        for name, content in read_fixtures('meta'):
+            self.assertEqual(
+                check_for_meta(content, 'http://url.ru/path/'),
+                soup_check_for_meta(content, 'http://url.ru/path/'),
+                name
+            )
+
     def test_check_for_meta(self):
-        result = MagicMock(name="result")
-        result.attrs = {
-            "content": "somewords;url=url.ru/somepath",
-            "http-equiv": 'refresh',
-        }
-        result.__getitem__ = Mock(return_value=result.attrs["content"])
-        with patch.object(BeautifulSoup, "find", return_value=result):
-            res = check_for_meta("content", "url")
+        content = '<html><head><meta http-equiv="refresh" content="somewords;url=url.ru/somepath"></head></html>'
+        res = check_for_meta(content, "url")
         self.assertEqual(res, u'url.ru/somepath')
 
     def test_check_for_meta_no_result(self):
-        result = MagicMock()
-        result.attrs = {
-            "http-equiv": 'refresh',
-        }
-        with patch.object(BeautifulSoup, "find", return_value=None):
-            res = check_for_meta("content", "url")
+        res = check_for_meta("content", "url")
         self.assertEqual(res, None)
 
     def test_check_for_meta_splitted_len_not_two(self):
-        result = MagicMock()
-        result.attrs = {
-            "content": "somewords",
-            "http-equiv": 'refresh',
-        }
-        result.__getitem__ = Mock(return_value=result.attrs["content"])
-        with patch.object(BeautifulSoup, "find", return_value=result):
-            res = check_for_meta("content", "url")
+        res = check_for_meta('<meta http-equiv="refresh" content="somewords">', "url")
         self.assertEqual(res, None)
 
     def test_check_for_meta_not_m(self):
-        result = MagicMock(name="result")
-        result.attrs = {
-            "content": "somewords;url=",
-            "http-equiv": 'refresh',
+        res = check_for_meta('<meta http-equiv="refresh" content="somewords;url=">', "url")
+        self.assertEqual(res, None)
+
+    def test_check_for_meta_stops_at_body(self):
+        content = '<html><head></head><body><meta http-equiv="refresh" content="0;url=/next"></body></html>'
+        res = check_for_meta(content, "url")
+        self.assertEqual(res, None)
+
+    def test_check_for_meta_skips_false_head_ends(self):
+        expected = {
+            'refresh_after_body_prefixed_tag.html': u'http://url.ru/after-custom-tag',
+            'refresh_after_commented_head_end.html': u'http://url.ru/after-comment',
+            'refresh_after_script_tags.html': u'http://url.ru/after-script',
         }
-        result.__getitem__ = Mock(return_value=result.attrs["content"])
-        with patch.object(BeautifulSoup, "find", return_value=result):
-            res = check_for_meta("content", "url")
+        for name, content in read_fixtures('meta'):
+            if name in expected:
+                self.assertEqual(check_for_meta(content, 'http://url.ru/path/'), expected.pop(name), name)
+        self.assertEqual(expected, {})
+
+    def test_check_for_meta_feeds_by_chunks(self):
+        content = '<html><head><title>' + '\xd0\xb9' * 3000 + '</title>' \
+                  '<meta http-equiv="refresh" content="0;url=/\xd0\xb9"></head></html>'
+        with patch('lib.META_FEED_CHUNK', 1001):
+            res = check_for_meta(content, 'http://url.ru/')
+        self.assertEqual(res, u'http://url.ru/\u0439')
+
+    def test_check_for_meta_keeps_latin1_bytes(self):
+        content = '<title>caf\xe9 \xd0\xb9</title><meta http-equiv="refresh" content="0;url=/?q=\xe9">'
+        with patch('lib.META_FEED_CHUNK', 13):
+            res = check_for_meta(content, 'http://url.ru/')
+        self.assertEqual(res, u'http://url.ru/?q=\xe9')
+
+    def test_check_for_meta_parse_error(self):
+        with patch('lib.MetaParser.feed', Mock(side_effect=HTMLParseError('HTMLParseError'))):
+            res = check_for_meta('<meta http-equiv="refresh" content="0;url=/next">', "url")
         self.assertEqual(res, None)
 
     def test_fix_market_url(self):
@@ -85,20 +118,92 @@ class InitTestCase(unittest.TestCase):
 
     def test_make_pycurl_request(self):
         curl = Mock()
-        with patch('pycurl.Curl', Mock(curl)):
-            with patch.object(StringIO, "getvalue", return_value='redirect_url'):
-                content, redirect_url = make_pycurl_request('url', 5, 'useragent')
+        with patch('lib.get_curl_pool', Mock(return_value=CurlPool())):
+            with patch('pycurl.Curl', Mock(curl)):
+                with patch.object(ResponseBuffer, "getvalue", return_value='redirect_url'):
+                    content, redirect_url = make_pycurl_request('url', 5, 'useragent')
         self.assertTrue(content)
         self.assertTrue(redirect_url)
 
     def test_make_pycurl_request_no_useragent(self):
         curl = Mock()
-        with patch('pycurl.Curl', Mock(curl)):
-            with patch.object(StringIO, "getvalue", return_value='redirect_url'):
-                content, redirect_url = make_pycurl_request('url', 5)
+        with patch('lib.get_curl_pool', Mock(return_value=CurlPool())):
+            with patch('pycurl.Curl', Mock(curl)):
+                with patch.object(ResponseBuffer, "getvalue", return_value='redirect_url'):
+                    content, redirect_url = make_pycurl_request('url', 5)
         self.assertTrue(content)
         self.assertTrue(redirect_url)
 
+    def test_make_pycurl_request_returns_handle_on_error(self):
+        curl = Mock()
+        curl.perform = Mock(side_effect=ValueError('ValueError'))
+        pool = CurlPool()
+        with patch('lib.get_curl_pool', Mock(return_value=pool)):
+            with patch('pycurl.Curl', Mock(return_value=curl)):
+                self.assertRaises(ValueError, make_pycurl_request, 'url', 5)
+        self.assertEqual(pool.free, [curl])
+        self.assertTrue(curl.reset.called)
+
+    def test_make_pycurl_request_aborted_by_buffer(self):
+        curl = Mock()
+        curl.getinfo = Mock(return_value='http://url.ru/next')
+        buff = ResponseBuffer('url')
+        buff.aborted = True
+        curl.perform = Mock(side_effect=pycurl.error(pycurl.E_WRITE_ERROR, 'Failed writing body'))
+        with patch('lib.get_curl_pool', Mock(return_value=CurlPool())):
+            with patch('pycurl.Curl', Mock(return_value=curl)):
+                with patch('lib.setup_curl', Mock(return_value=buff)):
+                    content, redirect_url = make_pycurl_request('url', 5, 'useragent')
+        self.assertEqual(content, '')
+        self.assertEqual(redirect_url, u'http://url.ru/next')
+
+    def test_response_buffer_skips_redirect_body(self):
+        buff = ResponseBuffer('url')
+        buff.header('HTTP/1.1 100 Continue\r\n')
+        buff.header('HTTP/1.1 301 Moved Permanently\r\n')
+        buff.header('location: /next\r\n')
+        self.assertEqual(buff.write('<html>'), 0)
+        self.assertTrue(buff.aborted)
+        self.assertEqual(buff.getvalue(), '')
+
+    def test_response_buffer_stops_after_meta_head(self):
+        buff = ResponseBuffer('http://url.ru/')
+        buff.header('HTTP/1.1 200 OK\r\n')
+        self.assertEqual(buff.write('<html><head><meta http-equiv="refresh" content="0;url=/next"></he'), None)
+        self.assertEqual(buff.write('ad><body>'), 0)
+        self.assertTrue(buff.aborted)
+
+    def test_response_buffer_keeps_final_page(self):
+        buff = ResponseBuffer('http://url.ru/', 20)
+        buff.header('HTTP/1.1 200 OK\r\n')
+        self.assertEqual(buff.write('<head></head><body>'), None)
+        self.assertFalse(buff.aborted)
+        self.assertEqual(buff.write('counter'), 0)
+        self.assertEqual(buff.getvalue(), '<head></head><body>c')
+
+    def test_curl_pool_reuse(self):
+        pool = CurlPool(1)
+        first, second = Mock(), Mock()
+        with patch('pycurl.Curl', Mock(side_effect=[first, second])):
+            curl = pool.get()
+            pool.put(curl)
+            self.assertIs(pool.get(), first)
+            self.assertIs(pool.get(), second)
+            pool.put(first)
+            pool.put(second)
+        first.setopt.assert_called_with(pycurl.SHARE, pool.share)
+        self.assertTrue(second.close.called)
+        pool.close()
+        self.assertTrue(first.close.called)
+
+    def test_get_curl_pool_per_process(self):
+        with patch('lib.curl_pool', None):
+            pool = get_curl_pool(3)
+            self.assertIs(get_curl_pool(), pool)
+            self.assertEqual(pool.size, 3)
+            with patch('os.getpid', Mock(return_value=pool.pid + 1)):
+                self.assertIsNot(get_curl_pool(), pool)
+
     def test_get_url(self):
         with patch('lib.make_pycurl_request', Mock(return_value=('content', 'new_redirect_url'))):
             with patch('lib.prepare_url', Mock(return_value='prepare_url')):
@@ -155,7 +260,7 @@ class InitTestCase(unittest.TestCase):
 
     def test_get_redirect_history(self):
         with patch('lib.prepare_url', Mock(return_value='prepare_url')):
-            with patch('lib.get_url', Mock(return_value=('redirect_url', 'redirect_type', 'content'))):
+            with patch('lib.fetch_url', Mock(return_value=(('redirect_url', 'redirect_type', 'content'), None))):
                 with patch('lib.break_func_for_test', Mock(return_value=True)):
                     history_types, history_urls, counters = get_redirect_history('url', 5)
         self.assertEquals(history_types, ['redirect_type'])
@@ -164,7 +269,7 @@ class InitTestCase(unittest.TestCase):
 
     def test_get_redirect_history_not_redirect_url(self):
         with patch('lib.prepare_url', Mock(return_value='prepare_url')):
-            with patch('lib.get_url', Mock(return_value=(None, 'redirect_type', 'content'))):
+            with patch('lib.fetch_url', Mock(return_value=((None, 'redirect_type', 'content'), None))):
                 history_types, history_urls, counters = get_redirect_history('url', 5)
         self.assertEquals(history_types, [])
         self.assertEquals(history_urls, ['prepare_url'])
@@ -172,7 +277,7 @@ class InitTestCase(unittest.TestCase):
 
     def test_get_redirect_history_redirect_type_error(self):
         with patch('lib.prepare_url', Mock(return_value='prepare_url')):
-            with patch('lib.get_url', Mock(return_value=('redirect_url', 'ERROR', 'content'))):
+            with patch('lib.fetch_url', Mock(return_value=(('redirect_url', 'ERROR', 'content'), None))):
                 history_types, history_urls, counters = get_redirect_history('url', 5)
         self.assertEquals(history_types, ['ERROR'])
         self.assertEquals(history_urls, ['prepare_url', 'redirect_url'])
@@ -185,14 +290,128 @@ class InitTestCase(unittest.TestCase):
         self.assertEquals(history_urls, ['http://www.odnoklassniki.ru/sdfst.redirect'])
         self.assertEquals(counters, [])
 
+    def test_make_pycurl_request_curl_driver(self):
+        curl = Mock()
+        driver = Mock()
+        with patch('lib.get_curl_pool', Mock(return_value=CurlPool())):
+            with patch('pycurl.Curl', Mock(return_value=curl)):
+                with patch('lib.curl_driver', driver):
+                    make_pycurl_request('url', 5)
+        driver.perform.assert_called_once_with(curl)
+        self.assertFalse(curl.perform.called)
+
+    def test_make_pycurl_request_timing(self):
+        curl = Mock()
+        curl.perform = Mock(side_effect=pycurl.error(pycurl.E_COULDNT_CONNECT, 'Connection refused'))
+        timing = Mock()
+        with patch('lib.get_curl_pool', Mock(return_value=CurlPool())):
+            with patch('pycurl.Curl', Mock(return_value=curl)):
+                self.assertRaises(pycurl.error, make_pycurl_request, 'url', 5, timing=timing)
+        timing.add_hop.assert_called_once_with('url', curl)
+
+    def test_process_response_timing(self):
+        timing = Mock()
+        timing.call = Mock(return_value=u'http://url.ru/next')
+        res = process_response(u'http://url.ru/', 'content', None, timing)
+        timing.call.assert_called_once_with('check_for_meta', check_for_meta, 'content', u'http://url.ru/')
+        self.assertEqual(res, (u'http://url.ru/next', 'meta_tag', 'content'))
+
+    def test_redirect_history_result_timing(self):
+        history = RedirectHistory('url1', 30)
+        history.add(None, None, 'content')
+        timing = Mock()
+        timing.call = Mock(return_value=['GOOGLE_ANALYTICS'])
+        self.assertEqual(history.result(timing), ([], ['url1'], ['GOOGLE_ANALYTICS']))
+        timing.call.assert_called_once_with('get_counters', get_counters, 'content')
+
+    def test_process_response_meta(self):
+        content = '<html><head><meta http-equiv="refresh" content="0; url=/next"></head></html>'
+        res = process_response(u'http://url.ru/', content, None)
+        self.assertEqual(res, (u'http://url.ru/next', 'meta_tag', content))
+
+    def test_redirect_history_loop(self):
+        history = RedirectHistory('url1', 30)
+        self.assertTrue(history.add('url2', 'http_status', None))
+        self.assertFalse(history.add('url1', 'http_status', 'content'))
+        self.assertTrue(history.finished)
+        self.assertEqual(history.result(), (['http_status', 'http_status'], ['url1', 'url2', 'url1'], []))
+
+    def test_redirect_history_max_redirects(self):
+        history = RedirectHistory('url1', 1)
+        self.assertFalse(history.add('url2', 'http_status', None))
+
+    def test_get_redirect_history_hop_cache(self):
+        hop_cache = Mock()
+        hop_cache.follow = Mock(return_value=[(u'http://b.ru/', 'http_status')])
+        with patch('lib.fetch_url', Mock(return_value=((None, None, 'content'), None))) as fetch_url:
+            history_types, history_urls, counters = get_redirect_history('http://a.ru/', 5, hop_cache=hop_cache)
+        fetch_url.assert_called_once_with(url=u'http://b.ru/', timeout=5, user_agent=None,
+                                          max_body_bytes=MAX_BODY_BYTES, timing=None)
+        hop_cache.follow.assert_called_once_with(u'http://a.ru/', 30)
+        self.assertFalse(hop_cache.remember.called)
+        self.assertEquals(history_types, ['http_status'])
+        self.assertEquals(history_urls, [u'http://a.ru/', u'http://b.ru/'])
+
+    def test_get_redirect_history_remembers_hop(self):
+        hop_cache = Mock()
+        hop_cache.follow = Mock(return_value=[])
+        hop_cache.remember = Mock(return_value=[])
+        with patch('lib.fetch_url', Mock(side_effect=[((u'http://b.ru/', 'meta_tag', 'content'), None),
+                                                      ((u'http://b.ru/', 'ERROR', None), pycurl.error(6, ''))])):
+            get_redirect_history('http://a.ru/', 5, hop_cache=hop_cache)
+        hop_cache.remember.assert_called_once_with(u'http://a.ru/', (u'http://b.ru/', 'meta_tag'), 29)
+
+    def test_get_redirect_history_follows_remembered_hop(self):
+        hop_cache = Mock()
+        hop_cache.follow = Mock(return_value=[])
+        hop_cache.remember = Mock(return_value=[(u'http://c.ru/', 'http_status')])
+        with patch('lib.fetch_url', Mock(side_effect=[((u'http://b.ru/', 'meta_tag', 'content'), None),
+                                                      ((None, None, 'content'), None)])) as fetch_url:
+            history_types, history_urls, counters = get_redirect_history('http://a.ru/', 5, hop_cache=hop_cache)
+        # b.ru -> c.ru is known, so c.ru is requested right after a.ru
+        self.assertEqual([call[1]['url'] for call in fetch_url.call_args_list], [u'http://a.ru/', u'http://c.ru/'])
+        self.assertEqual(hop_cache.follow.call_count, 1)
+        self.assertEqual(history_urls, [u'http://a.ru/', u'http://b.ru/', u'http://c.ru/'])
+
+    def test_get_redirect_history_resumed(self):
+        history = RedirectHistory.resumed(['http_status'], ['http://a.ru/', 'http://b.ru/'])
+        error = pycurl.error(pycurl.E_OPERATION_TIMEDOUT, 'timed out')
+        with patch('lib.fetch_url', Mock(return_value=((u'http://b.ru/', 'ERROR', None), error))) as fetch_url:
+            history_types, history_urls, counters = get_redirect_history('http://a.ru/', 5, history=history)
+        # the first url is not requested again
+        self.assertEqual(fetch_url.call_args[1]['url'], u'http://b.ru/')
+        self.assertEqual(history_types, ['http_status', 'ERROR'])
+        self.assertEqual(history_urls, [u'http://a.ru/', u'http://b.ru/', u'http://b.ru/'])
+        self.assertEqual(history.error, 'timeout')
+
+    def test_get_redirect_history_stopped_between_hops(self):
+        stopped = Mock(side_effect=[False, True])
+        with patch('lib.fetch_url', Mock(return_value=((u'http://b.ru/', 'http_status', None), None))) as fetch_url:
+            self.assertRaises(CheckStopped, get_redirect_history, 'http://a.ru/', 5, stopped=stopped)
+        self.assertEqual(fetch_url.call_count, 1)
+
+    def test_get_url_returns_hop_of_fetch_url(self):
+        error = pycurl.error(pycurl.E_COULDNT_CONNECT, 'refused')
+        with patch('lib.make_pycurl_request', Mock(side_effect=error)):
+            with patch('lib.logger', Mock()):
+                self.assertEqual(fetch_url('url', 5), (('url', 'ERROR', None), error))
+                self.assertEqual(get_url('url', 5), ('url', 'ERROR', None))
+
+    def test_follow_cached_hops_until_finished(self):
+        history = RedirectHistory(u'http://a.ru/', 30)
+        hop_cache = Mock()
+        hop_cache.follow = Mock(return_value=[(u'http://a.ru/', 'http_status'), (u'http://b.ru/', 'http_status')])
+        follow_cached_hops(history, hop_cache)
+        self.assertTrue(history.finished)
+        # the hops after the loop are not added
+        self.assertEqual(history.history_urls, [u'http://a.ru/', u'http://a.ru/'])
+
     def test_prepare_url_url_is_none(self):
         res = prepare_url(None)
         self.assertEquals(res, None)
 
     def test_prepare_url(self):
-        netlock = Mock()
-        netlock.encode = Mock(side_effect=UnicodeError)
-        with patch('lib.urlparse', Mock(return_value=('scheme', netlock, 'path', 'qs', 'anchor', 'fragments'))):
-            with patch('lib.urlunparse', Mock()) as urlunparse:
-                prepare_url('url')
-        self.assertTrue(urlunparse.called)
\ No newline at end of file
+        prepare_url.clear()
+        # the netloc with an empty label can't be encoded to idna and is left as is
+        self.assertEqual(prepare_url(u'http://a..\u0431/\u043f \u0443'), u'http://a..\u0431/%D0%BF%20%D1%83')
+        prepare_url.clear()
\ No newline at end of file
@@ -0,0 +1,134 @@
+# coding: utf-8
+import unittest
+from multiprocessing import Process
+
+import requests
+from mock import patch, Mock
+
+from lib.cache import start_cache_manager
+from lib.metrics import MetricsBuffer, Registry, Timer, start_metrics_server
+
+
+def push_metrics(shared, count):
+    metrics = MetricsBuffer(shared, 60)
+    for _ in xrange(count):
+        metrics.inc('tasks_total')
+        metrics.observe('latency_seconds', 0.2, (0.1, 1))
+    metrics.push()
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_render(self):
+        metrics = Registry()
+        metrics.inc('tasks_total', request='take')
+        metrics.inc('tasks_total', 2, request='take')
+        metrics.set('in_flight', 3, worker=42)
+        metrics.observe('latency_seconds', 0.05, (0.1, 1))
+        metrics.observe('latency_seconds', 0.5, (0.1, 1))
+        metrics.observe('latency_seconds', 5, (0.1, 1))
+        self.assertEqual(metrics.render(), '\n'.join([
+            '# TYPE tasks_total counter',
+            'tasks_total{request="take"} 3',
+            '# TYPE in_flight gauge',
+            'in_flight{worker="42"} 3',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 5.55',
+            'latency_seconds_count 3',
+        ]) + '\n')
+
+    def test_render_escapes_labels(self):
+        metrics = Registry()
+        metrics.inc('errors_total', error='bad "url"\n')
+        self.assertIn(r'errors_total{error="bad \"url\"\n"} 1', metrics.render())
+
+    def test_take_and_merge(self):
+        local, shared = Registry(), Registry()
+        shared.inc('tasks_total', 5)
+        shared.observe('latency_seconds', 0.5, (0.1, 1))
+        local.inc('tasks_total', 2)
+        local.set('in_flight', 1)
+        local.observe('latency_seconds', 0.05, (0.1, 1))
+        local.observe('chain_length', 3, (1, 5))
+
+        shared.merge(local.take())
+        self.assertEqual(shared.counters, {('tasks_total', ()): 7})
+        self.assertEqual(shared.gauges, {('in_flight', ()): 1})
+        self.assertEqual(shared.histograms, {
+            ('latency_seconds', ()): [[1, 1, 0], 0.55, 2],
+            ('chain_length', ()): [[0, 1, 0], 3, 1],
+        })
+        # counters and histograms are sent once, gauges are kept
+        self.assertEqual(local.counters, {})
+        self.assertEqual(local.histograms, {})
+        self.assertEqual(local.gauges, {('in_flight', ()): 1})
+
+    def test_sum_and_retain(self):
+        metrics = Registry()
+        metrics.set('in_flight', 2, worker=1)
+        metrics.set('in_flight', 3, worker=2)
+        metrics.set('workers', 2)
+        self.assertEqual(metrics.sum('in_flight'), 5)
+        metrics.retain('worker', [2])
+        self.assertEqual(metrics.gauges, {('in_flight', (('worker', 2),)): 3, ('workers', ()): 2})
+
+    def test_timer(self):
+        metrics = Registry()
+        with patch('lib.metrics.time', Mock(side_effect=[10, 10.5])):
+            with Timer(metrics, 'request_seconds', request='take'):
+                pass
+        self.assertEqual(metrics.histograms[('request_seconds', (('request', 'take'),))][1:], [0.5, 1])
+
+    def test_buffer_push_if_due(self):
+        shared = Mock()
+        with patch('lib.metrics.time', Mock(return_value=100)):
+            metrics = MetricsBuffer(shared, 1)
+            metrics.inc('tasks_total')
+            metrics.push_if_due()
+        self.assertFalse(shared.merge.called)
+        with patch('lib.metrics.time', Mock(return_value=101)):
+            metrics.push_if_due()
+        shared.merge.assert_called_once_with(({('tasks_total', ()): 1}, {}, {}, {}))
+        self.assertEqual(metrics.counters, {})
+
+    def test_buffer_without_shared_registry(self):
+        metrics = MetricsBuffer(None, 0)
+        metrics.inc('tasks_total')
+        metrics.push()
+        self.assertEqual(metrics.counters, {})
+
+    def test_buffer_push_manager_gone(self):
+        metrics = MetricsBuffer(Mock(merge=Mock(side_effect=EOFError)), 0)
+        with patch('lib.metrics.logger', Mock()) as logger:
+            metrics.push()
+        self.assertTrue(logger.warning.called)
+
+    def test_shared_registry_aggregates_processes(self):
+        manager = start_cache_manager()
+        try:
+            shared = manager.MetricsRegistry()
+            workers = [Process(target=push_metrics, args=(shared, count)) for count in (2, 3)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            rendered = shared.render()
+        finally:
+            manager.shutdown()
+        self.assertIn('tasks_total 5\n', rendered)
+        self.assertIn('latency_seconds_bucket{le="1"} 5\n', rendered)
+
+    def test_metrics_server(self):
+        server = start_metrics_server('127.0.0.1', 0, lambda: 'tasks_total 1\n')
+        url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        try:
+            response = requests.get(url + '/metrics')
+            not_found = requests.get(url + '/')
+        finally:
+            server.shutdown()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, 'tasks_total 1\n')
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertEqual(not_found.status_code, 404)
@@ -0,0 +1,151 @@
+import unittest
+from mock import patch, Mock
+import pycurl
+from lib import CurlPool, RedirectHistory
+from lib.multi import MultiRedirectChecker
+
+
+def get_checker(multi, hop_cache=None):
+    with patch('pycurl.CurlMulti', Mock(return_value=multi)):
+        with patch('lib.multi.get_curl_pool', Mock(return_value=CurlPool(1))):
+            return MultiRedirectChecker(5, 3, 'user_agent', hop_cache=hop_cache)
+
+
+class MultiTestCase(unittest.TestCase):
+    def test_add_skipped_domain(self):
+        checker = get_checker(Mock())
+        checker.add('key', 'http://my.mail.ru/apps/42')
+        self.assertEqual(len(checker), 1)
+        self.assertEqual(checker.perform(0.01), [('key', ([], ['http://my.mail.ru/apps/42'], []))])
+        self.assertEqual(len(checker), 0)
+
+    def test_add_starts_request(self):
+        multi = Mock()
+        checker = get_checker(multi)
+        with patch('pycurl.Curl', Mock(return_value=Mock())):
+            checker.add('key', 'http://url.ru/')
+        self.assertTrue(multi.add_handle.called)
+        self.assertEqual(len(checker), 1)
+
+    def test_add_setup_error(self):
+        checker = get_checker(Mock())
+        with patch('pycurl.Curl', Mock(return_value=Mock())):
+            with patch('lib.multi.setup_curl', Mock(side_effect=ValueError('ValueError'))):
+                checker.add('key', 'http://url.ru/')
+        self.assertEqual(checker.perform(0.01), [('key', (['ERROR'], ['http://url.ru/', 'http://url.ru/'], []))])
+
+    def test_perform_follows_chain(self):
+        multi = Mock()
+        multi.select = Mock(return_value=1)
+        multi.perform = Mock(return_value=(0, 1))
+        checker = get_checker(multi)
+        curl = Mock()
+        multi.info_read = Mock(return_value=(0, [curl], []))
+        responses = [('', u'http://next.ru/'), ('<html></html>', None)]
+        with patch('pycurl.Curl', Mock(return_value=curl)) as curl_class:
+            with patch('lib.multi.read_curl_response', Mock(side_effect=responses)):
+                checker.add('key', 'http://url.ru/')
+                self.assertEqual(checker.perform(0.01), [])
+                self.assertEqual(len(checker), 1)
+                finished = checker.perform(0.01)
+        self.assertEqual(finished, [('key', (['http_status'], ['http://url.ru/', 'http://next.ru/'], []))])
+        self.assertEqual(curl_class.call_count, 1)
+        self.assertEqual(curl.reset.call_count, 2)
+
+    def test_perform_timing(self):
+        multi = Mock()
+        multi.select = Mock(return_value=1)
+        multi.perform = Mock(return_value=(0, 0))
+        checker = get_checker(multi)
+        curl = Mock()
+        multi.info_read = Mock(return_value=(0, [curl], []))
+        timing = Mock()
+        timing.call = Mock(side_effect=[None, []])
+        with patch('pycurl.Curl', Mock(return_value=curl)):
+            with patch('lib.multi.read_curl_response', Mock(return_value=('<html></html>', None))):
+                checker.add('key', 'http://url.ru/', timing)
+                finished = checker.perform(0.01)
+        self.assertEqual(finished, [('key', ([], ['http://url.ru/'], []))])
+        timing.add_hop.assert_called_once_with('http://url.ru/', curl)
+        self.assertEqual([call[0][0] for call in timing.call.call_args_list], ['check_for_meta', 'get_counters'])
+        self.assertEqual(checker.timings, {})
+
+    def test_perform_error(self):
+        multi = Mock()
+        multi.select = Mock(return_value=-1)
+        multi.perform = Mock(side_effect=[(pycurl.E_CALL_MULTI_PERFORM, 1), (0, 0)])
+        checker = get_checker(multi)
+        curl = Mock()
+        multi.info_read = Mock(return_value=(0, [], [(curl, 6, 'Could not resolve host')]))
+        with patch('pycurl.Curl', Mock(return_value=curl)):
+            checker.add('key', 'http://url.ru/')
+            with patch('lib.multi.sleep', Mock()) as sleep:
+                finished = checker.perform(0.01)
+        self.assertTrue(sleep.called)
+        self.assertEqual(finished, [('key', (['ERROR'], ['http://url.ru/', 'http://url.ru/'], []))])
+
+    def test_perform_error_kind_and_resume(self):
+        multi = Mock()
+        multi.select = Mock(return_value=1)
+        multi.perform = Mock(return_value=(0, 0))
+        checker = get_checker(multi)
+        curl = Mock()
+        multi.info_read = Mock(return_value=(0, [], [(curl, pycurl.E_COULDNT_RESOLVE_HOST, 'Could not resolve host')]))
+        history = RedirectHistory.resumed(['http_status'], ['http://a.ru/', 'http://url.ru/'])
+        with patch('pycurl.Curl', Mock(return_value=curl)):
+            checker.add('key', 'http://a.ru/', history=history)
+            finished = checker.perform(0.01)
+        curl.setopt.assert_any_call(curl.URL, 'http://url.ru/')
+        self.assertEqual(finished, [('key', (
+            ['http_status', 'ERROR'], ['http://a.ru/', 'http://url.ru/', 'http://url.ru/'], []
+        ))])
+        self.assertEqual(history.error, 'dns')
+
+    def test_perform_aborted_by_buffer(self):
+        multi = Mock()
+        multi.select = Mock(return_value=1)
+        multi.perform = Mock(return_value=(0, 0))
+        checker = get_checker(multi)
+        curl = Mock()
+        multi.info_read = Mock(return_value=(0, [], [(curl, pycurl.E_WRITE_ERROR, 'Failed writing body')]))
+        buff = Mock()
+        buff.aborted = True
+        with patch('pycurl.Curl', Mock(return_value=curl)):
+            with patch('lib.multi.setup_curl', Mock(return_value=buff)):
+                with patch('lib.multi.read_curl_response', Mock(return_value=('<html></html>', None))):
+                    checker.add('key', 'http://url.ru/')
+                    finished = checker.perform(0.01)
+        self.assertEqual(finished, [('key', ([], ['http://url.ru/'], []))])
+
+    def test_hop_cache(self):
+        multi = Mock()
+        multi.select = Mock(return_value=1)
+        multi.perform = Mock(return_value=(0, 0))
+        hop_cache = Mock()
+        hop_cache.follow = Mock(return_value=[(u'http://next.ru/', 'http_status')])
+        hop_cache.remember = Mock(return_value=[(u'http://url.ru/', 'http_status')])
+        checker = get_checker(multi, hop_cache)
+        curl = Mock()
+        multi.info_read = Mock(return_value=(0, [curl], []))
+        with patch('pycurl.Curl', Mock(return_value=curl)):
+            with patch('lib.multi.setup_curl', Mock()) as setup_curl:
+                with patch('lib.multi.read_curl_response', Mock(return_value=('', u'http://last.ru/'))):
+                    checker.add('key', 'http://url.ru/')
+                    finished = checker.perform(0.01)
+        self.assertEqual(setup_curl.call_count, 1)
+        self.assertEqual(setup_curl.call_args[0][1], u'http://next.ru/')
+        hop_cache.follow.assert_called_once_with(u'http://url.ru/', 3)
+        # the hop is stored and the rest of the chain is looked up in one call
+        hop_cache.remember.assert_called_once_with(u'http://next.ru/', (u'http://last.ru/', 'http_status'), 1)
+        self.assertEqual(finished, [('key', (['http_status', 'http_status', 'http_status'], [
+            'http://url.ru/', u'http://next.ru/', u'http://last.ru/', u'http://url.ru/'], []))])
+
+    def test_close(self):
+        multi = Mock()
+        checker = get_checker(multi)
+        curl = Mock()
+        with patch('pycurl.Curl', Mock(return_value=curl)):
+            checker.add('key', 'http://url.ru/')
+        checker.close()
+        self.assertTrue(curl.reset.called)
+        self.assertTrue(multi.close.called)
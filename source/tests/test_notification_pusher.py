@@ -1,12 +1,24 @@
+# coding: utf-8
+import json
+from multiprocessing import Pipe, Process
+import time
 import unittest
 from mock import patch, Mock, MagicMock, mock_open
 import notification_pusher
+from lib.cache import LRUCache
+from lib.circuit_breaker import CircuitBreaker
+from lib.host_limiter import HostLimiter, PendingTasks
+from lib.metrics import Registry
 from lib.utils import Config
+from tests.stub_server import StubServer
 from requests import RequestException
+from requests.exceptions import MissingSchema
 from gevent import queue as gevent_queue
 from threading import current_thread
 import os
 from gevent import sleep
+from gevent.monkey import patch_all
+import gevent
 import tarantool
 import tarantool_queue
 
@@ -15,6 +27,43 @@ def start_app():
     notification_pusher.run_application = True
 
 
+def push_with_main_loop(config, urls, conn):
+    """
+    Отправляет уведомления на urls настоящим main_loop из очереди-заглушки
+    и отправляет в conn словарь {номер урла: время от начала до ack задачи}.
+
+    Запускается в дочернем процессе: сокеты патчатся gevent'ом, как в main,
+    и это не должно задеть остальные тесты.
+    """
+    gevent.reinit()
+    # gevent 1.0 can not patch ssl of newer python 2.7 builds, callbacks here are plain http
+    patch_all(ssl=False)
+    left = [Mock(task_id=i, data={'callback_url': url, 'id': i}) for i, url in enumerate(urls)]
+    acked = {}
+    started = time.time()
+
+    def take_tasks(tube, count, timeout):
+        if not left:
+            sleep(timeout)
+        taken = left[:count]
+        del left[:count]
+        return taken
+
+    def ack_tasks(tasks):
+        for task in tasks:
+            acked[task.task_id] = time.time() - started
+        return set(task.task_id for task in tasks)
+
+    start_app()
+    with patch('notification_pusher.tarantool_queue.Queue', Mock()):
+        with patch('notification_pusher.take_tasks', take_tasks):
+            with patch.dict('notification_pusher.BULK_ACTIONS', ack=ack_tasks):
+                with patch('notification_pusher.break_func_for_test', lambda: len(acked) == len(urls)):
+                    with patch('notification_pusher.logger', Mock()):
+                        notification_pusher.main_loop(config)
+    conn.send(acked)
+
+
 def stop_app():
     notification_pusher.run_application = False
 
@@ -113,10 +162,13 @@ class NotificationPusherTestCase(unittest.TestCase):
         }
         task.data = data
         task.task_id = 42
-        with patch('requests.post', Mock(return_value=Mock(name = "response"))):
+        with patch('notification_pusher.http_session', Mock()) as http_session:
             with patch('notification_pusher.logger', Mock()) as logger:
-                notification_pusher.notification_worker(task,task_queue)
+                self.assertTrue(notification_pusher.notification_worker(task,task_queue))
         self.assertTrue(logger.info.called)
+        self.assertEqual(http_session.post.call_args[0][0], 'www.url.ru')
+        self.assertEqual(json.loads(http_session.post.call_args[1]['data']), {'id': 42})
+        self.assertEqual(task.data, {'callback_url': 'www.url.ru', 'id': 42})
 
     def test_notification_worker_unsuccess(self):
         task = Mock()
@@ -127,19 +179,57 @@ class NotificationPusherTestCase(unittest.TestCase):
         }
         task.data = data
         task.task_id = 42
-        with patch('requests.post', Mock(side_effect=RequestException("RequestException"))):
+        with patch('notification_pusher.http_session', Mock()) as http_session:
+            http_session.post = Mock(side_effect=RequestException("RequestException"))
             with patch('notification_pusher.logger', Mock()) as logger:
-                notification_pusher.notification_worker(task, task_queue)
+                self.assertFalse(notification_pusher.notification_worker(task, task_queue))
         self.assertTrue(logger.exception.called)
 
+    def test_notification_worker_malformed_url(self):
+        task = Mock(task_id=42, data={'callback_url': 'url.ru/callback', 'id': 42})
+        with patch('notification_pusher.http_session', Mock()) as http_session:
+            http_session.post = Mock(side_effect=MissingSchema('No schema supplied'))
+            with patch('notification_pusher.logger', Mock()):
+                self.assertIsNone(notification_pusher.notification_worker(task, Mock()))
+
     def test_done_with_processed_tasks_success(self):
         task_queue = Mock()
-        task_queue.qsize = Mock(return_value=10)
-        task = Mock()
-        task_queue.get_nowait = Mock(return_value=(task, 'action_name'))
-        with patch('notification_pusher.logger', Mock()) as logger:
-            notification_pusher.done_with_processed_tasks(task_queue)
+        task_queue.qsize = Mock(return_value=5)
+        task1, task2, task3, task4, task5 = Mock(), Mock(), Mock(), Mock(), Mock()
+        task_queue.get_nowait = Mock(side_effect=[
+            (task1, 'ack'), (task2, 'bury'), (task3, 'ack'), (task4, 'release', 10), (task5, 'release', 20)
+        ])
+        actions = {
+            'ack': Mock(return_value={1, 3}),
+            'bury': Mock(return_value={2}),
+            'release': Mock(side_effect=[{4}, set()]),
+        }
+        metrics = Registry()
+        with patch('notification_pusher.BULK_ACTIONS', actions):
+            with patch('notification_pusher.metrics', metrics):
+                with patch('notification_pusher.logger', Mock()) as logger:
+                    notification_pusher.done_with_processed_tasks(task_queue)
         self.assertTrue(logger.debug.called)
+        self.assertEqual(metrics.counters, {
+            ('pusher_tasks_acked_total', ()): 2,
+            ('pusher_tasks_buried_total', ()): 1,
+            ('pusher_tasks_released_total', ()): 1,
+        })
+        actions['ack'].assert_called_once_with([task1, task3])
+        actions['bury'].assert_called_once_with([task2])
+        self.assertEqual(actions['release'].call_count, 2)
+        actions['release'].assert_any_call([task4], 10)
+        actions['release'].assert_any_call([task5], 20)
+
+    def test_done_with_processed_tasks_database_error(self):
+        task_queue = Mock()
+        task_queue.qsize = Mock(return_value=1)
+        task_queue.get_nowait = Mock(return_value=(Mock(), 'ack'))
+        actions = {'ack': Mock(side_effect=tarantool.DatabaseError)}
+        with patch('notification_pusher.BULK_ACTIONS', actions):
+            with patch('notification_pusher.logger', Mock()) as logger:
+                notification_pusher.done_with_processed_tasks(task_queue)
+        self.assertTrue(logger.exception.called)
 
     def test_done_with_processed_tasks_empty_except(self):
         task_queue = Mock()
@@ -166,6 +256,23 @@ class NotificationPusherTestCase(unittest.TestCase):
         config.SLEEP = 0.01
         config.SLEEP_ON_FAIL = 5
         config.WORKER_POOL_SIZE = 15
+        config.HTTP_POOL_HOSTS = 10
+        config.HTTP_HOST_POOL_SIZE = {}
+        config.HTTP_POOL_STATS_INTERVAL = 0
+        config.HOST_MAX_CONCURRENCY = 1
+        config.HOST_LATENCY_THRESHOLD = 5
+        config.HOST_MAX_PENDING = 1
+        config.HOST_PENDING_TIMEOUT = 30
+        config.HOST_BUSY_RELEASE_DELAY = 3
+        config.CIRCUIT_FAILURE_THRESHOLD = 3
+        config.CIRCUIT_BASE_DELAY = 10
+        config.CIRCUIT_MAX_DELAY = 60
+        config.MAX_TASK_FAILURES = 2
+        config.TASK_FAILURES_CACHE_SIZE = 100
+        config.TASK_FAILURES_TTL = 3600
+        config.JSON_BACKEND = 'json'
+        config.METRICS_HOST = '127.0.0.1'
+        config.METRICS_PORT = None
         config.LOGGING = 5
         return config
 
@@ -175,16 +282,309 @@ class NotificationPusherTestCase(unittest.TestCase):
         worker.start = Mock(return_value=1)
         task = Mock()
         task.task_id = Mock(return_value=1)
+        task.data = {'callback_url': 'http://url.ru/'}
         tube = Mock()
         tube.take = Mock(return_value=task)
         queue = Mock()
         queue.tube = Mock(return_value=tube)
+        acker = Mock()
+        start_app()
         with patch('notification_pusher.tarantool_queue.Queue', Mock(return_value=queue)):
-            with patch('notification_pusher.Greenlet', Mock(return_value=worker)):
+            with patch('notification_pusher.Greenlet', Mock(side_effect=[acker, worker])):
                 with patch('notification_pusher.break_func_for_test', Mock(return_value=True)):
-                    with patch('notification_pusher.logger', Mock()) as logger:
-                        notification_pusher.main_loop(config)
+                    with patch('notification_pusher.take_tasks', Mock(return_value=[task])) as take_tasks:
+                        with patch('notification_pusher.logger', Mock()) as logger:
+                            notification_pusher.main_loop(config)
         self.assertTrue(logger.info.called)
+        take_tasks.assert_called_once_with(tube, config.WORKER_POOL_SIZE, config.QUEUE_TAKE_TIMEOUT)
+        self.assertEqual(worker.start.call_count, 1)
+        self.assertTrue(worker.link.called)
+        self.assertTrue(acker.start.called)
+        self.assertTrue(acker.join.called)
+
+    def test_main_loop_busy_host(self):
+        config = self.get_config()
+        tasks = [Mock(task_id=i, data={'callback_url': 'http://{}.ru/'.format(host)})
+                 for i, host in enumerate(('slow', 'slow', 'fast', 'slow'))]
+        workers = [Mock(), Mock()]
+        release_tasks = Mock(return_value={1, 3})
+        start_app()
+        with patch('notification_pusher.tarantool_queue.Queue', Mock()):
+            with patch('notification_pusher.Greenlet', Mock(side_effect=[Mock()] + workers)) as greenlet:
+                with patch('notification_pusher.break_func_for_test', Mock(return_value=True)):
+                    with patch('notification_pusher.take_tasks', Mock(return_value=tasks)):
+                        with patch.dict('notification_pusher.BULK_ACTIONS', release=release_tasks):
+                            with patch('notification_pusher.logger', Mock()):
+                                notification_pusher.main_loop(config)
+        self.assertEqual([call[0][1] for call in greenlet.call_args_list[1:]], [tasks[0], tasks[2]])
+        # tasks[1] waited for the slow host until the stop, tasks[3] did not fit into HOST_MAX_PENDING
+        self.assertEqual(sorted(release_tasks.call_args_list), sorted([
+            (([tasks[3]], config.HOST_BUSY_RELEASE_DELAY),), (([tasks[1]], 0),)
+        ]))
+        self.assertFalse(tasks[1].release.called)
+
+    def test_main_loop_busy_host_cancels_probe(self):
+        config = self.get_config()
+        task = Mock(task_id=1, data={'callback_url': 'http://down.ru/'})
+        circuit_breaker = Mock()
+        circuit_breaker.allow = Mock(return_value=True)
+        host_limiter = Mock()
+        host_limiter.acquire = Mock(return_value=False)
+        start_app()
+        with patch('notification_pusher.tarantool_queue.Queue', Mock()):
+            with patch('notification_pusher.Greenlet', Mock()) as greenlet:
+                with patch('notification_pusher.CircuitBreaker', Mock(return_value=circuit_breaker)):
+                    with patch('notification_pusher.HostLimiter', Mock(return_value=host_limiter)):
+                        with patch('notification_pusher.break_func_for_test', Mock(return_value=True)):
+                            with patch('notification_pusher.take_tasks', Mock(return_value=[task])):
+                                with patch.dict('notification_pusher.BULK_ACTIONS', release=Mock(return_value={1})):
+                                    with patch('notification_pusher.logger', Mock()):
+                                        notification_pusher.main_loop(config)
+        circuit_breaker.cancel.assert_called_once_with('down.ru')
+        self.assertEqual(greenlet.call_count, 1)
+
+    def test_main_loop_slow_host_does_not_block_healthy_hosts(self):
+        try:
+            import gevent.socket
+        except NameError:
+            # gevent 1.0 fails to import its ssl module on python builds without SSLv3
+            self.skipTest('gevent can not patch sockets here')
+        config = self.get_config()
+        config.WORKER_POOL_SIZE = 4
+        config.HOST_MAX_CONCURRENCY = 2
+        config.HOST_LATENCY_THRESHOLD = 10
+        config.HOST_MAX_PENDING = 10
+        config.HTTP_POOL_STATS_INTERVAL = 60
+        slow = StubServer(0.5)
+        fast = StubServer(0)
+        urls = [slow.url] * 4 + [fast.url + '?{}'.format(i) for i in xrange(8)]
+        conn, child_conn = Pipe()
+        pusher = Process(target=push_with_main_loop, args=(config, urls, child_conn))
+        try:
+            pusher.start()
+            self.assertTrue(conn.poll(10), 'pusher did not send all notifications')
+            acked = conn.recv()
+        finally:
+            if pusher.is_alive():
+                pusher.terminate()
+            pusher.join()
+            slow.shutdown()
+            fast.shutdown()
+        self.assertEqual(sorted(acked), range(len(urls)))
+        self.assertGreaterEqual(min(acked[i] for i in xrange(4)), 0.5)
+        # without the per-host limit the slow host takes all 4 slots and
+        # the healthy one waits for at least one slow response
+        self.assertLess(max(acked[i] for i in xrange(4, len(urls))), min(acked[i] for i in xrange(4)))
+
+    def test_main_loop_backs_off_when_nothing_started(self):
+        config = self.get_config()
+        task = Mock(task_id=1, data={'callback_url': 'http://down.ru/'})
+        circuit_breaker = Mock()
+        circuit_breaker.allow = Mock(return_value=False)
+        circuit_breaker.retry_delay = Mock(return_value=25)
+        event = Mock()
+        start_app()
+        with patch('notification_pusher.tarantool_queue.Queue', Mock()):
+            with patch('notification_pusher.Greenlet', Mock()):
+                with patch('notification_pusher.CircuitBreaker', Mock(return_value=circuit_breaker)):
+                    with patch('notification_pusher.Event', Mock(return_value=event)):
+                        with patch('notification_pusher.break_func_for_test', Mock(return_value=True)):
+                            with patch('notification_pusher.take_tasks', Mock(return_value=[task])):
+                                with patch.dict('notification_pusher.BULK_ACTIONS', release=Mock(return_value={1})):
+                                    with patch('notification_pusher.logger', Mock()):
+                                        notification_pusher.main_loop(config)
+        event.wait.assert_called_once_with(config.SLEEP)
+
+    def test_dispatcher_drains_pending_when_host_frees(self):
+        config = self.get_config()
+        pool = Mock()
+        pool.free_count = Mock(return_value=5)
+        host_limiter = HostLimiter(1)
+        pending = PendingTasks(10, 30)
+        tasks = [Mock(task_id=i, data={'callback_url': 'http://slow.ru/'}) for i in xrange(2)]
+        dispatcher = notification_pusher.Dispatcher(
+            config, pool, host_limiter, CircuitBreaker(3, 10, 60), pending, LRUCache(10, 60), Mock(), Mock()
+        )
+        with patch('notification_pusher.Greenlet', Mock()) as greenlet:
+            with patch('notification_pusher.logger', Mock()):
+                dispatcher.add(tasks)
+                self.assertEqual(len(pending), 1)
+                dispatcher.drain()
+                self.assertEqual(len(pending), 1)
+                host_limiter.release('slow.ru', 0.1)
+                dispatcher.drain()
+        self.assertEqual(len(pending), 0)
+        self.assertEqual([call[0][1] for call in greenlet.call_args_list], tasks)
+
+    def test_dispatcher_releases_expired_pending(self):
+        config = self.get_config()
+        task_queue = Mock()
+        pending = PendingTasks(10, 30)
+        task = Mock(task_id=1, data={'callback_url': 'http://slow.ru/'})
+        dispatcher = notification_pusher.Dispatcher(
+            config, Mock(), Mock(), Mock(), pending, LRUCache(10, 60), task_queue, Mock()
+        )
+        with patch('lib.host_limiter.time', Mock(return_value=100)):
+            pending.add('slow.ru', task)
+        with patch('lib.host_limiter.time', Mock(return_value=130)):
+            with patch('notification_pusher.logger', Mock()):
+                dispatcher.drain()
+        task_queue.put.assert_called_once_with((task, 'release', config.HOST_BUSY_RELEASE_DELAY))
+        self.assertEqual(len(pending), 0)
+
+    def test_worker_finished_success(self):
+        host_limiter = Mock()
+        circuit_breaker = Mock()
+        task_queue = Mock()
+        worker_done = Mock()
+        with patch('notification_pusher.time', Mock(return_value=15)):
+            notification_pusher.worker_finished(
+                host_limiter, circuit_breaker, task_queue, Mock(), 'a.ru', 10, worker_done, LRUCache(10, 60), 2, Mock(value=True)
+            )
+        host_limiter.release.assert_called_once_with('a.ru', 5, False)
+        circuit_breaker.success.assert_called_once_with('a.ru')
+        self.assertFalse(task_queue.put.called)
+        self.assertTrue(worker_done.set.called)
+
+    def test_worker_finished_failure(self):
+        host_limiter = Mock()
+        circuit_breaker = Mock()
+        circuit_breaker.failure = Mock(return_value=40)
+        task_queue = Mock()
+        task = Mock(task_id=7)
+        failures = LRUCache(10, 60)
+        worker_done = Mock()
+        with patch('notification_pusher.time', Mock(return_value=15)):
+            with patch('notification_pusher.logger', Mock()):
+                notification_pusher.worker_finished(
+                    host_limiter, circuit_breaker, task_queue, task, 'a.ru', 10, worker_done, failures, 2,
+                    Mock(value=False)
+                )
+        host_limiter.release.assert_called_once_with('a.ru', 5, True)
+        circuit_breaker.failure.assert_called_once_with('a.ru')
+        task_queue.put.assert_called_once_with((task, 'release', 40))
+        self.assertEqual(failures.get(7), 1)
+        self.assertTrue(worker_done.set.called)
+
+    def test_worker_finished_buries_after_max_failures(self):
+        host_limiter = Mock()
+        circuit_breaker = Mock()
+        task_queue = Mock()
+        task = Mock(task_id=7)
+        failures = LRUCache(10, 60)
+        failures.set(7, 1)
+        with patch('notification_pusher.time', Mock(return_value=15)):
+            with patch('notification_pusher.logger', Mock()):
+                notification_pusher.worker_finished(
+                    host_limiter, circuit_breaker, task_queue, task, 'a.ru', 10, Mock(), failures, 2,
+                    Mock(value=False)
+                )
+        circuit_breaker.failure.assert_called_once_with('a.ru')
+        task_queue.put.assert_called_once_with((task, 'bury'))
+
+    def test_busy_host_release_not_counted_as_failure(self):
+        config = self.get_config()
+        task_queue = Mock()
+        pool = Mock()
+        pool.free_count = Mock(return_value=5)
+        dispatcher = notification_pusher.Dispatcher(
+            config, pool, HostLimiter(1), CircuitBreaker(3, 10, 60), PendingTasks(0, 30), LRUCache(10, 60),
+            task_queue, Mock()
+        )
+        first, second = [Mock(task_id=i, data={'callback_url': 'http://slow.ru/'}) for i in xrange(2)]
+        workers = [Mock(), Mock()]
+        with patch('notification_pusher.Greenlet', Mock(side_effect=workers)):
+            with patch('notification_pusher.logger', Mock()):
+                dispatcher.add([first, second])
+                workers[0].link.call_args[0][0](Mock(value=True))
+                # the second task is taken again after the busy host release and fails once
+                dispatcher.add([second])
+                workers[1].link.call_args[0][0](Mock(value=False))
+        self.assertEqual([call[0][0] for call in task_queue.put.call_args_list], [
+            (second, 'release', config.HOST_BUSY_RELEASE_DELAY),
+            (second, 'release', 10),
+        ])
+
+    def test_worker_finished_buries_unsendable(self):
+        host_limiter = Mock()
+        circuit_breaker = Mock()
+        task_queue = Mock()
+        task = Mock(task_id=7)
+        worker_done = Mock()
+        with patch('notification_pusher.time', Mock(return_value=15)):
+            with patch('notification_pusher.logger', Mock()):
+                notification_pusher.worker_finished(
+                    host_limiter, circuit_breaker, task_queue, task, '', 10, worker_done, LRUCache(10, 60), 2, Mock(value=None)
+                )
+        host_limiter.release.assert_called_once_with('', 5, False)
+        self.assertFalse(circuit_breaker.failure.called)
+        circuit_breaker.cancel.assert_called_once_with('')
+        task_queue.put.assert_called_once_with((task, 'bury'))
+        self.assertTrue(worker_done.set.called)
+
+    def test_main_loop_open_circuit(self):
+        config = self.get_config()
+        task = Mock(task_id=1, data={'callback_url': 'http://down.ru/'})
+        circuit_breaker = Mock()
+        circuit_breaker.allow = Mock(return_value=False)
+        circuit_breaker.retry_delay = Mock(return_value=25)
+        release_tasks = Mock(return_value={1})
+        start_app()
+        with patch('notification_pusher.tarantool_queue.Queue', Mock()):
+            with patch('notification_pusher.Greenlet', Mock()) as greenlet:
+                with patch('notification_pusher.CircuitBreaker', Mock(return_value=circuit_breaker)):
+                    with patch('notification_pusher.break_func_for_test', Mock(return_value=True)):
+                        with patch('notification_pusher.take_tasks', Mock(return_value=[task])):
+                            with patch.dict('notification_pusher.BULK_ACTIONS', release=release_tasks):
+                                with patch('notification_pusher.logger', Mock()):
+                                    notification_pusher.main_loop(config)
+        circuit_breaker.allow.assert_called_once_with('down.ru')
+        release_tasks.assert_called_once_with([task], 25)
+        self.assertEqual(greenlet.call_count, 1)
+
+    def test_main_loop_waits_for_free_worker(self):
+        config = self.get_config()
+        config.WORKER_POOL_SIZE = 1
+        queue = Mock()
+        pool = MagicMock()
+        pool.free_count = Mock(return_value=0)
+        pool.__len__.return_value = 1
+        event = Mock()
+        metrics = Registry()
+        start_app()
+        with patch('notification_pusher.tarantool_queue.Queue', Mock(return_value=queue)):
+            with patch('notification_pusher.Greenlet', Mock()):
+                with patch('notification_pusher.Pool', Mock(return_value=pool)):
+                    with patch('notification_pusher.Event', Mock(return_value=event)):
+                        with patch('notification_pusher.break_func_for_test', Mock(return_value=True)):
+                            with patch('notification_pusher.take_tasks', Mock()) as take_tasks:
+                                with patch('notification_pusher.metrics', metrics):
+                                    with patch('notification_pusher.logger', Mock()):
+                                        notification_pusher.main_loop(config)
+        self.assertFalse(take_tasks.called)
+        event.wait.assert_called_once_with(config.SLEEP)
+        self.assertEqual(metrics.gauges[('pusher_workers_in_flight', ())], 1)
+        self.assertEqual(metrics.gauges[('pusher_pool_saturation', ())], 1.0)
+
+    def test_log_http_pool_stats(self):
+        stats = {('http', 'a.ru', 80): (3, 1)}
+        with patch('notification_pusher.get_pool_stats', Mock(return_value=stats)):
+            with patch('notification_pusher.logger', Mock()) as logger:
+                notification_pusher.log_http_pool_stats(Mock())
+        logger.info.assert_called_once_with('HTTP pool http://a.ru:80 hits=3 misses=1.')
+
+    def test_processed_tasks_worker(self):
+        task_queue = gevent_queue.Queue()
+        task_queue.put((Mock(), 'ack'))
+        stopped = Mock()
+        stopped.is_set = Mock(side_effect=[False, False, True])
+        queue_lock = MagicMock()
+        with patch('notification_pusher.done_with_processed_tasks', Mock()) as done:
+            notification_pusher.processed_tasks_worker(gevent_queue.Queue(), queue_lock, stopped, 0.001)
+            notification_pusher.processed_tasks_worker(task_queue, queue_lock, Mock(
+                is_set=Mock(side_effect=[False, True])), 0.001)
+        done.assert_called_once_with(task_queue)
+        self.assertTrue(queue_lock.__enter__.called)
 
     def test_main_loop_unsuccessful_while(self):
         config = self.get_config()
@@ -245,6 +645,23 @@ class NotificationPusherTestCase(unittest.TestCase):
                                         notification_pusher.main(argv)
         self.assertTrue(logger.info.called)
 
+    def test_main_serves_metrics(self):
+        args = Mock(daemon=False, pidfile=None, config='somepath')
+        config = self.get_config()
+        config.METRICS_PORT = 9100
+        with patch('notification_pusher.load_config_from_pyfile', Mock(return_value=config)):
+            with patch('notification_pusher.parse_cmd_args', Mock(return_value=args)):
+                with patch('notification_pusher.patch_all', Mock()):
+                    with patch('notification_pusher.dictConfig', Mock()):
+                        with patch('notification_pusher.install_signal_handlers', Mock()):
+                            with patch('notification_pusher.start_metrics_server', Mock()) as start_metrics_server:
+                                with patch('notification_pusher.logger', Mock()):
+                                    with patch('notification_pusher.while_is_workig', Mock(return_value=False)):
+                                        notification_pusher.main(['1'])
+        start_metrics_server.assert_called_once_with(
+            '127.0.0.1', 9100, notification_pusher.metrics.render
+        )
+
     def break_func_for_test(self):
         result = notification_pusher.break_func_for_test()
         self.assertFalse(result)
@@ -0,0 +1,114 @@
+# coding: utf-8
+import random
+import unittest
+from urllib import quote, quote_plus
+from urlparse import urlparse, urlunparse
+
+from mock import patch, Mock
+
+from lib import prepare_url, to_str, to_unicode
+from tests.fixtures import read_fixtures
+
+SEED = 20141018
+CASES = 3000
+
+
+def original_prepare_url(url):
+    """prepare_url без запоминания и пропуска IDNA и экранирования"""
+    if url is None:
+        return url
+    scheme, netloc, path, qs, anchor, fragments = urlparse(
+        to_unicode(url),
+        allow_fragments=False
+    )
+    try:
+        netloc = netloc.encode('idna')
+    except UnicodeError:
+        pass
+    path = quote(to_str(path, 'ignore'), safe='/%+$!*\'(),')
+    qs = quote_plus(to_str(qs, 'ignore'), safe=':&%=+$!*\'(),')
+    return urlunparse((scheme, netloc, path, qs, anchor, fragments))
+
+
+def read_corpus():
+    return [
+        line.decode('utf8') for name, content in read_fixtures('urls') for line in content.splitlines() if line
+    ]
+
+
+SCHEMES = [u'', u'http://', u'https://', u'HTTP://', u'//', u'ftp://', u'mailto:', u'http:', u'javascript:']
+HOSTS = [
+    u'', u'a.ru', u'WWW.Example.COM', u'пример.рф', u'xn--e1afmkfd.xn--p1ai', u'a..b', u'bücher.example',
+    u'user:pass@host:8080', u'127.0.0.1:80', u'[::1]', u'x' * 70 + u'.com', u'host.', u'例え.テスト',
+]
+ALPHABET = (
+    u'abcXYZ019_.-~/%+$!*\'(),;:&=?#@ "<>|^`{}[]\\\t' + u'абвЖЁ' + u'ü' + u'。' + u'😀'
+)
+
+
+def random_text(rnd, max_length):
+    return u''.join(rnd.choice(ALPHABET) for _ in xrange(rnd.randint(0, max_length)))
+
+
+def random_url(rnd):
+    url = rnd.choice(SCHEMES) + rnd.choice(HOSTS)
+    if rnd.random() < 0.8:
+        url += u'/' + random_text(rnd, 20)
+    if rnd.random() < 0.3:
+        url += u';' + random_text(rnd, 8)
+    if rnd.random() < 0.5:
+        url += u'?' + random_text(rnd, 20)
+    if rnd.random() < 0.2:
+        url += u'#' + random_text(rnd, 8)
+    if rnd.random() < 0.3:
+        url = to_str(url)
+    return url
+
+
+class PrepareUrlTestCase(unittest.TestCase):
+    def setUp(self):
+        prepare_url.clear()
+
+    def tearDown(self):
+        prepare_url.clear()
+
+    def assertSameResult(self, url):
+        try:
+            expected = original_prepare_url(url)
+        except (UnicodeError, ValueError) as e:
+            self.assertRaises(type(e), prepare_url, url)
+            return
+        for _ in xrange(2):
+            # the second call returns the memoized result
+            result = prepare_url(url)
+            self.assertEqual(result, expected, repr(url))
+            self.assertIs(type(result), type(expected), repr(url))
+
+    def test_corpus(self):
+        for url in read_corpus():
+            self.assertSameResult(url)
+            self.assertSameResult(to_str(url))
+
+    def test_random_urls(self):
+        rnd = random.Random(SEED)
+        for _ in xrange(CASES):
+            self.assertSameResult(random_url(rnd))
+
+    def test_random_bytes(self):
+        rnd = random.Random(SEED)
+        for _ in xrange(CASES):
+            self.assertSameResult('http://a.ru/' + ''.join(chr(rnd.randint(0, 255)) for _ in xrange(8)))
+
+    def test_none(self):
+        self.assertEqual(prepare_url(None), None)
+
+    def test_ascii_url_skips_idna_and_quoting(self):
+        with patch('lib.quote', Mock()) as quote_mock:
+            self.assertEqual(prepare_url('http://a.ru/path?q=1'), u'http://a.ru/path?q=1')
+        self.assertFalse(quote_mock.called)
+
+    def test_memoized(self):
+        with patch('lib.urlparse', Mock(wraps=urlparse)) as urlparse_mock:
+            prepare_url(u'http://a.ru/')
+            prepare_url('http://a.ru/')
+        self.assertEqual(urlparse_mock.call_count, 1)
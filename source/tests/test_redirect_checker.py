@@ -1,6 +1,8 @@
+import signal
 import unittest
 from mock import patch, Mock
 import redirect_checker
+from lib.metrics import Registry
 
 
 class RedirectCheckerTestCase(unittest.TestCase):
@@ -8,13 +10,16 @@ class RedirectCheckerTestCase(unittest.TestCase):
         test_config = Mock()
         test_config.WORKER_POOL_SIZE = 10
         test_config.SLEEP = 0.01
-        test_config.CHECK_URL = 0.01
+        test_config.WORKER_ENGINE = 'simple'
+        test_config.HOP_CACHE_SIZE = 0
+        test_config.RESULT_CACHE_SIZE = 0
+        test_config.METRICS_PORT = None
         test_pid = 42
         with patch('redirect_checker.logger', Mock()) as logger:
             with patch('os.getpid', Mock(return_value=test_pid)):
-                with patch('redirect_checker.check_network_status', Mock(return_value=True)):
-                    with patch('redirect_checker.active_children', Mock(return_value=list([1, 2, 3]))):
-                        with patch('redirect_checker.spawn_workers', Mock()):
+                with patch('redirect_checker.HealthMonitor', Mock(return_value=Mock(up=True))):
+                    with patch('redirect_checker.active_children', Mock(return_value=[Mock(pid=1), Mock(pid=2), Mock(pid=3)])):
+                        with patch('redirect_checker.spawn_workers', Mock(return_value=[])):
                             with patch('redirect_checker.break_func_for_test', Mock(return_value=True)):
                                 redirect_checker.main_loop(test_config)
         self.assertTrue(logger.info.called)
@@ -23,33 +28,171 @@ class RedirectCheckerTestCase(unittest.TestCase):
         test_config = Mock()
         test_config.WORKER_POOL_SIZE = 2
         test_config.SLEEP = 0.01
-        test_config.CHECK_URL = 0.01
+        test_config.WORKER_ENGINE = 'simple'
+        test_config.HOP_CACHE_SIZE = 0
+        test_config.RESULT_CACHE_SIZE = 0
+        test_config.METRICS_PORT = None
         test_pid = 42
         with patch('redirect_checker.logger', Mock()) as logger:
             with patch('os.getpid', Mock(return_value=test_pid)):
-                with patch('redirect_checker.check_network_status', Mock(return_value=True)):
-                    with patch('redirect_checker.active_children', Mock(return_value=list([1, 2, 3]))):
-                        with patch('redirect_checker.spawn_workers', Mock()):
+                with patch('redirect_checker.HealthMonitor', Mock(return_value=Mock(up=True))):
+                    with patch('redirect_checker.active_children', Mock(return_value=[Mock(pid=1), Mock(pid=2), Mock(pid=3)])):
+                        with patch('redirect_checker.spawn_workers', Mock(return_value=[])):
                             with patch('redirect_checker.break_func_for_test', Mock(return_value=True)):
                                 redirect_checker.main_loop(test_config)
         self.assertTrue(logger.info.called)
 
 
-    def test_main_loop_check_network_status_false(self):
+    def test_main_loop_network_down(self):
         test_config = Mock()
         test_config.WORKER_POOL_SIZE = 10
         test_config.SLEEP = 0.01
-        test_config.CHECK_URL = 0.01
+        test_config.WORKER_ENGINE = 'simple'
+        test_config.HOP_CACHE_SIZE = 0
+        test_config.RESULT_CACHE_SIZE = 0
+        test_config.METRICS_PORT = None
         test_pid = 42
-        proc = Mock()
-        proc.terminate = Mock()
+        proc = Mock(pid=7)
         with patch('redirect_checker.logger', Mock()) as logger:
             with patch('os.getpid', Mock(return_value=test_pid)):
-                with patch('redirect_checker.check_network_status', Mock(return_value=False)):
+                with patch('redirect_checker.HealthMonitor', Mock(return_value=Mock(up=False))):
                     with patch('redirect_checker.active_children', Mock(return_value=list([proc, proc, proc]))):
-                        with patch('redirect_checker.break_func_for_test', Mock(return_value=True)):
-                            redirect_checker.main_loop(test_config)
+                        with patch('redirect_checker.spawn_workers', Mock(return_value=[])) as spawn_workers:
+                            with patch('redirect_checker.os.kill', Mock()) as kill:
+                                with patch('redirect_checker.break_func_for_test', Mock(return_value=True)):
+                                    redirect_checker.main_loop(test_config)
         self.assertTrue(logger.critical.called)
+        # workers are paused, not killed in the middle of their tasks
+        self.assertEqual(kill.call_args_list, [((7, signal.SIGUSR1),)] * 3)
+        self.assertFalse(proc.terminate.called)
+        self.assertFalse(spawn_workers.called)
+
+    def test_main_loop_follows_health_status(self):
+        test_config = Mock()
+        test_config.WORKER_POOL_SIZE = 1
+        test_config.SLEEP = 10
+        test_config.WORKER_ENGINE = 'simple'
+        test_config.HOP_CACHE_SIZE = 0
+        test_config.RESULT_CACHE_SIZE = 0
+        test_config.METRICS_PORT = None
+        health = Mock(up=True)
+        statuses = [False, False, True, True]
+
+        def wait(timeout):
+            health.up = statuses.pop(0)
+
+        child_watcher = Mock()
+        child_watcher.wait = Mock(side_effect=wait)
+        with patch('redirect_checker.logger', Mock()):
+            with patch('redirect_checker.HealthMonitor', Mock(return_value=health)):
+                with patch('redirect_checker.ChildWatcher', Mock(return_value=child_watcher)):
+                    with patch('redirect_checker.active_children', Mock(return_value=[Mock(pid=7)])):
+                        with patch('redirect_checker.spawn_workers', Mock(return_value=[])):
+                            with patch('redirect_checker.os.kill', Mock()) as kill:
+                                with patch('redirect_checker.break_func_for_test', Mock(side_effect=[False] * 3 + [True])):
+                                    redirect_checker.main_loop(test_config)
+        self.assertTrue(health.start.called)
+        self.assertTrue(health.stop.called)
+        self.assertEqual(kill.call_args_list, [
+            ((7, signal.SIGUSR1),), ((7, signal.SIGUSR1),), ((7, signal.SIGUSR2),),
+        ])
+
+    def test_stop_workers_waits_for_drain(self):
+        stopped, stuck = Mock(pid=1), Mock(pid=2)
+        child_watcher = Mock()
+        with patch('redirect_checker.logger', Mock()):
+            with patch('redirect_checker.active_children', Mock(side_effect=[[stopped, stuck], [stuck], [stuck]])):
+                with patch('redirect_checker.time', Mock(side_effect=[0, 0, 0, 4, 4, 11])):
+                    with patch('redirect_checker.os.kill', Mock()) as kill:
+                        redirect_checker.stop_workers(child_watcher, 10)
+        self.assertTrue(stopped.terminate.called)
+        self.assertTrue(stuck.terminate.called)
+        self.assertEqual(child_watcher.wait.call_args_list, [((10,),), ((6,),)])
+        kill.assert_called_once_with(2, signal.SIGKILL)
+
+    def test_stop_workers_all_drained(self):
+        worker = Mock(pid=1)
+        with patch('redirect_checker.active_children', Mock(side_effect=[[worker], []])):
+            with patch('redirect_checker.os.kill', Mock()) as kill:
+                redirect_checker.stop_workers(Mock(), 10)
+        self.assertTrue(worker.terminate.called)
+        self.assertFalse(kill.called)
+
+    def test_main_loop_drains_on_stop_signal(self):
+        test_config = Mock()
+        test_config.WORKER_POOL_SIZE = 1
+        test_config.SLEEP = 10
+        test_config.WORKER_ENGINE = 'simple'
+        test_config.HOP_CACHE_SIZE = 0
+        test_config.RESULT_CACHE_SIZE = 0
+        test_config.METRICS_PORT = None
+
+        def stop(*args):
+            redirect_checker.stop_handler(signal.SIGTERM, None)
+
+        child_watcher = Mock()
+        child_watcher.wait = Mock(side_effect=stop)
+        try:
+            with patch('redirect_checker.logger', Mock()):
+                with patch('redirect_checker.ChildWatcher', Mock(return_value=child_watcher)):
+                    with patch('redirect_checker.HealthMonitor', Mock(return_value=Mock(up=True))):
+                        with patch('redirect_checker.active_children', Mock(return_value=[Mock()])):
+                            with patch('redirect_checker.stop_workers', Mock()) as stop_workers:
+                                redirect_checker.main_loop(test_config)
+        finally:
+            redirect_checker.run_application = True
+        stop_workers.assert_called_once_with(child_watcher, test_config.DRAIN_TIMEOUT, None)
+        self.assertTrue(child_watcher.close.called)
+
+    def test_main_loop_pauses_workers(self):
+        test_config = Mock()
+        test_config.WORKER_POOL_SIZE = 2
+        test_config.SLEEP = 10
+        test_config.WORKER_ENGINE = 'simple'
+        test_config.HOP_CACHE_SIZE = 0
+        test_config.RESULT_CACHE_SIZE = 0
+        test_config.METRICS_PORT = None
+        redirect_checker.pause_handler(signal.SIGUSR1, None)
+        try:
+            with patch('redirect_checker.logger', Mock()):
+                with patch('redirect_checker.ChildWatcher', Mock()):
+                    with patch('redirect_checker.HealthMonitor', Mock(return_value=Mock(up=True))):
+                        with patch('redirect_checker.active_children', Mock(return_value=[Mock(pid=7)])):
+                            with patch('redirect_checker.spawn_workers', Mock(return_value=[])) as spawn_workers:
+                                with patch('redirect_checker.os.kill', Mock()) as kill:
+                                    with patch('redirect_checker.break_func_for_test', Mock(return_value=True)):
+                                        redirect_checker.main_loop(test_config)
+        finally:
+            redirect_checker.pause_handler(signal.SIGUSR2, None)
+        kill.assert_called_once_with(7, signal.SIGUSR1)
+        self.assertFalse(spawn_workers.called)
+
+    def test_main_loop_hop_cache(self):
+        test_config = Mock()
+        test_config.WORKER_POOL_SIZE = 2
+        test_config.SLEEP = 0.01
+        test_config.WORKER_ENGINE = 'multi'
+        test_config.HOP_CACHE_SIZE = 100
+        test_config.HOP_CACHE_TTL = 60
+        test_config.RESULT_CACHE_SIZE = 0
+        test_config.METRICS_PORT = None
+        manager = Mock()
+        manager._process.pid = 2
+        workers = [Mock(pid=1), Mock(pid=2)]
+        with patch('redirect_checker.logger', Mock()):
+            with patch('redirect_checker.start_cache_manager', Mock(return_value=manager)):
+                with patch('redirect_checker.HealthMonitor', Mock(return_value=Mock(up=True))):
+                    with patch('redirect_checker.active_children', Mock(return_value=workers)):
+                        with patch('redirect_checker.spawn_workers', Mock(return_value=[])) as spawn_workers:
+                            with patch('redirect_checker.ChildWatcher', Mock()):
+                                with patch('redirect_checker.break_func_for_test', Mock(return_value=True)):
+                                    redirect_checker.main_loop(test_config)
+        manager.HopCache.assert_called_once_with(100, 60)
+        self.assertEqual(spawn_workers.call_args[1]['num'], 1)
+        self.assertEqual(spawn_workers.call_args[1]['kwargs'], {
+            'hop_cache': manager.HopCache.return_value, 'metrics': None, 'result_cache': None
+        })
+        self.assertTrue(manager.shutdown.called)
 
     def test_main_true(self):
         args = Mock()
@@ -58,20 +201,24 @@ class RedirectCheckerTestCase(unittest.TestCase):
         config = Mock()
         config.LOGGING = Mock()
         config.EXIT_CODE = 0
+        config.DOMAIN_RULES = [{'type': 'skip', 'host': 'a.ru'}]
         with patch('redirect_checker.parse_cmd_args', Mock(return_value=args)):
             with patch('redirect_checker.daemonize', Mock()) as daemonize:
                 with patch('redirect_checker.create_pidfile', Mock()) as create_pidfile:
                     with patch('redirect_checker.dictConfig', Mock()) as dictConfig:
-                        with patch('redirect_checker.main_loop', Mock()) as main_loop:
-                            with patch('redirect_checker.load_config_from_pyfile', Mock(return_value=config)):
-                                with patch('os.path.realpath', Mock()):
-                                    with patch('os.path.expanduser', Mock()):
-                                        res = redirect_checker.main('argv')
-                                        self.assertTrue(daemonize.called)
-                                        self.assertTrue(create_pidfile.called)
-                                        self.assertTrue(dictConfig.called)
-                                        self.assertTrue(main_loop.called)
-                                        self.assertEqual(config.EXIT_CODE, res)
+                        with patch('redirect_checker.install_signal_handlers', Mock()):
+                            with patch('redirect_checker.set_domain_rules', Mock()) as set_domain_rules:
+                                with patch('redirect_checker.main_loop', Mock()) as main_loop:
+                                    with patch('redirect_checker.load_config_from_pyfile', Mock(return_value=config)):
+                                        with patch('os.path.realpath', Mock()):
+                                            with patch('os.path.expanduser', Mock()):
+                                                res = redirect_checker.main('argv')
+                                                self.assertTrue(daemonize.called)
+                                                self.assertTrue(create_pidfile.called)
+                                                self.assertTrue(dictConfig.called)
+                                                self.assertTrue(main_loop.called)
+                                                self.assertEqual(len(set_domain_rules.call_args[0][0]), 1)
+                                                self.assertEqual(config.EXIT_CODE, res)
 
     def test_main_false(self):
         args = Mock()
@@ -80,20 +227,110 @@ class RedirectCheckerTestCase(unittest.TestCase):
         config = Mock()
         config.LOGGING = Mock()
         config.EXIT_CODE = 0
+        config.DOMAIN_RULES = [{'type': 'skip', 'host': 'a.ru'}]
         with patch('redirect_checker.parse_cmd_args', Mock(return_value=args)):
             with patch('redirect_checker.daemonize', Mock()) as daemonize:
                 with patch('redirect_checker.create_pidfile', Mock()) as create_pidfile:
                     with patch('redirect_checker.dictConfig', Mock()) as dictConfig:
-                        with patch('redirect_checker.main_loop', Mock()) as main_loop:
-                            with patch('redirect_checker.load_config_from_pyfile', Mock(return_value=config)):
-                                with patch('os.path.realpath', Mock()):
-                                    with patch('os.path.expanduser', Mock()):
-                                        res = redirect_checker.main('argv')
-                                        self.assertFalse(daemonize.called)
-                                        self.assertFalse(create_pidfile.called)
-                                        self.assertTrue(dictConfig.called)
-                                        self.assertTrue(main_loop.called)
-                                        self.assertEqual(config.EXIT_CODE, res)
+                        with patch('redirect_checker.install_signal_handlers', Mock()):
+                            with patch('redirect_checker.set_domain_rules', Mock()) as set_domain_rules:
+                                with patch('redirect_checker.main_loop', Mock()) as main_loop:
+                                    with patch('redirect_checker.load_config_from_pyfile', Mock(return_value=config)):
+                                        with patch('os.path.realpath', Mock()):
+                                            with patch('os.path.expanduser', Mock()):
+                                                res = redirect_checker.main('argv')
+                                                self.assertFalse(daemonize.called)
+                                                self.assertFalse(create_pidfile.called)
+                                                self.assertTrue(dictConfig.called)
+                                                self.assertTrue(main_loop.called)
+                                                self.assertEqual(len(set_domain_rules.call_args[0][0]), 1)
+                                                self.assertEqual(config.EXIT_CODE, res)
+
+    def test_main_loop_metrics(self):
+        test_config = Mock()
+        test_config.WORKER_POOL_SIZE = 2
+        test_config.SLEEP = 0.01
+        test_config.WORKER_ENGINE = 'simple'
+        test_config.HOP_CACHE_SIZE = 0
+        test_config.RESULT_CACHE_SIZE = 0
+        test_config.METRICS_HOST = '127.0.0.1'
+        test_config.METRICS_PORT = 9100
+        manager = Mock()
+        manager._process.pid = 2
+        metrics = manager.MetricsRegistry.return_value
+        with patch('redirect_checker.logger', Mock()):
+            with patch('redirect_checker.start_cache_manager', Mock(return_value=manager)):
+                with patch('redirect_checker.start_metrics_server', Mock()) as start_metrics_server:
+                    with patch('redirect_checker.HealthMonitor', Mock(return_value=Mock(up=True))):
+                        with patch('redirect_checker.active_children', Mock(return_value=[Mock(pid=1)])):
+                            with patch('redirect_checker.spawn_workers', Mock(return_value=[])) as spawn_workers:
+                                with patch('redirect_checker.update_pool_metrics', Mock()) as update_pool_metrics:
+                                    with patch('redirect_checker.ChildWatcher', Mock()):
+                                        with patch('redirect_checker.break_func_for_test', Mock(return_value=True)):
+                                            redirect_checker.main_loop(test_config)
+        start_metrics_server.assert_called_once_with('127.0.0.1', 9100, metrics.render)
+        self.assertEqual(spawn_workers.call_args[1]['kwargs'], {
+            'hop_cache': None, 'metrics': metrics, 'result_cache': None
+        })
+        self.assertEqual(update_pool_metrics.call_args[0][0], metrics)
+        manager.shutdown.assert_called_once_with()
+
+    def test_main_loop_respawns_on_child_exit(self):
+        test_config = Mock()
+        test_config.WORKER_POOL_SIZE = 2
+        test_config.SLEEP = 10
+        test_config.WORKER_ENGINE = 'simple'
+        test_config.HOP_CACHE_SIZE = 0
+        test_config.RESULT_CACHE_SIZE = 0
+        test_config.METRICS_PORT = None
+        child_watcher = Mock()
+        with patch('redirect_checker.logger', Mock()):
+            with patch('redirect_checker.warm_up', Mock()) as warm_up:
+                with patch('redirect_checker.ChildWatcher', Mock(return_value=child_watcher)):
+                    with patch('redirect_checker.HealthMonitor', Mock(return_value=Mock(up=True))):
+                        with patch('redirect_checker.active_children', Mock(side_effect=[[], [Mock()]])):
+                            with patch('redirect_checker.spawn_workers', Mock(return_value=[])) as spawn_workers:
+                                with patch('redirect_checker.break_func_for_test', Mock(side_effect=[False, True])):
+                                    redirect_checker.main_loop(test_config)
+        self.assertTrue(warm_up.called)
+        self.assertEqual([call[1]['num'] for call in spawn_workers.call_args_list], [2, 1])
+        self.assertEqual(child_watcher.wait.call_count, 2)
+        self.assertTrue(child_watcher.close.called)
+
+    def test_main_loop_backs_off_quickly_exiting_workers(self):
+        test_config = Mock()
+        test_config.WORKER_POOL_SIZE = 2
+        test_config.SLEEP = 10
+        test_config.WORKER_ENGINE = 'simple'
+        test_config.HOP_CACHE_SIZE = 0
+        test_config.RESULT_CACHE_SIZE = 0
+        test_config.METRICS_PORT = None
+        test_config.RESPAWN_MIN_LIFETIME = 5
+        test_config.RESPAWN_DELAY = 1
+        test_config.RESPAWN_MAX_DELAY = 60
+        child_watcher = Mock()
+        with patch('redirect_checker.logger', Mock()):
+            with patch('redirect_checker.warm_up', Mock()):
+                with patch('redirect_checker.ChildWatcher', Mock(return_value=child_watcher)):
+                    with patch('redirect_checker.HealthMonitor', Mock(return_value=Mock(up=True))):
+                        with patch('redirect_checker.active_children', Mock(return_value=[])):
+                            with patch('redirect_checker.spawn_workers',
+                                       Mock(side_effect=lambda **kwargs: [Mock(pid=1), Mock(pid=2)])) as spawn_workers:
+                                with patch('redirect_checker.break_func_for_test', Mock(side_effect=[False, True])):
+                                    redirect_checker.main_loop(test_config)
+        self.assertEqual(spawn_workers.call_count, 1)
+        # the second turn waits for the respawn delay instead of the whole SLEEP
+        self.assertLessEqual(child_watcher.wait.call_args_list[1][0][0], 1)
+
+    def test_update_pool_metrics(self):
+        metrics = Registry()
+        for pid, capacity, in_flight in ((1, 10, 10), (2, 10, 5), (3, 1, 1)):
+            metrics.set('checker_worker_capacity', capacity, worker=pid)
+            metrics.set('checker_tasks_in_flight', in_flight, worker=pid)
+        redirect_checker.update_pool_metrics(metrics, [Mock(pid=1), Mock(pid=2)], 3)
+        self.assertEqual(metrics.gauges[('checker_workers', ())], 2)
+        self.assertEqual(metrics.gauges[('checker_worker_pool_size', ())], 3)
+        self.assertEqual(metrics.gauges[('checker_pool_saturation', ())], 0.75)
 
     def break_func_for_test(self):
         result = redirect_checker.break_func_for_test()
@@ -0,0 +1,36 @@
+import unittest
+import pycurl
+from mock import patch, Mock
+from lib import retry
+
+
+class RetryTestCase(unittest.TestCase):
+    def test_classify_error(self):
+        self.assertEqual(retry.classify_error(pycurl.error(pycurl.E_COULDNT_RESOLVE_HOST, '')), retry.DNS)
+        self.assertEqual(retry.classify_error(pycurl.error(pycurl.E_OPERATION_TIMEDOUT, '')), retry.TIMEOUT)
+        self.assertEqual(retry.classify_error(pycurl.error(pycurl.E_COULDNT_CONNECT, '')), retry.REFUSED)
+        self.assertEqual(retry.classify_error(pycurl.error(pycurl.E_SSL_CONNECT_ERROR, '')), retry.TLS)
+        self.assertEqual(retry.classify_error(pycurl.error(pycurl.E_RECV_ERROR, '')), retry.OTHER)
+
+    def test_classify_unknown_error(self):
+        self.assertEqual(retry.classify_error(ValueError('bad url')), retry.OTHER)
+        self.assertEqual(retry.classify_error(pycurl.error()), retry.OTHER)
+        self.assertEqual(retry.classify_error(None), retry.OTHER)
+
+    def test_attempts(self):
+        policy = retry.RetryPolicy({retry.TIMEOUT: {'attempts': 3, 'delay': 60}}, 3600, 0)
+        self.assertEqual(policy.attempts(retry.TIMEOUT), 3)
+        self.assertEqual(policy.attempts(retry.TLS), 0)
+
+    def test_delay_exponential_and_capped(self):
+        policy = retry.RetryPolicy({retry.TIMEOUT: {'attempts': 10, 'delay': 60}}, 300, 0)
+        self.assertEqual([policy.delay(retry.TIMEOUT, attempt) for attempt in xrange(1, 5)], [60, 120, 240, 300])
+
+    def test_delay_jitter(self):
+        policy = retry.RetryPolicy({retry.DNS: {'attempts': 2, 'delay': 100}}, 3600, 0.5)
+        with patch('lib.retry.random.uniform', Mock(return_value=0.25)) as uniform:
+            self.assertEqual(policy.delay(retry.DNS, 2), 150)
+        uniform.assert_called_once_with(0, 0.5)
+        delays = set(policy.delay(retry.DNS, 1) for _ in xrange(100))
+        self.assertTrue(all(50 <= delay <= 100 for delay in delays))
+        self.assertGreater(len(delays), 1)
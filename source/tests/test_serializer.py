@@ -0,0 +1,39 @@
+import json
+import unittest
+from mock import patch, Mock
+from lib import serializer
+
+
+class SerializerTestCase(unittest.TestCase):
+    def test_get_json_backend_auto(self):
+        with patch('lib.serializer.import_module', Mock(side_effect=[ImportError, json])) as import_module:
+            self.assertEqual(serializer.get_json_backend(), ('simplejson', json.dumps))
+        self.assertEqual(import_module.call_count, 2)
+
+    def test_get_json_backend_by_name(self):
+        self.assertEqual(serializer.get_json_backend('json'), ('json', json.dumps))
+
+    def test_get_json_backend_not_installed(self):
+        with patch('lib.serializer.import_module', Mock(side_effect=ImportError)):
+            self.assertRaises(ImportError, serializer.get_json_backend, 'ujson')
+
+    def test_get_json_backend_unknown(self):
+        self.assertRaises(ValueError, serializer.get_json_backend, 'pickle')
+
+    def test_dumps_without(self):
+        data = {'callback_url': 'http://a.ru/', 'a': u'\u0442\u0435\u0441\u0442'}
+        url, result = serializer.dumps_without(data, 'callback_url', 'id', 42, json.dumps)
+        self.assertEqual(url, 'http://a.ru/')
+        self.assertEqual(json.loads(result), {'a': u'\u0442\u0435\u0441\u0442', 'id': 42})
+        self.assertEqual(data, {'callback_url': 'http://a.ru/', 'a': u'\u0442\u0435\u0441\u0442'})
+
+    def test_dumps_without_replaces_value(self):
+        data = {'callback_url': 'http://a.ru/', 'id': 'old'}
+        url, result = serializer.dumps_without(data, 'callback_url', 'id', 42, json.dumps)
+        self.assertEqual(json.loads(result), {'id': 42})
+        self.assertEqual(data, {'callback_url': 'http://a.ru/', 'id': 'old'})
+
+    def test_dumps_without_restores_data_on_error(self):
+        data = {'callback_url': 'http://a.ru/', 'a': 1}
+        self.assertRaises(TypeError, serializer.dumps_without, data, 'callback_url', 'id', object(), json.dumps)
+        self.assertEqual(data, {'callback_url': 'http://a.ru/', 'a': 1})
@@ -0,0 +1,97 @@
+# coding: utf-8
+import os
+import shutil
+import tempfile
+import unittest
+
+import pycurl
+from mock import patch, Mock
+
+from lib.metrics import Registry
+from lib.timing import Profiler, TaskTiming, get_timing_sink, log_timing, observe_timing
+
+
+def get_curl(times):
+    curl = Mock()
+    curl.getinfo = Mock(side_effect=lambda info: times[info])
+    return curl
+
+
+CURL_TIMES = {
+    pycurl.NAMELOOKUP_TIME: 0.01,
+    pycurl.CONNECT_TIME: 0.02,
+    pycurl.APPCONNECT_TIME: 0.05,
+    pycurl.STARTTRANSFER_TIME: 0.1,
+    pycurl.TOTAL_TIME: 0.2,
+}
+
+
+def sink(timing):
+    pass
+
+
+class TimingTestCase(unittest.TestCase):
+    def test_add_hop(self):
+        timing = TaskTiming('id')
+        timing.add_hop('http://a.ru/', get_curl(CURL_TIMES))
+        self.assertEqual(timing.hops, [('http://a.ru/', {
+            'namelookup': 0.01, 'connect': 0.02, 'appconnect': 0.05, 'starttransfer': 0.1, 'total': 0.2,
+        })])
+
+    def test_call_sums_stage(self):
+        timing = TaskTiming('id')
+        with patch('lib.timing.time', Mock(side_effect=[0, 0.5, 1, 1.25])):
+            self.assertEqual(timing.call('get_counters', len, 'abc'), 3)
+            self.assertRaises(TypeError, timing.call, 'get_counters', len, None)
+        self.assertEqual(timing.stages, {'get_counters': 0.75})
+
+    def test_log_timing(self):
+        with patch('lib.timing.time', Mock(side_effect=[10, 10.5])):
+            timing = TaskTiming('id')
+            timing.finish()
+        timing.add_stage('check_for_meta', 0.001)
+        timing.add_hop(u'http://a.ru/', get_curl(CURL_TIMES))
+        with patch('lib.timing.logger', Mock()) as logger:
+            log_timing(timing)
+        logger.info.assert_called_once_with(
+            u'Task id=id timing: total=0.5000 check_for_meta=0.0010 [http://a.ru/ namelookup=0.0100 '
+            u'connect=0.0200 appconnect=0.0500 starttransfer=0.1000 total=0.2000]'
+        )
+
+    def test_observe_timing(self):
+        timing = TaskTiming('id')
+        timing.add_stage('get_counters', 0.001)
+        timing.add_hop('http://a.ru/', get_curl(CURL_TIMES))
+        timing.add_hop('http://b.ru/', get_curl(CURL_TIMES))
+        metrics = Registry()
+        observe_timing(metrics, timing)
+        self.assertEqual(metrics.histograms[('checker_hop_seconds', (('phase', 'total'),))][2], 2)
+        self.assertEqual(metrics.histograms[('checker_stage_seconds', (('stage', 'get_counters'),))][2], 1)
+
+    def test_get_timing_sink(self):
+        metrics = Mock()
+        self.assertEqual(get_timing_sink(None), None)
+        self.assertEqual(get_timing_sink('log'), log_timing)
+        get_timing_sink('metrics', metrics)(TaskTiming('id'))
+        self.assertEqual(get_timing_sink('tests.test_timing.sink'), sink)
+        self.assertRaises(ValueError, get_timing_sink, 'unknown')
+
+    def test_profiler_samples_every_nth(self):
+        directory = tempfile.mkdtemp()
+        try:
+            profiler = Profiler(2, os.path.join(directory, 'profiles'))
+            with patch('lib.timing.logger', Mock()):
+                for task_id in xrange(4):
+                    with profiler.sample(task_id):
+                        sum(xrange(100))
+            files = sorted(os.listdir(os.path.join(directory, 'profiles')))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(files, ['{}-2-1.prof'.format(os.getpid()), '{}-4-3.prof'.format(os.getpid())])
+
+    def test_profiler_disabled(self):
+        profiler = Profiler(0, '/nonexistent')
+        with patch('lib.timing.cProfile.Profile', Mock()) as profile:
+            with profiler.sample('id'):
+                pass
+        self.assertFalse(profile.called)
@@ -1,6 +1,10 @@
 import unittest
 from mock import patch, Mock, MagicMock, mock_open
+from multiprocessing import Process
+import msgpack
+import signal
 import socket
+import time
 import urllib2
 from lib import utils
 
@@ -82,9 +86,181 @@ class UtilsTestCase(unittest.TestCase):
         self.assertEquals(tube.queue.port, 80)
         self.assertEquals(tube.queue.space, 5)
 
+    def test_take_task(self):
+        tube = Mock()
+        tube.queue.space = 5
+        tube.opt = {'tube': 'name'}
+        response = MagicMock()
+        response.rowcount = 1
+        response.__getitem__ = Mock(return_value=('task_id', 'name', 'taken', 'data', '-3'))
+        tube.queue.tnt.call = Mock(return_value=response)
+        task = utils.take_task(tube, 0.1)
+        tube.queue.tnt.call.assert_called_once_with('queue.take', ('5', 'name', '0.1'))
+        self.assertEqual(task.task_id, 'task_id')
+        self.assertEqual(task.raw_data, 'data')
+        self.assertEqual(task.pri, -3)
+        task.modified = True
+
+    def test_take_task_empty(self):
+        tube = Mock()
+        tube.opt = {'tube': 'name'}
+        tube.queue.tnt.call = Mock(return_value=Mock(rowcount=0))
+        self.assertIsNone(utils.take_task(tube, 0.1))
+
+    def test_take_tasks(self):
+        tube = Mock()
+        tube.queue.space = 5
+        tube.opt = {'tube': 'name'}
+        rows = [('id1', 'name', 'taken', 'data1', '0'), ('id2', 'name', 'taken', 'data2', '1')]
+        tube.queue.tnt.call = Mock(return_value=rows)
+        tasks = utils.take_tasks(tube, 10, 0.1)
+        tube.queue.tnt.call.assert_called_once_with('queue.take_many', ('5', 'name', '10', '0.1'))
+        self.assertEqual([(task.task_id, task.pri) for task in tasks], [('id1', 0), ('id2', 1)])
+        for task in tasks:
+            task.modified = True
+
+    def test_put_tasks(self):
+        tube = Mock()
+        tube.queue.space = 5
+        tube.opt = {'tube': 'name', 'delay': 0, 'ttl': 0, 'ttr': 0, 'pri': 0}
+        tube.serialize = Mock(side_effect=lambda data: 'serialized ' + data)
+        tube.queue.tnt.call = Mock(return_value=[('id1',), ('id2',)])
+        count = utils.put_tasks(tube, [('data1', {}), ('data2', {'delay': 300, 'pri': 5})])
+        tube.queue.tnt.call.assert_called_once_with('queue.put_many', (
+            '5', 'name', '0', '0', '0', '0', 'serialized data1', '300', '0', '0', '5', 'serialized data2'
+        ))
+        self.assertEqual(count, 2)
+
+    def test_put_tasks_empty(self):
+        tube = Mock()
+        self.assertEqual(utils.put_tasks(tube, []), 0)
+        self.assertFalse(tube.queue.tnt.call.called)
+
+    def test_put_unique_tasks(self):
+        tube = Mock()
+        tube.queue.space = 5
+        tube.opt = {'tube': 'name', 'delay': 0, 'ttl': 0, 'ttr': 0, 'pri': 0}
+        tube.serialize = Mock(side_effect=msgpack.packb)
+        tube.queue.tnt.call = Mock(return_value=[('id1',)])
+        data = {'url_id': 1, 'url': 'http://a.ru/', 'recheck': True, 'result': [{'b': 1, 'a': 2}]}
+        count = utils.put_unique_tasks(tube, [(data, {'delay': 300, 'pri': 5})])
+        self.assertEqual(tube.queue.tnt.call.call_args[0][0], 'queue.put_unique_many')
+        self.assertEqual(tube.queue.tnt.call.call_args[0][1][:6], ('5', 'name', '300', '0', '0', '5'))
+        self.assertEqual(msgpack.unpackb(tube.queue.tnt.call.call_args[0][1][6]), data)
+        self.assertEqual(count, 1)
+
+    def test_put_unique_tasks_empty(self):
+        tube = Mock()
+        self.assertEqual(utils.put_unique_tasks(tube, []), 0)
+        self.assertFalse(tube.queue.tnt.call.called)
+
+    def test_task_fingerprint_ignores_key_order(self):
+        tube = Mock()
+        tube.serialize = Mock(side_effect=msgpack.packb)
+        first, second = {}, {}
+        for key in xrange(100):
+            first[str(key)] = {'a': key, 'b': [key]}
+        for key in reversed(xrange(100)):
+            second[str(key)] = {'b': [key], 'a': key}
+        self.assertEqual(utils.task_fingerprint(tube, first), utils.task_fingerprint(tube, second))
+        self.assertEqual(msgpack.unpackb(utils.task_fingerprint(tube, first)), first)
+
+    def test_ack_tasks(self):
+        queue = Mock()
+        queue.space = 5
+        queue.tnt.call = Mock(return_value=[('id1', 'tube', 'done', 'data')])
+        tasks = [Mock(queue=queue, task_id='id1'), Mock(queue=queue, task_id='id2')]
+        self.assertEqual(utils.ack_tasks(tasks), {'id1'})
+        queue.tnt.call.assert_called_once_with('queue.ack_many', ('5', 'id1', 'id2'))
+        self.assertTrue(all(task.modified for task in tasks))
+
+    def test_bury_tasks(self):
+        queue = Mock()
+        queue.space = 5
+        queue.tnt.call = Mock(return_value=[('id1', 'tube', 'buried', 'data')])
+        self.assertEqual(utils.bury_tasks([Mock(queue=queue, task_id='id1')]), {'id1'})
+        queue.tnt.call.assert_called_once_with('queue.bury_many', ('5', 'id1'))
+
+    def test_release_tasks(self):
+        queue = Mock()
+        queue.space = 5
+        queue.tnt.call = Mock(return_value=[('id1', 'tube', 'ready', 'data')])
+        self.assertEqual(utils.release_tasks([Mock(queue=queue, task_id='id1')], 30), {'id1'})
+        queue.tnt.call.assert_called_once_with('queue.release_many', ('5', '30', 'id1'))
+
+    def test_ack_tasks_empty(self):
+        self.assertEqual(utils.ack_tasks([]), set())
+
     def test_spawn_workers(self):
         with patch('lib.utils.Process', Mock(return_value=Mock())):
-            utils.spawn_workers(10, 'target', 'args', 35)
+            utils.spawn_workers(10, 'target', ('arg',), 35)
+
+    def test_spawn_workers_returns_processes(self):
+        with patch('lib.utils.Process', Mock(side_effect=[Mock(pid=1), Mock(pid=2)])):
+            processes = utils.spawn_workers(2, 'target', ('arg',), 35)
+        self.assertEqual([p.pid for p in processes], [1, 2])
+        self.assertTrue(all(p.start.called for p in processes))
+
+    def test_respawn_backoff_doubles_delay_on_quick_exits(self):
+        backoff = utils.RespawnBackoff(5, 1, 3)
+        with patch('lib.utils.time', Mock(time=Mock(side_effect=[100, 101, 102, 103, 104, 105, 110, 116]))):
+            backoff.spawned([Mock(pid=1), Mock(pid=2)])
+            backoff.update([])
+            self.assertEqual(backoff.spawn_at(), 101)
+            backoff.spawned([Mock(pid=3)])
+            backoff.update([])
+            self.assertEqual(backoff.spawn_at(), 104)
+            backoff.spawned([Mock(pid=4)])
+            backoff.update([])
+            self.assertEqual(backoff.spawn_at(), 107)
+            backoff.spawned([Mock(pid=5)])
+            backoff.update([])
+        self.assertEqual(backoff.failures, 0)
+        self.assertEqual(backoff.spawn_at(), 0)
+
+    def test_respawn_backoff_ignores_alive_workers(self):
+        backoff = utils.RespawnBackoff(5, 1, 60)
+        with patch('lib.utils.time', Mock(time=Mock(side_effect=[100, 101]))):
+            backoff.spawned([Mock(pid=1)])
+            backoff.update([1])
+        self.assertEqual(backoff.spawn_at(), 0)
+        self.assertEqual(backoff.started, {1: 100})
+
+    def test_spawn_workers_kwargs(self):
+        with patch('lib.utils.Process', Mock(return_value=Mock())) as process:
+            utils.spawn_workers(1, 'target', ('arg',), 35, kwargs={'hop_cache': 'cache'})
+        process.assert_called_once_with(target=utils.run_worker, args=('target', 'arg'),
+                                        kwargs={'hop_cache': 'cache', 'parent_pid': 35})
+
+    def test_run_worker_resets_signals(self):
+        target = Mock()
+        with patch('lib.utils.signal.set_wakeup_fd', Mock()) as set_wakeup_fd:
+            with patch('lib.utils.signal.signal', Mock()) as set_signal:
+                utils.run_worker(target, 'config', parent_pid=35)
+        set_wakeup_fd.assert_called_once_with(-1)
+        self.assertEqual(set_signal.call_args_list, [
+            ((signal.SIGCHLD, signal.SIG_DFL),),
+            ((signal.SIGTERM, signal.SIG_DFL),),
+            ((signal.SIGINT, signal.SIG_DFL),),
+            ((signal.SIGUSR1, signal.SIG_IGN),),
+            ((signal.SIGUSR2, signal.SIG_IGN),),
+        ])
+        target.assert_called_once_with('config', parent_pid=35)
+
+    def test_child_watcher_wakes_on_child_exit(self):
+        watcher = utils.ChildWatcher()
+        try:
+            self.assertFalse(watcher.wait(0.01))
+            child = Process(target=time.sleep, args=(0.1,))
+            child.start()
+            started = time.time()
+            self.assertTrue(watcher.wait(5))
+            self.assertLess(time.time() - started, 1)
+            child.join()
+            self.assertFalse(watcher.wait(0))
+        finally:
+            watcher.close()
+        self.assertEqual(signal.getsignal(signal.SIGCHLD), signal.SIG_DFL)
 
     def test_check_network_status(self):
         with patch('lib.utils.urllib2.urlopen', Mock()):
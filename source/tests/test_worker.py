@@ -1,9 +1,17 @@
 __author__ = 'anis'
 
+import signal
 import unittest
+import gevent
 from mock import patch, Mock, MagicMock
 from tarantool.error import DatabaseError
 from lib import worker
+from lib.cache import ResultCache
+from lib.metrics import Registry
+from lib.retry import RetryPolicy
+
+
+WORKER_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, signal.SIGUSR2)
 
 
 def get_confog():
@@ -20,10 +28,36 @@ def get_confog():
     config.HTTP_TIMEOUT = 5
     config.MAX_REDIRECTS = 3
     config.USER_AGENT = "user_agent"
+    config.MULTI_CONCURRENCY = 2
+    config.MULTI_TAKE_TIMEOUT = 0.001
+    config.CURL_POOL_SIZE = 2
+    config.RESULT_BATCH_SIZE = 1
+    config.RESULT_FLUSH_INTERVAL = 0
+    config.METRICS_PUSH_INTERVAL = 0
+    config.TIMING_SINK = None
+    config.MAX_TASKS_PER_CHILD = 0
+    config.GREEN_CONCURRENCY = 2
+    config.GREEN_TAKE_INTERVAL = 0.01
+    config.PROFILE_EVERY = 0
+    config.PROFILE_DIR = '/tmp/profiles'
+    config.RESULT_CACHE_POLL_INTERVAL = 0.01
+    config.RETRY_POLICY = {'other': {'attempts': 1, 'delay': 300}}
+    config.RETRY_MAX_DELAY = 3600
+    config.RETRY_JITTER = 0
     return config
 
 
 class WorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        # workers install their own signal handlers
+        self.handlers = dict((signum, signal.getsignal(signum)) for signum in WORKER_SIGNALS)
+
+    def tearDown(self):
+        for signum, handler in self.handlers.iteritems():
+            signal.signal(signum, handler)
+        worker.run_application = True
+        worker.take_paused = False
+
     def test_get_redirect_history_from_task_error_and_no_recheck1(self):
         task = Mock()
         task.data = dict(url='url', recheck=False, url_id='url_id', suspicious='suspicious')
@@ -45,6 +79,73 @@ class WorkerTestCase(unittest.TestCase):
             is_input, data = worker.get_redirect_history_from_task(task, 42)
             self.assertFalse(is_input)
 
+    def test_get_redirect_history_from_task_result_cache_hit(self):
+        task = Mock()
+        task.data = dict(url='http://a.ru/', url_id='url_id', suspicious='suspicious')
+        result_cache = Mock()
+        result_cache.claim = Mock(return_value=((['http_status'], ['http://b.ru/'], []), False))
+        metrics = Registry()
+        with patch('lib.worker.get_redirect_history', Mock()) as get_redirect_history:
+            is_input, data = worker.get_redirect_history_from_task(
+                task, 42, metrics=metrics, result_cache=result_cache
+            )
+        self.assertFalse(get_redirect_history.called)
+        result_cache.claim.assert_called_once_with(u'http://a.ru/', 0)
+        self.assertFalse(is_input)
+        self.assertEqual(data, {
+            'url_id': 'url_id',
+            'result': [['http_status'], ['http://b.ru/'], []],
+            'check_type': 'normal',
+            'suspicious': 'suspicious',
+        })
+        self.assertEqual(metrics.counters[('checker_result_cache_total', (('outcome', 'hit'),))], 1)
+
+    def test_get_redirect_history_from_task_result_cache_waits_for_check(self):
+        task = Mock()
+        task.data = dict(url='http://a.ru/', url_id='url_id', recheck=True)
+        result_cache = Mock()
+        result_cache.claim = Mock(side_effect=[(None, False), (None, True)])
+        wait = Mock()
+        history = (['ERROR'], ['http://a.ru/'], [])
+        with patch('lib.worker.get_redirect_history', Mock(return_value=history)):
+            with patch('lib.worker.time', Mock(return_value=100)):
+                is_input, data = worker.get_redirect_history_from_task(
+                    task, 42, result_cache=result_cache, poll_interval=0.5, wait=wait
+                )
+        # a recheck does not take a result got before the task
+        self.assertEqual(result_cache.claim.call_args_list[0][0], (u'http://a.ru/', 100))
+        wait.assert_called_once_with(0.5)
+        result_cache.complete.assert_called_once_with(u'http://a.ru/', history + (None,))
+        self.assertFalse(is_input)
+
+    def test_get_redirect_history_from_task_result_cache_wait_stopped(self):
+        task = Mock()
+        task.data = dict(url='http://a.ru/', url_id='url_id')
+        result_cache = Mock()
+        result_cache.claim = Mock(return_value=(None, False))
+        wait = Mock()
+        stopped = Mock(side_effect=[False, True])
+        with patch('lib.worker.get_redirect_history', Mock()) as get_redirect_history:
+            self.assertRaises(
+                worker.WaitCancelled, worker.get_redirect_history_from_task, task, 42,
+                result_cache=result_cache, wait=wait, stopped=stopped
+            )
+        self.assertEqual(wait.call_count, 1)
+        self.assertFalse(get_redirect_history.called)
+        self.assertFalse(result_cache.release.called)
+
+    def test_get_redirect_history_from_task_result_cache_released_on_error(self):
+        task = Mock()
+        task.data = dict(url='http://a.ru/', url_id='url_id')
+        result_cache = Mock()
+        result_cache.claim = Mock(return_value=(None, True))
+        with patch('lib.worker.get_redirect_history', Mock(side_effect=gevent.GreenletExit)):
+            self.assertRaises(
+                gevent.GreenletExit, worker.get_redirect_history_from_task, task, 42, result_cache=result_cache
+            )
+        result_cache.release.assert_called_once_with([u'http://a.ru/'])
+        self.assertFalse(result_cache.complete.called)
+
     def test_worker_is_input_true(self):
         config = get_confog()
         with patch("os.path.exists", Mock(return_value=True)):
@@ -52,7 +153,9 @@ class WorkerTestCase(unittest.TestCase):
                 with patch("lib.worker.get_tube", Mock(return_value=MagicMock())):
                     data = dict(url='url', recheck=True, url_id='url_id', suspicious='suspicious')
                     with patch("lib.worker.get_redirect_history_from_task", Mock(return_value=(True, data))):
-                        worker.worker(config, 42)
+                        with patch("lib.worker.put_unique_tasks", Mock()) as put_unique_tasks:
+                            worker.worker(config, 42)
+        self.assertTrue(put_unique_tasks.called)
 
     def test_worker_is_input_false(self):
         config = get_confog()
@@ -61,7 +164,60 @@ class WorkerTestCase(unittest.TestCase):
                 with patch("lib.worker.get_tube", Mock(return_value=MagicMock())):
                     data = dict(url='url', recheck=True, url_id='url_id', suspicious='suspicious')
                     with patch("lib.worker.get_redirect_history_from_task", Mock(return_value=(False, data))):
-                        worker.worker(config, 42)
+                        with patch("lib.worker.put_tasks", Mock()) as put_tasks:
+                            worker.worker(config, 42)
+        self.assertTrue(put_tasks.called)
+
+    def test_worker_timing(self):
+        config = get_confog()
+        config.TIMING_SINK = 'log'
+        task = Mock(task_id='task_id')
+        timing_sink = Mock()
+        with patch("os.path.exists", Mock(return_value=True)):
+            with patch("lib.worker.break_func_for_test", Mock(return_value=True)):
+                with patch("lib.worker.get_tube", Mock(return_value=MagicMock())):
+                    with patch("lib.worker.take_task", Mock(return_value=task)):
+                        with patch("lib.worker.get_timing_sink", Mock(return_value=timing_sink)):
+                            with patch("lib.worker.get_redirect_history_from_task",
+                                       Mock(return_value=None)) as get_history:
+                                with patch("lib.worker.ack_tasks", Mock(return_value=set())):
+                                    worker.worker(config, 42)
+        timing = timing_sink.call_args[0][0]
+        self.assertEqual(timing.task_id, 'task_id')
+        self.assertEqual(timing.stages.keys(), ['queue_take'])
+        self.assertIsNotNone(timing.total)
+        self.assertIs(get_history.call_args[0][7], timing)
+
+    def test_worker_recycled_after_max_tasks(self):
+        config = get_confog()
+        config.MAX_TASKS_PER_CHILD = 2
+        with patch('lib.worker.logger', Mock()) as logger:
+            with patch("os.path.exists", Mock(return_value=True)):
+                with patch("lib.worker.get_tube", Mock(return_value=MagicMock())):
+                    with patch("lib.worker.take_task", Mock(return_value=Mock(task_id=1))) as take_task:
+                        with patch("lib.worker.get_redirect_history_from_task", Mock(return_value=None)):
+                            with patch("lib.worker.ack_tasks", Mock(return_value={1})):
+                                worker.worker(config, 42)
+        self.assertEqual(take_task.call_count, 2)
+        logger.info.assert_any_call(u'Worker took 2 tasks, exiting to be respawned.')
+
+    def test_multi_worker_recycled_after_max_tasks(self):
+        config = get_confog()
+        config.MAX_TASKS_PER_CHILD = 3
+        tasks = [Mock(task_id=i, data=dict(url='url', url_id=i)) for i in xrange(3)]
+        checker = Mock()
+        checker.perform = Mock(side_effect=[[], [(0, ([], ['url'], [])), (1, ([], ['url'], []))],
+                                            [(2, ([], ['url'], []))]])
+        with patch('lib.worker.logger', Mock()) as logger:
+            with patch("os.path.exists", Mock(return_value=True)):
+                with patch("lib.worker.connect_tubes", Mock(return_value=(MagicMock(), MagicMock()))):
+                    with patch("lib.worker.MultiRedirectChecker", Mock(return_value=checker)):
+                        with patch("lib.worker.take_tasks", Mock(side_effect=[tasks[:2], [tasks[2]]])) as take_tasks:
+                            with patch("lib.worker.put_tasks", Mock()):
+                                with patch("lib.worker.ack_tasks", Mock(return_value={0, 1, 2})):
+                                    worker.multi_worker(config, 42)
+        self.assertEqual([call[0][1] for call in take_tasks.call_args_list], [2, 1])
+        logger.info.assert_any_call(u'Worker took 3 tasks, exiting to be respawned.')
 
     def test_worker_no_while(self):
         config = get_confog()
@@ -82,29 +238,446 @@ class WorkerTestCase(unittest.TestCase):
 
     def test_worker_no_task(self):
         config = get_confog()
-        input_tube = MagicMock()
-        input_tube.take = Mock(return_value=False)
         with patch('lib.worker.logger', Mock()) as logger:
             with patch("os.path.exists", Mock(return_value=True)):
                 with patch("lib.worker.break_func_for_test", Mock(return_value=True)):
-                    with patch("lib.worker.get_tube", Mock(return_value=input_tube)):
-                        worker.worker(config, 42)
+                    with patch("lib.worker.get_tube", Mock(return_value=MagicMock())):
+                        with patch("lib.worker.take_task", Mock(return_value=None)):
+                            worker.worker(config, 42)
         self.assertTrue(logger.info.called)
 
     def test_worker_exception(self):
         config = get_confog()
         task = MagicMock()
-        task.ack = Mock(side_effect=DatabaseError)
-        input_tube = MagicMock()
-        input_tube.take = Mock(return_value=task)
+        data = dict(url='url', recheck=True, url_id='url_id', suspicious='suspicious')
         with patch('lib.worker.logger', Mock()) as logger:
             with patch("os.path.exists", Mock(return_value=True)):
                 with patch("lib.worker.break_func_for_test", Mock(return_value=True)):
-                    with patch("lib.worker.get_tube", Mock(return_value=input_tube)):
-                        data = dict(url='url', recheck=True, url_id='url_id', suspicious='suspicious')
-                        with patch("lib.worker.get_redirect_history_from_task", Mock(return_value=(True, data))):
-                            worker.worker(config, 42)
-        self.assertTrue(logger.info.called)
+                    with patch("lib.worker.get_tube", Mock(return_value=MagicMock())):
+                        with patch("lib.worker.take_task", Mock(return_value=task)):
+                            with patch("lib.worker.get_redirect_history_from_task", Mock(return_value=(True, data))):
+                                with patch("lib.worker.put_unique_tasks", Mock()):
+                                    with patch("lib.worker.ack_tasks", Mock(side_effect=DatabaseError)):
+                                        worker.worker(config, 42)
+        logger.info.assert_called_with('Task ack fail')
+
+    def test_make_task_result_normal(self):
+        task = Mock()
+        task.data = dict(url='url', url_id='url_id', suspicious='suspicious')
+        is_input, data = worker.make_task_result(task, ['http_status'], ['url', 'url2'], [])
+        self.assertFalse(is_input)
+        self.assertEqual(data, {
+            'url_id': 'url_id',
+            'result': [['http_status'], ['url', 'url2'], []],
+            'check_type': 'normal',
+            'suspicious': 'suspicious',
+        })
+
+    def test_make_task_result_retries_from_failed_url(self):
+        task = Mock()
+        task.data = dict(url='http://a.ru/', url_id='url_id')
+        policy = RetryPolicy({'timeout': {'attempts': 2, 'delay': 60}}, 3600, 0)
+        history = (['http_status', 'ERROR'], ['http://a.ru/', 'http://b.ru/', 'http://b.ru/'], [], 'timeout')
+        for attempt in (1, 2):
+            is_input, data = worker.make_task_result(task, *history, retry_policy=policy)
+            self.assertTrue(is_input)
+            self.assertEqual(data, {
+                'url': 'http://a.ru/',
+                'url_id': 'url_id',
+                'recheck': True,
+                'attempt': attempt,
+                'error': 'timeout',
+                'resume': [['http_status'], ['http://a.ru/', 'http://b.ru/']],
+            })
+        # the attempts are over
+        is_input, data = worker.make_task_result(task, *history, retry_policy=policy)
+        self.assertFalse(is_input)
+        self.assertEqual(data['result'], list(history[:3]))
+
+    def test_make_task_result_error_kind_not_retried(self):
+        task = Mock()
+        task.data = dict(url='http://a.ru/', url_id='url_id')
+        policy = RetryPolicy({'timeout': {'attempts': 2, 'delay': 60}}, 3600, 0)
+        is_input, data = worker.make_task_result(
+            task, ['ERROR'], ['http://a.ru/', 'http://a.ru/'], [], 'tls', retry_policy=policy
+        )
+        self.assertFalse(is_input)
+
+    def test_get_redirect_history_from_task_resumes(self):
+        task = Mock()
+        task.data = dict(url='http://a.ru/', url_id='url_id', recheck=True, attempt=1,
+                         resume=[['http_status'], ['http://a.ru/', 'http://b.ru/']])
+        with patch('lib.worker.get_redirect_history', Mock(return_value=([], [], []))) as get_redirect_history:
+            worker.get_redirect_history_from_task(task, 42)
+        history = get_redirect_history.call_args[0][7]
+        self.assertEqual(history.redirect_url, u'http://b.ru/')
+        self.assertEqual(history.history_types, ['http_status'])
+
+    def test_result_batch_retry_delay(self):
+        config = get_confog()
+        config.RETRY_POLICY = {'timeout': {'attempts': 3, 'delay': 60}}
+        results = worker.ResultBatch(config, 'input_tube', 'output_tube')
+        task = Mock(task_id='id1', pri=0)
+        results.items = [(task, (True, {'recheck': True, 'attempt': 2, 'error': 'timeout'}))]
+        with patch('lib.worker.put_unique_tasks', Mock()) as put_unique_tasks:
+            with patch('lib.worker.ack_tasks', Mock(return_value={'id1'})):
+                with patch('lib.worker.logger', Mock()):
+                    results.flush()
+        self.assertEqual(put_unique_tasks.call_args[0][1][0][1], {'delay': 120, 'pri': 0})
+
+    def test_multi_worker(self):
+        config = get_confog()
+        task = Mock()
+        task.task_id = 'task_id'
+        task.data = dict(url='url', url_id='url_id')
+        input_tube = MagicMock()
+        output_tube = MagicMock()
+        checker = Mock()
+        checker.perform = Mock(return_value=[('task_id', ([], ['url'], []))])
+        with patch("os.path.exists", Mock(return_value=True)):
+            with patch("lib.worker.break_func_for_test", Mock(return_value=True)):
+                with patch("lib.worker.connect_tubes", Mock(return_value=(input_tube, output_tube))):
+                    with patch("lib.worker.MultiRedirectChecker", Mock(return_value=checker)):
+                        with patch("lib.worker.take_tasks", Mock(return_value=[task])) as take_tasks:
+                            with patch("lib.worker.put_tasks", Mock()) as put_tasks:
+                                with patch("lib.worker.ack_tasks", Mock(return_value={'task_id'})) as ack_tasks:
+                                    worker.multi_worker(config, 42)
+        self.assertEqual(checker.add.call_args[0][:3], ('task_id', u'url', None))
+        take_tasks.assert_called_once_with(input_tube, config.MULTI_CONCURRENCY, config.QUEUE_TAKE_TIMEOUT)
+        self.assertEqual(put_tasks.call_args[0][0], output_tube)
+        ack_tasks.assert_called_once_with([task])
+        self.assertTrue(checker.close.called)
+
+    def test_multi_worker_takes_free_slots(self):
+        config = get_confog()
+        task = Mock()
+        task.task_id = 'task_id'
+        task.data = dict(url='url', url_id='url_id')
+        input_tube = MagicMock()
+        checker = Mock()
+        checker.perform = Mock(return_value=[])
+        with patch("os.path.exists", Mock(side_effect=[True, True, False])):
+            with patch("lib.worker.connect_tubes", Mock(return_value=(input_tube, MagicMock()))):
+                with patch("lib.worker.MultiRedirectChecker", Mock(return_value=checker)):
+                    with patch("lib.worker.take_tasks", Mock(side_effect=[[task], []])) as take_tasks:
+                        with patch("lib.worker.release_tasks", Mock(return_value={'task_id'})) as release_tasks:
+                            worker.multi_worker(config, 42)
+        self.assertEqual(take_tasks.call_args_list[1][0], (input_tube, 1, config.MULTI_TAKE_TIMEOUT))
+        # the task still in flight when the worker exits is given back to the queue at once
+        release_tasks.assert_called_once_with([task])
+        self.assertTrue(checker.close.called)
+
+    def test_multi_worker_result_cache_coalesces_same_url(self):
+        config = get_confog()
+        tasks = [
+            Mock(task_id=0, data=dict(url='http://a.ru/', url_id=10)),
+            Mock(task_id=1, data=dict(url='http://a.ru/', url_id=11, suspicious='suspicious')),
+        ]
+        checker = Mock()
+        checker.perform = Mock(side_effect=[[(0, (['http_status'], ['http://b.ru/'], []))], []])
+        with patch("os.path.exists", Mock(side_effect=[True, True, False])):
+            with patch("lib.worker.connect_tubes", Mock(return_value=(MagicMock(), 'output_tube'))):
+                with patch("lib.worker.MultiRedirectChecker", Mock(return_value=checker)):
+                    with patch("lib.worker.take_tasks", Mock(side_effect=[tasks, []])):
+                        with patch("lib.worker.put_tasks", Mock()) as put_tasks:
+                            with patch("lib.worker.ack_tasks", Mock(return_value={0, 1})):
+                                with patch('lib.worker.logger', Mock()):
+                                    worker.multi_worker(config, 42, result_cache=ResultCache(10, 60, 30))
+        self.assertEqual(checker.add.call_count, 1)
+        self.assertEqual(checker.add.call_args[0][:3], (0, u'http://a.ru/', None))
+        outputs = [call[0][1][0][0] for call in put_tasks.call_args_list]
+        self.assertEqual([data['url_id'] for data in outputs], [10, 11])
+        self.assertEqual(outputs[1]['result'], outputs[0]['result'])
+        self.assertEqual(outputs[1]['suspicious'], 'suspicious')
+
+    def test_multi_worker_stop_releases_in_flight(self):
+        config = get_confog()
+        tasks = [Mock(task_id=i, data=dict(url='url', url_id=i)) for i in xrange(2)]
+        checker = Mock()
+
+        def perform(timeout):
+            worker.stop_handler(15, None)
+            return [(0, ([], ['url'], []))]
+
+        checker.perform = Mock(side_effect=perform)
+        metrics = Registry()
+        with patch('lib.worker.logger', Mock()):
+            with patch("os.path.exists", Mock(return_value=True)):
+                with patch("lib.worker.connect_tubes", Mock(return_value=(MagicMock(), MagicMock()))):
+                    with patch("lib.worker.MultiRedirectChecker", Mock(return_value=checker)):
+                        with patch("lib.worker.take_tasks", Mock(return_value=tasks)) as take_tasks:
+                            with patch("lib.worker.put_tasks", Mock()):
+                                with patch("lib.worker.ack_tasks", Mock(return_value={0})) as ack_tasks:
+                                    with patch("lib.worker.release_tasks", Mock(return_value={1})) as release_tasks:
+                                        worker.multi_worker(config, 42, metrics=metrics)
+        self.assertEqual(take_tasks.call_count, 1)
+        ack_tasks.assert_called_once_with([tasks[0]])
+        release_tasks.assert_called_once_with([tasks[1]])
+        self.assertTrue(checker.close.called)
+        self.assertEqual(metrics.counters[('checker_tasks_released_total', ())], 1)
+
+    def test_worker_stop_finishes_current_task(self):
+        config = get_confog()
+        task = Mock(task_id=1)
+
+        def get_history(*args):
+            worker.stop_handler(15, None)
+            return False, 'data'
+
+        with patch('lib.worker.logger', Mock()):
+            with patch("os.path.exists", Mock(return_value=True)):
+                with patch("lib.worker.get_tube", Mock(return_value=MagicMock())):
+                    with patch("lib.worker.take_task", Mock(return_value=task)) as take_task:
+                        with patch("lib.worker.get_redirect_history_from_task", Mock(side_effect=get_history)):
+                            with patch("lib.worker.put_tasks", Mock()):
+                                with patch("lib.worker.ack_tasks", Mock(return_value={1})) as ack_tasks:
+                                    worker.worker(config, 42)
+        self.assertEqual(take_task.call_count, 1)
+        ack_tasks.assert_called_once_with([task])
+
+    def test_worker_stop_releases_waiting_task(self):
+        config = get_confog()
+        task = Mock(task_id=1)
+
+        def get_history(*args):
+            worker.stop_handler(15, None)
+            # the simple engine passes its stop condition as the last argument
+            self.assertTrue(args[-1]())
+            raise worker.WaitCancelled
+
+        with patch('lib.worker.logger', Mock()):
+            with patch("os.path.exists", Mock(return_value=True)):
+                with patch("lib.worker.get_tube", Mock(return_value=MagicMock())):
+                    with patch("lib.worker.take_task", Mock(return_value=task)) as take_task:
+                        with patch("lib.worker.get_redirect_history_from_task", Mock(side_effect=get_history)):
+                            with patch("lib.worker.ack_tasks", Mock()) as ack_tasks:
+                                with patch("lib.worker.release_tasks", Mock(return_value={1})) as release_tasks:
+                                    worker.worker(config, 42)
+        self.assertEqual(take_task.call_count, 1)
+        release_tasks.assert_called_once_with([task])
+        self.assertFalse(ack_tasks.called)
+
+    def test_worker_stop_releases_task_between_hops(self):
+        config = get_confog()
+        task = Mock(task_id=1, data=dict(url='http://a.ru/', url_id='url_id'))
+
+        def fetch_url(**kwargs):
+            worker.stop_handler(15, None)
+            return (u'http://b.ru/', 'http_status', None), None
+
+        with patch('lib.worker.logger', Mock()):
+            with patch("os.path.exists", Mock(return_value=True)):
+                with patch("lib.worker.get_tube", Mock(return_value=MagicMock())):
+                    with patch("lib.worker.take_task", Mock(return_value=task)) as take_task:
+                        with patch("lib.fetch_url", Mock(side_effect=fetch_url)) as fetch:
+                            with patch("lib.worker.ack_tasks", Mock()) as ack_tasks:
+                                with patch("lib.worker.release_tasks", Mock(return_value={1})) as release_tasks:
+                                    worker.worker(config, 42)
+        self.assertEqual(take_task.call_count, 1)
+        self.assertEqual(fetch.call_count, 1)
+        release_tasks.assert_called_once_with([task])
+        self.assertFalse(ack_tasks.called)
+
+    def test_worker_paused(self):
+        config = get_confog()
+
+        def resume(timeout):
+            worker.resume_handler(12, None)
+
+        with patch('lib.worker.install_signal_handlers', Mock()):
+            worker.pause_handler(10, None)
+            with patch('lib.worker.logger', Mock()):
+                with patch("os.path.exists", Mock(side_effect=[True, True, False])):
+                    with patch("lib.worker.get_tube", Mock(return_value=MagicMock())):
+                        with patch("lib.worker.take_task", Mock(return_value=None)) as take_task:
+                            with patch("lib.worker.sleep", Mock(side_effect=resume)) as sleep:
+                                worker.worker(config, 42)
+        sleep.assert_called_once_with(config.QUEUE_TAKE_TIMEOUT)
+        self.assertEqual(take_task.call_count, 1)
+
+    def test_install_signal_handlers(self):
+        with patch('lib.worker.signal.signal', Mock()) as set_signal:
+            with patch('lib.worker.signal.siginterrupt', Mock()) as siginterrupt:
+                worker.stop_handler(15, None)
+                worker.install_signal_handlers()
+        self.assertTrue(worker.run_application)
+        set_signal.assert_any_call(signal.SIGTERM, worker.stop_handler)
+        set_signal.assert_any_call(signal.SIGUSR1, worker.pause_handler)
+        set_signal.assert_any_call(signal.SIGUSR2, worker.resume_handler)
+        siginterrupt.assert_any_call(signal.SIGTERM, False)
+
+    def test_multi_worker_no_task(self):
+        config = get_confog()
+        checker = Mock()
+        with patch('lib.worker.logger', Mock()) as logger:
+            with patch("os.path.exists", Mock(side_effect=[True, False])):
+                with patch("lib.worker.connect_tubes", Mock(return_value=(MagicMock(), MagicMock()))):
+                    with patch("lib.worker.MultiRedirectChecker", Mock(return_value=checker)):
+                        with patch("lib.worker.take_tasks", Mock(return_value=[])):
+                            worker.multi_worker(config, 42)
+        self.assertFalse(checker.perform.called)
+        logger.info.assert_called_with('Parent is dead. exiting')
+
+    def test_green_worker(self):
+        config = get_confog()
+        tasks = [Mock(task_id=i, data=dict(url='url{}'.format(i), url_id=i)) for i in xrange(3)]
+        driver = Mock()
+        done = []
+
+        def get_history(task, *args):
+            # the first task is done at once, the second one takes a few loop turns
+            gevent.sleep(0.05 if task.task_id == 1 else 0)
+            done.append(task.task_id)
+            return False, 'data{}'.format(task.task_id)
+
+        with patch("os.path.exists", Mock(side_effect=lambda path: len(done) < 3)):
+            with patch("lib.worker.connect_tubes", Mock(return_value=(MagicMock(), 'output_tube'))):
+                with patch("lib.worker.GreenCurlMulti", Mock(return_value=driver)):
+                    with patch("lib.worker.set_curl_driver", Mock()) as set_curl_driver:
+                        with patch("lib.worker.take_tasks", Mock(side_effect=[tasks[:2], [tasks[2]]] + [[]] * 100)) as take:
+                            with patch("lib.worker.get_redirect_history_from_task", Mock(side_effect=get_history)):
+                                with patch("lib.worker.put_tasks", Mock()) as put_tasks:
+                                    with patch("lib.worker.ack_tasks", Mock(return_value={0, 1, 2})):
+                                        with patch('lib.worker.logger', Mock()):
+                                            worker.green_worker(config, 42)
+        self.assertEqual(take.call_args_list[0][0][1:], (2, config.QUEUE_TAKE_TIMEOUT))
+        # the second take happens after the first task is done
+        self.assertEqual(take.call_args_list[1][0][1:], (1, config.MULTI_TAKE_TIMEOUT))
+        self.assertEqual(sorted(call[0][1][0][0] for call in put_tasks.call_args_list), ['data0', 'data1', 'data2'])
+        self.assertEqual(set_curl_driver.call_args_list, [((driver,),), ((None,),)])
+        self.assertTrue(driver.close.called)
+
+    def test_green_worker_stop_releases_in_flight(self):
+        config = get_confog()
+        tasks = [Mock(task_id=i, data=dict(url='url{}'.format(i), url_id=i)) for i in xrange(2)]
+
+        def get_history(task, *args):
+            if task.task_id == 1:
+                worker.stop_handler(15, None)
+                gevent.sleep(10)
+            return False, 'data{}'.format(task.task_id)
+
+        with patch("os.path.exists", Mock(return_value=True)):
+            with patch("lib.worker.connect_tubes", Mock(return_value=(MagicMock(), 'output_tube'))):
+                with patch("lib.worker.GreenCurlMulti", Mock()):
+                    with patch("lib.worker.set_curl_driver", Mock()):
+                        with patch("lib.worker.take_tasks", Mock(side_effect=[tasks, []])):
+                            with patch("lib.worker.get_redirect_history_from_task", Mock(side_effect=get_history)):
+                                with patch("lib.worker.put_tasks", Mock()):
+                                    with patch("lib.worker.ack_tasks", Mock(return_value={0})) as ack_tasks:
+                                        with patch("lib.worker.release_tasks", Mock(return_value={1})) as release:
+                                            with patch('lib.worker.logger', Mock()):
+                                                worker.green_worker(config, 42)
+        ack_tasks.assert_called_once_with([tasks[0]])
+        release.assert_called_once_with([tasks[1]])
+
+    def test_result_batch_waits_for_size(self):
+        config = get_confog()
+        config.RESULT_BATCH_SIZE = 2
+        config.RESULT_FLUSH_INTERVAL = 60
+        output_tube = Mock()
+        results = worker.ResultBatch(config, Mock(), output_tube)
+        task1, task2 = Mock(), Mock()
+        with patch('lib.worker.put_tasks', Mock()) as put_tasks:
+            with patch('lib.worker.ack_tasks', Mock(return_value=set())) as ack_tasks:
+                results.add(task1, (False, 'data1'))
+                self.assertEqual(len(results), 1)
+                self.assertFalse(put_tasks.called)
+                results.add(task2, (False, 'data2'))
+        self.assertEqual(len(results), 0)
+        put_tasks.assert_called_once_with(output_tube, [('data1', {}), ('data2', {})])
+        ack_tasks.assert_called_once_with([task1, task2])
+
+    def test_result_batch_flush_interval(self):
+        config = get_confog()
+        config.RESULT_BATCH_SIZE = 10
+        config.RESULT_FLUSH_INTERVAL = 1
+        results = worker.ResultBatch(config, Mock(), Mock())
+        task = Mock()
+        with patch('lib.worker.put_tasks', Mock()):
+            with patch('lib.worker.ack_tasks', Mock(return_value=set())) as ack_tasks:
+                with patch('lib.worker.time', Mock(side_effect=[100, 100.5, 101])):
+                    results.add(task, (False, 'data'))
+                    self.assertFalse(ack_tasks.called)
+                    results.flush_if_due()
+        ack_tasks.assert_called_once_with([task])
+
+    def test_result_batch_puts_before_acks(self):
+        config = get_confog()
+        calls = Mock()
+        calls.ack_tasks = Mock(return_value={'id1'})
+        task1, task2, task3 = Mock(task_id='id1', pri=5), Mock(task_id='id2'), Mock(task_id='id3')
+        results = worker.ResultBatch(config, 'input_tube', 'output_tube')
+        results.items = [(task1, (True, {'recheck': True})), (task2, (False, 'data2')), (task3, None)]
+        with patch('lib.worker.put_unique_tasks', calls.put_unique_tasks):
+            with patch('lib.worker.put_tasks', calls.put_tasks):
+                with patch('lib.worker.ack_tasks', calls.ack_tasks):
+                    with patch('lib.worker.logger', Mock()) as logger:
+                        results.flush()
+        self.assertEqual(calls.mock_calls, [
+            ('put_unique_tasks', ('input_tube', [({'recheck': True}, {'delay': 300, 'pri': 5})]), {}),
+            ('put_tasks', ('output_tube', [('data2', {})]), {}),
+            ('ack_tasks', ([task3, task1, task2],), {}),
+        ])
+        logger.info.assert_any_call(u'Task id=id1 done')
+        logger.info.assert_any_call(u'Task id=id2 ack fail')
+
+    def test_result_batch_put_fail_not_acked(self):
+        results = worker.ResultBatch(get_confog(), 'input_tube', 'output_tube')
+        task1, task2 = Mock(task_id='id1'), Mock(task_id='id2')
+        results.items = [(task1, (True, {'recheck': True})), (task2, (False, 'data2'))]
+        with patch('lib.worker.put_unique_tasks', Mock(side_effect=DatabaseError)):
+            with patch('lib.worker.put_tasks', Mock(return_value=1)):
+                with patch('lib.worker.ack_tasks', Mock(return_value={'id2'})) as ack_tasks:
+                    with patch('lib.worker.logger', Mock()):
+                        results.flush()
+        ack_tasks.assert_called_once_with([task2])
+
+    def test_result_batch_metrics(self):
+        config = get_confog()
+        metrics = Registry()
+        results = worker.ResultBatch(config, 'input_tube', 'output_tube', metrics)
+        tasks = [Mock(task_id='id1', pri=0), Mock(task_id='id2'), Mock(task_id='id3')]
+        results.items = [(tasks[0], (True, {'recheck': True})), (tasks[1], (False, 'data2')), (tasks[2], (False, 'data3'))]
+        with patch('lib.worker.put_unique_tasks', Mock()):
+            with patch('lib.worker.put_tasks', Mock()):
+                with patch('lib.worker.ack_tasks', Mock(return_value={'id1', 'id2'})):
+                    with patch('lib.worker.logger', Mock()):
+                        results.flush()
+        self.assertEqual(metrics.counters, {
+            ('checker_tasks_requeued_total', ()): 1,
+            ('checker_tasks_acked_total', ()): 2,
+        })
+        self.assertEqual(sorted(dict(labels)['request'] for name, labels in metrics.histograms), ['ack', 'put'])
+
+    def test_multi_worker_metrics(self):
+        config = get_confog()
+        task = Mock(task_id='task_id', data=dict(url='url', url_id='url_id'))
+        checker = Mock()
+        checker.perform = Mock(return_value=[('task_id', (['http_status', 'meta_tag'], ['url', 'url2'], []))])
+        shared = Mock()
+        with patch("os.path.exists", Mock(return_value=True)):
+            with patch("lib.worker.break_func_for_test", Mock(return_value=True)):
+                with patch("lib.worker.connect_tubes", Mock(return_value=(MagicMock(), MagicMock()))):
+                    with patch("lib.worker.MultiRedirectChecker", Mock(return_value=checker)):
+                        with patch("lib.worker.take_tasks", Mock(return_value=[task])):
+                            with patch("lib.worker.put_tasks", Mock()):
+                                with patch("lib.worker.ack_tasks", Mock(return_value={'task_id'})):
+                                    with patch("lib.worker.os.getpid", Mock(return_value=7)):
+                                        worker.multi_worker(config, 42, metrics=shared)
+        shared_metrics = Registry()
+        for call in shared.merge.call_args_list:
+            shared_metrics.merge(call[0][0])
+        self.assertEqual(shared_metrics.counters, {
+            ('checker_tasks_taken_total', ()): 1,
+            ('checker_tasks_acked_total', ()): 1,
+        })
+        self.assertEqual(shared_metrics.gauges, {
+            ('checker_worker_capacity', (('worker', 7),)): config.MULTI_CONCURRENCY,
+            ('checker_tasks_in_flight', (('worker', 7),)): 0,
+        })
+        chain_length = shared_metrics.histograms[('checker_redirect_chain_length', ())]
+        self.assertEqual(chain_length[1:], [2, 1])
 
     def break_func_for_test(self):
         result = worker.break_func_for_test()